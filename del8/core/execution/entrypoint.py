@@ -1,4 +1,6 @@
 """TODO: Add title."""
+import time
+
 from del8.core.di import executable
 from del8.core.di import scopes
 from del8.core.storage.storage import RunState
@@ -21,8 +23,8 @@ def save_params_at_run_start(run_params, storage, experiment, run_uuid):
 
 
 @executable.executable()
-def set_run_state(state, storage):
-    storage.set_run_state(state)
+def set_run_state(state, storage, dedup_key=None):
+    storage.set_run_state(state, dedup_key=dedup_key)
 
 
 def worker_run(
@@ -39,6 +41,9 @@ def worker_run(
     # The run_params are used purely for storage at the start of the experiment
     # and do not affect any execution.
     run_params=None,
+    # Shared by every run of the same execution item. Used so that only one of
+    # them gets marked as finished if the item is run more than once.
+    dedup_key=None,
 ):
     # NOTE: Should only be called on the worker. Users probably won't call
     # this method directly.
@@ -80,5 +85,8 @@ def worker_run(
                 set_run_state()(RunState.STARTED)
                 if run_params:
                     save_params_at_run_start()(run_params)
+                start_time = time.time()
                 executable_cls(**init_kwargs)(**call_kwargs)
-                set_run_state()(RunState.FINISHED)
+                duration_secs = time.time() - start_time
+                storage.store_item(runs.RunTiming(duration_secs=duration_secs))
+                set_run_state()(RunState.FINISHED, dedup_key=dedup_key)
@@ -1,7 +1,16 @@
 """TODO: Add title."""
 import abc
+import collections
+import heapq
+import statistics
+import threading
+import time
+import uuid as uuidlib
+
+from absl import logging
 
 from .. import data_class
+from .. import serialization
 
 
 @data_class.data_class()
@@ -23,8 +32,13 @@ class Supervisor(abc.ABC):
         raise NotImplementedError
 
     def run(self, execution_items):
+        start_time = time.time()
         with self:
             self._run(execution_items)
+        logging.info(
+            f"Makespan of {len(execution_items)} execution items: "
+            f"{time.time() - start_time:.1f} secs."
+        )
 
     def initialize(self):
         pass
@@ -57,3 +71,340 @@ class WorkerLauncher(abc.ABC):
     @abc.abstractmethod
     def launch(self) -> WorkerHandle:
         raise NotImplementedError
+
+
+###############################################################################
+
+
+def get_item_key(item):
+    """Returns a string identifying the item, which is cheap to hash and compare.
+
+    Data classes all hash to the same value, so we should not put ExecutionItems
+    themselves in sets or use them as dict keys.
+    """
+    if isinstance(item, str):
+        # Already serialized.
+        return item
+    if isinstance(item, ExecutionItem):
+        dedup_key = item.worker_run_kwargs.get("dedup_key", None)
+        if dedup_key is not None:
+            return dedup_key
+    return serialization.serialize(item)
+
+
+def add_dedup_keys(items):
+    """Returns the items with a fresh dedup key added to each of them.
+
+    Only needed when items might run more than once. Storage then uses the key
+    so that only the first run of an item gets marked as finished.
+    """
+    keyed_items = []
+    for item in items:
+        if isinstance(item, str):
+            item = serialization.deserialize(item)
+        worker_run_kwargs = dict(item.worker_run_kwargs)
+        worker_run_kwargs.setdefault("dedup_key", uuidlib.uuid4().hex)
+        keyed_items.append(ExecutionItem(worker_run_kwargs=worker_run_kwargs))
+    return keyed_items
+
+
+class SpeculativeItemQueue(object):
+    """Thread-safe queue of execution items that re-dispatches stragglers.
+
+    Items are handed out in order. Once the queue is empty, idle workers can
+    instead get a copy of an item that has been running for more than
+    `straggler_multiple` times the median duration of the completed items. The
+    first copy of an item to complete wins; storage uses the item's dedup key to
+    keep later copies from also counting as finished.
+
+    If `straggler_multiple` is None, items are never re-dispatched.
+    """
+
+    def __init__(
+        self,
+        items,
+        straggler_multiple=None,
+        # We need this many completed items before we trust the median.
+        min_completed_for_estimate=3,
+        # Max number of workers running the same item at the same time.
+        max_copies_per_item=2,
+    ):
+        self.straggler_multiple = straggler_multiple
+        self.min_completed_for_estimate = min_completed_for_estimate
+        self.max_copies_per_item = max_copies_per_item
+
+        self._lock = threading.Lock()
+        self._pending = collections.deque(items)
+        # Item key to list of start times of its running copies.
+        self._in_flight = collections.defaultdict(list)
+        # Item key to item for the running items.
+        self._in_flight_items = {}
+        # Keys of the completed items.
+        self._done = set()
+        self._durations = []
+
+    def qsize(self):
+        with self._lock:
+            return len(self._pending)
+
+    def num_in_flight(self):
+        # Number of distinct items that are currently running.
+        with self._lock:
+            return len(self._in_flight)
+
+    def num_redispatchable(self):
+        # Number of running items that could still get another copy.
+        with self._lock:
+            if self.straggler_multiple is None:
+                return 0
+            return sum(
+                len(start_times) < self.max_copies_per_item
+                for start_times in self._in_flight.values()
+            )
+
+    def put(self, item):
+        with self._lock:
+            self._pending.append(item)
+
+    def get_expected_duration(self):
+        # Returns None if we do not have an estimate yet.
+        with self._lock:
+            return self._get_expected_duration()
+
+    def _get_expected_duration(self):
+        if len(self._durations) < self.min_completed_for_estimate:
+            return None
+        return statistics.median(self._durations)
+
+    def _get_straggler(self):
+        expected_duration = self._get_expected_duration()
+        if self.straggler_multiple is None or expected_duration is None:
+            return None
+        deadline_secs = self.straggler_multiple * expected_duration
+
+        now = time.time()
+        stragglers = [
+            (now - min(start_times), key)
+            for key, start_times in self._in_flight.items()
+            if start_times and len(start_times) < self.max_copies_per_item
+        ]
+        stragglers = [(e, key) for e, key in stragglers if e > deadline_secs]
+        if not stragglers:
+            return None
+        # Re-dispatch the item that is the furthest past its deadline.
+        return self._in_flight_items[max(stragglers, key=lambda x: x[0])[1]]
+
+    def get(self):
+        """Returns the next item to run, or None if there is nothing to run now."""
+        with self._lock:
+            if self._pending:
+                item = self._pending.popleft()
+            else:
+                item = self._get_straggler()
+                if item is None:
+                    return None
+            key = get_item_key(item)
+            self._in_flight[key].append(time.time())
+            self._in_flight_items[key] = item
+            return item
+
+    def _remove_copy(self, key):
+        start_times = self._in_flight.get(key)
+        if not start_times:
+            return None
+        # We do not know which copy this was. Assume it was the oldest.
+        start_time = start_times.pop(0)
+        if not start_times:
+            del self._in_flight[key]
+            del self._in_flight_items[key]
+        return start_time
+
+    def complete(self, item, duration_secs=None):
+        """Returns True if this was the first copy of the item to complete.
+
+        If not provided, the `duration_secs` are estimated from when we handed out
+        the item. Any other running copies of the item stop counting as in flight,
+        so the caller should stop them.
+        """
+        key = get_item_key(item)
+        with self._lock:
+            start_time = self._remove_copy(key)
+            if key in self._done:
+                return False
+            self._done.add(key)
+            self._in_flight.pop(key, None)
+            self._in_flight_items.pop(key, None)
+            if duration_secs is None and start_time is not None:
+                duration_secs = time.time() - start_time
+            if duration_secs is not None:
+                self._durations.append(duration_secs)
+            return True
+
+    def fail(self, item):
+        """Returns True if the item needs to be retried.
+
+        This is the case when the item has not completed and no other copy of it
+        is still running.
+        """
+        key = get_item_key(item)
+        with self._lock:
+            self._remove_copy(key)
+            return key not in self._done and key not in self._in_flight
+
+
+###############################################################################
+
+
+def estimate_makespan(durations, num_workers):
+    """Makespan of running items with these durations in order on the workers.
+
+    Each item goes to the worker that frees up first.
+    """
+    if not durations or num_workers <= 0:
+        return 0.0
+    worker_free_times = [0.0] * num_workers
+    for duration in durations:
+        free_time = heapq.heappop(worker_free_times)
+        heapq.heappush(worker_free_times, free_time + duration)
+    return max(worker_free_times)
+
+
+class SchedulingPolicy(object):
+    """Decides the order that supervisors run items in.
+
+    Also decides how many idle workers to keep alive once there are no more
+    pending items.
+    """
+
+    def order_items(self, items):
+        return list(items)
+
+    def num_idle_workers_to_keep(self, item_queue):
+        # Idle workers are only useful for picking up copies of stragglers, so
+        # there is no point keeping more of them than there are items that could
+        # be re-dispatched.
+        return item_queue.num_redispatchable()
+
+    def log_schedule(self, items, num_workers):
+        pass
+
+
+@data_class.data_class()
+class FifoSchedulingPolicy(SchedulingPolicy):
+    """Runs items in the order that they were given."""
+
+    def __init__(self):
+        pass
+
+
+@data_class.data_class()
+class LongestExpectedFirstPolicy(SchedulingPolicy):
+    """Runs the items expected to take the longest first.
+
+    This keeps a long item from starting near the end of the batch and leaving
+    the other workers idle, which shortens the makespan.
+
+    The expected duration of an item comes from, in order of preference:
+        - An `expected_duration_secs()` method on its run params.
+        - The `duration_estimator`'s `get_expected_duration(item)` method.
+        - The median duration of finished runs of its experiment with the same
+          run key values, if `use_historical_durations` is True.
+        - The median duration of all finished runs of its experiment.
+
+    Items without an expected duration are run first since we cannot rule out
+    that they are the longest.
+
+    NOTE: Items are only inspected if they are ExecutionItems and not serialized
+    strings, so the policy should be applied before serializing them.
+    """
+
+    def __init__(
+        self,
+        # Must be a data class so that the policy can be serialized along with the
+        # rest of the executor params. Functions cannot be serialized.
+        duration_estimator=None,
+        use_historical_durations=True,
+    ):
+        if duration_estimator is not None and not data_class.is_data_instance(
+            duration_estimator
+        ):
+            raise TypeError("The duration_estimator must be a data class instance.")
+        # Volatile state, so it does not get serialized. It only reads storage
+        # once it gets asked for a duration.
+        self._historical_durations = HistoricalDurations()
+
+    def get_expected_duration(self, item):
+        # Returns None if we have no estimate.
+        if not isinstance(item, ExecutionItem):
+            return None
+        run_params = item.worker_run_kwargs.get("run_params", None)
+
+        expected_duration_fn = getattr(run_params, "expected_duration_secs", None)
+        if callable(expected_duration_fn):
+            return expected_duration_fn()
+        elif self.duration_estimator:
+            return self.duration_estimator.get_expected_duration(item)
+        elif self.use_historical_durations:
+            return self._historical_durations.get_expected_duration(item)
+        return None
+
+    def order_items(self, items):
+        items = list(items)
+        durations = [self.get_expected_duration(item) for item in items]
+        # The sort is stable, so ties keep their original order.
+        order = sorted(
+            range(len(items)),
+            key=lambda i: float("inf") if durations[i] is None else durations[i],
+            reverse=True,
+        )
+        return [items[i] for i in order]
+
+    def log_schedule(self, items, num_workers):
+        durations = [self.get_expected_duration(item) for item in items]
+        known_durations = [d for d in durations if d is not None]
+        makespan = estimate_makespan(known_durations, num_workers)
+        logging.info(
+            f"Expected makespan of {len(known_durations)} out of {len(items)} "
+            f"execution items with known durations: {makespan:.1f} secs."
+        )
+
+
+class HistoricalDurations(object):
+    """Estimates item durations from the RunTimings of finished runs.
+
+    Storage is only read once per experiment.
+    """
+
+    def __init__(self):
+        self._experiment_durations = {}
+
+    def _get_run_key_to_durations(self, experiment):
+        if experiment.uuid not in self._experiment_durations:
+            try:
+                with experiment.get_storage():
+                    run_key_to_durations = experiment.get_run_key_to_durations()
+            except Exception as e:
+                logging.warning(
+                    f"Failed to get durations of runs of experiment {experiment.uuid}."
+                )
+                logging.exception(e)
+                run_key_to_durations = {}
+            self._experiment_durations[experiment.uuid] = run_key_to_durations
+        return self._experiment_durations[experiment.uuid]
+
+    def get_expected_duration(self, item):
+        experiment = item.worker_run_kwargs["experiment_cls"]
+        run_params = item.worker_run_kwargs.get("run_params", None)
+
+        run_key_to_durations = self._get_run_key_to_durations(experiment)
+        if not run_key_to_durations:
+            return None
+
+        if run_params is not None:
+            key = experiment.create_run_key_values(run_params)
+            key = serialization.serialize(key)
+            if key in run_key_to_durations:
+                return statistics.median(run_key_to_durations[key])
+
+        all_durations = [d for ds in run_key_to_durations.values() for d in ds]
+        return statistics.median(all_durations)
@@ -202,6 +202,34 @@ def experiment(  # noqa: C901
 
                 return run_key_to_finished_run_uuids
 
+            def get_run_key_to_durations(self, storage_data=None):
+                # Maps serialized run key values to the durations in seconds of the
+                # finished runs with them. Runs without a stored RunTiming, e.g.
+                # ones from older versions of del8, are skipped.
+                if storage_data is None:
+                    storage_data = self.get_storage().retrieve_storage_data(
+                        experiment_uuid=[self.uuid]
+                    )
+
+                run_key_to_durations = collections.defaultdict(list)
+
+                finished_run_ids = storage_data.get_finished_runs_ids(
+                    experiment_uuid=self.uuid
+                )
+                for run_id in finished_run_ids:
+                    merge_run = storage_data.get_run_data(run_id)
+                    timings = merge_run.get_items_by_class(runs.RunTiming)
+                    if not timings:
+                        continue
+                    params = merge_run.get_single_item_by_class(self.params_cls)
+
+                    key = self.create_run_key_values(params)
+                    key = serialization.serialize(key)
+
+                    run_key_to_durations[key].extend(t.duration_secs for t in timings)
+
+                return run_key_to_durations
+
             def get_all_package_kwargs(self, binding_specs):
                 exe_classes = dependencies.get_all_executables_classes_in_graph(
                     self.executable_cls, binding_specs
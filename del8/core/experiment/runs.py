@@ -22,3 +22,11 @@ class RunInstanceConfig(object):
             self.init_kwargs = {}
         if not self.call_kwargs:
             self.call_kwargs = {}
+
+
+@data_class.data_class()
+class RunTiming(object):
+    # Stored at the end of each run so that schedulers can estimate how long
+    # similar runs will take.
+    def __init__(self, duration_secs):
+        pass
@@ -1,6 +1,7 @@
 """TODO: Add title."""
 import abc
 import contextlib
+import mmap
 import os
 import shutil
 import tempfile
@@ -22,6 +23,9 @@ class StorageParams(abc.ABC):
 class RunState(object):
     STARTED = 1
     FINISHED = 2
+    # The run finished, but another run of the same execution item finished before
+    # it. Happens when an item is speculatively executed by more than one worker.
+    DUPLICATE = 3
 
 
 class Storage(abc.ABC):
@@ -123,8 +127,40 @@ class Storage(abc.ABC):
                 file.close()
             shutil.rmtree(temp_dir)
 
+    def get_blob_prefetch_fn(self, blob_uuid):
+        # Hint that the blob will be retrieved soon. Storages with local caches can
+        # override this to return a function that downloads the blob into the
+        # cache. This gets called on the thread using the storage, but the returned
+        # function can be called from a background thread. Returns None if there
+        # is nothing to prefetch.
+        return None
+
+    @contextlib.contextmanager
+    def retrieve_blob_as_readonly_path(self, blob_uuid):
+        # Yields the filepath of a local copy of the blob. The file must NOT be
+        # modified, and it is only guaranteed to exist until the context exits.
+        # Storages with local caches should override this to hand out paths into
+        # the cache directly instead of making a copy, keeping the file from being
+        # evicted within the context.
+        temp_dir = tempfile.mkdtemp()
+        try:
+            yield self.retrieve_blob_as_file(blob_uuid, temp_dir)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @contextlib.contextmanager
+    def retrieve_blob_as_mmap(self, blob_uuid):
+        # Yields a read-only memory map of the blob's contents.
+        with self.retrieve_blob_as_readonly_path(blob_uuid) as filepath:
+            with open(filepath, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    yield mm
+
     @abc.abstractmethod
-    def set_run_state(self, run_state):
+    def set_run_state(self, run_state, dedup_key=None):
+        # If `dedup_key` is provided when setting the state to FINISHED, only the
+        # first run to finish with that key gets marked as FINISHED. Any later ones
+        # get marked as DUPLICATE instead.
         raise NotImplementedError
 
     def initialize(self):
@@ -0,0 +1,145 @@
+"""Content-addressed artifacts that startup scripts fetch instead of inlining.
+
+Inlining a base64 tarball in a startup script makes the script about as large
+as the tarball. Instead, we can upload the tarball once and have the script
+fetch it and verify its sha256 hash. The hash also serves as the artifact's
+name, so uploading the same content twice is a no-op.
+"""
+import datetime
+import hashlib
+import os
+import threading
+import uuid as uuidlib
+
+from absl import logging
+
+from del8.core import data_class
+
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _verify_command(sha256, dst):
+    # Aborts the script if the fetched file does not match. `dst` can contain
+    # shell variables, so it does not get quoted.
+    return f'echo "{sha256}  {dst}" | sha256sum -c - || exit 1'
+
+
+###############################################################################
+
+
+@data_class.data_class()
+class GcsArtifactStoreParams(object):
+    def __init__(
+        self,
+        bucket="del8_artifacts",
+        private_key_filepath="~/del8/gcp/vast/storage-private-key.json",
+        prefix="artifacts",
+        # The script fetches artifacts using signed URLs, so it does not need any
+        # credentials. V4 signed URLs are valid for at most 7 days, so scripts must
+        # run within this long of being created.
+        url_expiration_secs=7 * 24 * 60 * 60,
+    ):
+        pass
+
+    def instantiate_store(self):
+        return GcsArtifactStore(self)
+
+
+@data_class.data_class()
+class LocalArtifactStoreParams(object):
+    # Stand-in for testing where artifacts are files in a local directory. Scripts
+    # will only work on the same machine.
+
+    def __init__(self, directory="~/.del8_artifacts"):
+        pass
+
+    def instantiate_store(self):
+        return LocalArtifactStore(self)
+
+
+###############################################################################
+
+
+class ArtifactStore(object):
+    def put(self, data, suffix=""):
+        """Uploads the bytes if needed and returns the key of the artifact."""
+        raise NotImplementedError
+
+    def fetch_command(self, key, dst):
+        """Bash command that fetches the artifact to the `dst` filepath.
+
+        Does not verify the contents.
+        """
+        raise NotImplementedError
+
+    def put_and_fetch_command(self, data, dst, suffix=""):
+        """Bash command fetching the bytes to `dst` and verifying their hash."""
+        key = self.put(data, suffix=suffix)
+        script = [
+            self.fetch_command(key, dst),
+            _verify_command(sha256_hex(data), dst),
+        ]
+        return "\n".join(script)
+
+
+class GcsArtifactStore(ArtifactStore):
+    def __init__(self, params):
+        self._params = params
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        # NOTE: Imported here so that the local stand-in works without the
+        # cloud dependencies installed.
+        from del8.core.utils import gcp_util
+
+        with self._lock:
+            if self._bucket is None:
+                self._bucket = gcp_util.connect_to_bucket(
+                    self._params.bucket, self._params.private_key_filepath
+                )
+            return self._bucket
+
+    def put(self, data, suffix=""):
+        key = f"{self._params.prefix}/{sha256_hex(data)}{suffix}"
+        blob = self.bucket.blob(key)
+        if blob.exists():
+            logging.info(f"Artifact gs://{self._params.bucket}/{key} already exists.")
+        else:
+            blob.upload_from_string(data)
+            logging.info(f"Uploaded artifact to gs://{self._params.bucket}/{key}.")
+        return key
+
+    def fetch_command(self, key, dst):
+        url = self.bucket.blob(key).generate_signed_url(
+            expiration=datetime.timedelta(seconds=self._params.url_expiration_secs),
+            version="v4",
+            method="GET",
+        )
+        return f"curl -fsSL --retry 5 -o {dst} '{url}'"
+
+
+class LocalArtifactStore(ArtifactStore):
+    def __init__(self, params):
+        self._params = params
+
+    @property
+    def directory(self):
+        return os.path.expanduser(self._params.directory)
+
+    def put(self, data, suffix=""):
+        key = f"{sha256_hex(data)}{suffix}"
+        filepath = os.path.join(self.directory, key)
+        if not os.path.exists(filepath):
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_filepath = f"{filepath}.{uuidlib.uuid4().hex}.tmp"
+            with open(tmp_filepath, "wb") as f:
+                f.write(data)
+            os.replace(tmp_filepath, filepath)
+        return key
+
+    def fetch_command(self, key, dst):
+        return f"cp '{os.path.join(self.directory, key)}' {dst}"
@@ -1,10 +1,188 @@
 """TODO: Add title."""
+import asyncio
+import collections
 import functools
 import random
+import threading
 import time
 from absl import logging
 
 
+class Jitter(object):
+    # Adds uniform noise with a total width of `backoff_noise_ms` to each wait.
+    UNIFORM = "UNIFORM"
+    # Waits a uniformly random time between 0 and the interval.
+    FULL = "FULL"
+    # Waits a random time between the first interval and 3 times the previous
+    # wait, capped at the largest interval.
+    DECORRELATED = "DECORRELATED"
+
+
+###############################################################################
+
+
+class TokenBucket(object):
+    """Rate limiter allowing `rate_per_sec` calls a second with bursts of `capacity`.
+
+    Thread-safe. Callers that have to wait get served in the order they called.
+    """
+
+    def __init__(self, rate_per_sec, capacity=None):
+        self.rate_per_sec = rate_per_sec
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_sec)
+
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._last_refill_time = time.monotonic()
+
+    def _reserve(self):
+        # Takes a token and returns how long we need to wait before using it. The
+        # tokens can go negative, which is how we queue up the waiting callers.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._last_refill_time) * self.rate_per_sec,
+            )
+            self._last_refill_time = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate_per_sec
+
+    def acquire(self):
+        """Blocks until we can make a call. Returns the seconds waited."""
+        wait_secs = self._reserve()
+        if wait_secs > 0:
+            time.sleep(wait_secs)
+        return wait_secs
+
+    async def acquire_async(self):
+        wait_secs = self._reserve()
+        if wait_secs > 0:
+            await asyncio.sleep(wait_secs)
+        return wait_secs
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(endpoint, rate_per_sec, capacity=None):
+    """Returns the TokenBucket shared by everything calling the `endpoint`.
+
+    The rate and capacity are only used the first time that we see the endpoint.
+    """
+    with _rate_limiters_lock:
+        if endpoint not in _rate_limiters:
+            _rate_limiters[endpoint] = TokenBucket(rate_per_sec, capacity=capacity)
+        return _rate_limiters[endpoint]
+
+
+###############################################################################
+
+
+_metrics = collections.defaultdict(
+    lambda: {"calls": 0, "retries": 0, "failures": 0, "secs_waited": 0.0}
+)
+_metrics_lock = threading.Lock()
+
+
+def _record_metrics(name, **increments):
+    with _metrics_lock:
+        metrics = _metrics[name]
+        for key, increment in increments.items():
+            metrics[key] += increment
+
+
+def get_metrics():
+    """Returns a dict of per-function retry metrics.
+
+    For each function, we have the number of calls, the number of retries, the
+    number of calls that failed after giving up, and the total seconds waited
+    between attempts.
+    """
+    with _metrics_lock:
+        return {name: dict(metrics) for name, metrics in _metrics.items()}
+
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+###############################################################################
+
+
+class RetrySchedule(object):
+    """Decides how long to wait before each retry of a single call.
+
+    Useful on its own for callers that schedule their retries instead of
+    sleeping, e.g. on a timer. Use `create_retry_schedule` to make one.
+    """
+
+    def __init__(self, intervals, jitter, backoff_noise_ms, deadline_secs):
+        self._intervals = intervals
+        self._jitter = jitter
+        self._backoff_noise_ms = backoff_noise_ms
+        self._deadline = (
+            time.monotonic() + deadline_secs if deadline_secs is not None else None
+        )
+
+        self._min_interval = min(intervals) if intervals else 0.0
+        self._max_interval = max(intervals) if intervals else 0.0
+        self._prev_wait_secs = self._min_interval
+
+        self.attempts = 0
+        self.total_secs_waited = 0
+
+    def _apply_jitter(self, interval):
+        if self._jitter == Jitter.UNIFORM:
+            noise = (random.random() - 0.5) * self._backoff_noise_ms / 1000
+            return max(interval + noise, 0.0)
+        elif self._jitter == Jitter.FULL:
+            return random.uniform(0, interval)
+        elif self._jitter == Jitter.DECORRELATED:
+            wait_secs = random.uniform(self._min_interval, 3 * self._prev_wait_secs)
+            return min(wait_secs, self._max_interval)
+        else:
+            raise ValueError(f"Unrecognized jitter {self._jitter}.")
+
+    def next_wait_secs(self):
+        """Returns None if we should give up."""
+        self.attempts += 1
+        if not self._intervals:
+            return None
+
+        wait_secs = self._apply_jitter(self._intervals.pop(0))
+        if self._deadline is not None and (
+            time.monotonic() + wait_secs > self._deadline
+        ):
+            return None
+
+        self._prev_wait_secs = wait_secs
+        self.total_secs_waited += wait_secs
+        return wait_secs
+
+
+def create_retry_schedule(
+    linear_backoff_steps=5,
+    linear_interval_secs=5,
+    exp_backoff_steps=4,
+    exp_start_interval_secs=5,
+    exp_backoff_base=2,
+    backoff_noise_ms=50,
+    jitter=Jitter.UNIFORM,
+    deadline_secs=None,
+):
+    """Returns a RetrySchedule with the same intervals as `linear_to_exp_backoff`."""
+    intervals = [linear_interval_secs for i in range(linear_backoff_steps)] + [
+        exp_start_interval_secs * exp_backoff_base ** i
+        for i in range(exp_backoff_steps)
+    ]
+    return RetrySchedule(intervals, jitter, backoff_noise_ms, deadline_secs)
+
+
 def linear_to_exp_backoff(
     exceptions_to_catch=(),
     should_retry_on_exception_fn=lambda e: False,
@@ -17,10 +195,112 @@ def linear_to_exp_backoff(
     exp_start_interval_secs=5,
     exp_backoff_base=2,
     backoff_noise_ms=50,
+    # One of the `Jitter` values.
+    jitter=Jitter.UNIFORM,
+    # If provided, we give up once retrying would take us past this many seconds
+    # since the first attempt.
+    deadline_secs=None,
+    # If provided, a TokenBucket that each attempt acquires a token from. Use
+    # `get_rate_limiter` to share one between all callers of an endpoint.
+    rate_limiter=None,
+    # Name that the metrics get recorded under. Defaults to the function's
+    # qualified name.
+    metrics_name=None,
+    # If True, the decorated function must be a coroutine function. We then await
+    # instead of sleeping between attempts.
+    is_async=False,
 ):
     exceptions_to_catch = tuple(exceptions_to_catch)
 
     def decorator(fn):
+        name = metrics_name or fn.__qualname__
+
+        def create_schedule(
+            no_backoff,
+            linear_backoff_steps,
+            linear_interval_secs,
+            exp_backoff_steps,
+            exp_start_interval_secs,
+            exp_backoff_base,
+            backoff_noise_ms,
+            jitter,
+            deadline_secs,
+        ):
+            if no_backoff:
+                return RetrySchedule([], jitter, backoff_noise_ms, deadline_secs)
+            return create_retry_schedule(
+                linear_backoff_steps=linear_backoff_steps,
+                linear_interval_secs=linear_interval_secs,
+                exp_backoff_steps=exp_backoff_steps,
+                exp_start_interval_secs=exp_start_interval_secs,
+                exp_backoff_base=exp_backoff_base,
+                backoff_noise_ms=backoff_noise_ms,
+                jitter=jitter,
+                deadline_secs=deadline_secs,
+            )
+
+        def handle_exception(e, schedule, no_backoff):
+            # Returns how long to wait before retrying. Raises the exception if we
+            # should not retry.
+            if not should_retry_on_exception_fn(e):
+                _record_metrics(name, failures=1)
+                raise e
+
+            wait_secs = schedule.next_wait_secs()
+            if wait_secs is None:
+                msg = (
+                    f"Unable to call {fn.__name__} with an acceptable outcome. "
+                    f"We had a total of {schedule.attempts} attempts with a "
+                    f"cumulative total of {schedule.total_secs_waited} seconds "
+                    "waited between attempts."
+                )
+                if not no_backoff:
+                    logging.warning(msg)
+                _record_metrics(name, failures=1)
+                raise e
+
+            _record_metrics(name, retries=1, secs_waited=wait_secs)
+            return wait_secs
+
+        if is_async:
+
+            @functools.wraps(fn)
+            async def inner(
+                *args,
+                no_backoff=False,
+                linear_backoff_steps=linear_backoff_steps,
+                linear_interval_secs=linear_interval_secs,
+                exp_backoff_steps=exp_backoff_steps,
+                exp_start_interval_secs=exp_start_interval_secs,
+                exp_backoff_base=exp_backoff_base,
+                backoff_noise_ms=backoff_noise_ms,
+                jitter=jitter,
+                deadline_secs=deadline_secs,
+                **kwargs,
+            ):
+                schedule = create_schedule(
+                    no_backoff,
+                    linear_backoff_steps,
+                    linear_interval_secs,
+                    exp_backoff_steps,
+                    exp_start_interval_secs,
+                    exp_backoff_base,
+                    backoff_noise_ms,
+                    jitter,
+                    deadline_secs,
+                )
+                _record_metrics(name, calls=1)
+                while True:
+                    if rate_limiter:
+                        await rate_limiter.acquire_async()
+                    try:
+                        return await fn(*args, **kwargs)
+                    except exceptions_to_catch as e:
+                        wait_secs = handle_exception(e, schedule, no_backoff)
+                    await asyncio.sleep(wait_secs)
+
+            return inner
+
         @functools.wraps(fn)
         def inner(
             *args,
@@ -35,45 +315,30 @@ def linear_to_exp_backoff(
             exp_start_interval_secs=exp_start_interval_secs,
             exp_backoff_base=exp_backoff_base,
             backoff_noise_ms=backoff_noise_ms,
+            jitter=jitter,
+            deadline_secs=deadline_secs,
             **kwargs,
         ):
-            if no_backoff:
-                intervals = []
-            else:
-                intervals = [
-                    linear_interval_secs for i in range(linear_backoff_steps)
-                ] + [
-                    exp_start_interval_secs * exp_backoff_base ** i
-                    for i in range(exp_backoff_steps)
-                ]
-
-            attempts = 0
-            total_secs_waited = 0
-
+            schedule = create_schedule(
+                no_backoff,
+                linear_backoff_steps,
+                linear_interval_secs,
+                exp_backoff_steps,
+                exp_start_interval_secs,
+                exp_backoff_base,
+                backoff_noise_ms,
+                jitter,
+                deadline_secs,
+            )
+            _record_metrics(name, calls=1)
             while True:
+                if rate_limiter:
+                    rate_limiter.acquire()
                 try:
                     return fn(*args, **kwargs)
-
                 except exceptions_to_catch as e:
-                    if not should_retry_on_exception_fn(e):
-                        raise e
-
-                    attempts += 1
-                    if not intervals:
-                        msg = (
-                            f"Unable to call {fn.__name__} with an acceptable outcome. "
-                            f"We had a total of {attempts} attempts with a cumulative "
-                            f"total of {total_secs_waited} seconds waited between attempts."
-                        )
-                        if not no_backoff:
-                            logging.warning(msg)
-                        raise e
-
-                    interval = intervals.pop(0)
-                    total_secs_waited += interval
-
-                    noise = (random.random() - 0.5) * backoff_noise_ms / 1000
-                    time.sleep(interval + noise)
+                    wait_secs = handle_exception(e, schedule, no_backoff)
+                time.sleep(wait_secs)
 
             raise Exception("If we get here, then there is a bug in the code.")
 
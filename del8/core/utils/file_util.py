@@ -1,8 +1,100 @@
 """TODO: Add title."""
+import contextlib
+import fcntl
+import hashlib
+import os
 import pathlib
+import shutil
+
+
+# 8 MB
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# From linux/fs.h. Used to create copy-on-write clones of files.
+_FICLONE = 0x40049409
 
 
 def get_file_suffix(file):
     # Pretty much get the file extension, starting with a dot.
     # Returns empty string if there is no file extension.
     return "".join(pathlib.Path(file).suffixes)
+
+
+def new_hasher(algorithm="blake2b"):
+    if algorithm == "blake2b":
+        # NOTE: A 32 byte digest gives us a 64 character hex string, which
+        # is plenty to avoid collisions while keeping object names short.
+        return hashlib.blake2b(digest_size=32)
+    return hashlib.new(algorithm)
+
+
+def hash_bytes(data, algorithm="blake2b"):
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def hash_stream(f, algorithm="blake2b", chunk_size=DEFAULT_CHUNK_SIZE):
+    # Returns the hex digest of everything left to read in the binary stream.
+    # Reads it in chunks so that we never copy all of it at once.
+    hasher = new_hasher(algorithm)
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hash_file(filepath, algorithm="blake2b", chunk_size=DEFAULT_CHUNK_SIZE):
+    # Returns the hex digest of the file's contents. Reads the file in chunks
+    # so that we never have the entire file in memory.
+    with open(filepath, "rb") as f:
+        return hash_stream(f, algorithm=algorithm, chunk_size=chunk_size)
+
+
+@contextlib.contextmanager
+def file_lock(filepath):
+    # Exclusive lock on the file at `filepath`, which is created if needed.
+    #
+    # NOTE: The flock is associated with the open file description, so this
+    # works between threads of the same process as well as between processes.
+    with open(filepath, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _reflink(src, dst):
+    # Only supported on some filesystems (btrfs, xfs with reflink=1, ...). Raises
+    # an OSError otherwise.
+    with open(src, "rb") as src_f, open(dst, "wb") as dst_f:
+        fcntl.ioctl(dst_f.fileno(), _FICLONE, src_f.fileno())
+
+
+def link_or_copy(src, dst, allow_hardlink=False):
+    # Makes the file at src available at dst while trying to avoid copying its
+    # contents. We try, in order:
+    #   - A hardlink. Only if `allow_hardlink`, since writing to dst will then
+    #     also modify src. Requires src and dst to be on the same filesystem.
+    #   - A copy-on-write clone (reflink). Safe to modify but only supported by
+    #     some filesystems.
+    #   - A regular copy.
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if allow_hardlink:
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+
+    try:
+        _reflink(src, dst)
+        return dst
+    except OSError:
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+    shutil.copyfile(src, dst)
+    return dst
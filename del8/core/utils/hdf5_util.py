@@ -1,4 +1,14 @@
 """TODO: Add title."""
+import collections.abc
+from concurrent import futures
+import functools
+import io
+import os
+import re
+import tempfile
+import uuid as uuidlib
+import zlib
+
 import h5py
 
 import numpy as np
@@ -6,47 +16,417 @@ import tensorflow as tf
 
 _LIST_GROUP_NAME = "__list__"
 
+FLOAT16 = "float16"
+BFLOAT16 = "bfloat16"
+
+# Kinds of numpy dtypes whose raw bytes we can interpret ourselves.
+_RAW_DTYPE_KINDS = frozenset("biuf")
+
+# Bit in a chunk's filter mask that is set when its first filter was skipped.
+_FIRST_FILTER_SKIPPED = 1
+
+
+###############################################################################
+
+
+def create_hdf5_image(write_fn):
+    # Builds an hdf5 file entirely in memory using the "core" driver and returns
+    # its contents as bytes. The `write_fn` gets called with the open h5py.File.
+    #
+    # NOTE: HDF5 needs random access while writing, so we cannot stream the file
+    # out as it is being written. The image is only complete once `write_fn`
+    # returns, and its size is roughly that of the serialized data.
+    #
+    # The file name is only used as an identifier; nothing gets written to disk.
+    name = f"{uuidlib.uuid4().hex}.h5"
+    with h5py.File(name, "w", driver="core", backing_store=False) as f:
+        write_fn(f)
+        f.flush()
+        return f.id.get_file_image()
+
+
+def create_hdf5_buffer(write_fn):
+    # Like `create_hdf5_image`, but returns an io.BytesIO holding the file that
+    # is positioned at its start.
+    #
+    # h5py writes straight into the buffer, so there is only ever one copy of
+    # the file in memory. Getting the image out of the "core" driver copies it.
+    buf = io.BytesIO()
+    with h5py.File(buf, "w") as f:
+        write_fn(f)
+    buf.seek(0)
+    return buf
+
+
+def _maybe_register_filter_plugins():
+    # The hdf5plugin package registers extra compression filters (like lz4) with
+    # HDF5 when imported. We need it to read datasets that use them.
+    try:
+        import hdf5plugin  # noqa: F401
+    except ImportError:
+        pass
+
+
+def _get_compression_kwargs(compression, compression_level):
+    if compression is None:
+        return {}
+    elif compression == "gzip":
+        return {"compression": "gzip", "compression_opts": compression_level}
+    elif compression == "lz4":
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("Using lz4 compression requires the hdf5plugin package.")
+        return dict(hdf5plugin.LZ4())
+    else:
+        # Let h5py handle other built-in filters, e.g. "lzf".
+        return {"compression": compression}
+
+
+def _get_chunks_kwargs(chunks, shape):
+    # A chunk shape only applies to datasets of the same rank. Other datasets get
+    # h5py's guess for a chunk shape if we are compressing and no chunks otherwise.
+    if chunks is True:
+        return {"chunks": True}
+    elif chunks and len(chunks) == len(shape):
+        return {"chunks": tuple(min(c, d) for c, d in zip(chunks, shape))}
+    return {}
+
+
+def _to_bfloat16_bits(val):
+    # Numpy has no bfloat16, so we store the upper 16 bits of the float32 values
+    # as uint16s. Rounds to nearest even.
+    bits = np.asarray(val, dtype=np.float32).view(np.uint32)
+    rounding_bias = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+    return ((bits + rounding_bias) >> 16).astype(np.uint16)
+
+
+def _from_bfloat16_bits(bits):
+    return (np.asarray(bits).astype(np.uint32) << 16).view(np.float32)
+
+
+def _downcast(val, save_dtype):
+    # Returns the value to store. Only floating point values get downcast.
+    if save_dtype is None or not np.issubdtype(val.dtype, np.floating):
+        return val, None
+    elif save_dtype == FLOAT16:
+        return val.astype(np.float16), FLOAT16
+    elif save_dtype == BFLOAT16:
+        return _to_bfloat16_bits(val), BFLOAT16
+    else:
+        raise ValueError(f"Unsupported save_dtype {save_dtype}.")
+
+
+def _restore_dtype(val, attrs):
+    # Undoes the `_downcast` using the attributes stored on the dataset.
+    if "stored_dtype" not in attrs:
+        return val
+    if attrs["stored_dtype"] == BFLOAT16:
+        val = _from_bfloat16_bits(val)
+    return np.asarray(val).astype(attrs["dtype"])
+
+
+###############################################################################
 
-def save_variables_to_hdf5(variables, filepath):
+
+def _write_variables(
+    f,
+    variables,
+    compression=None,
+    compression_level=None,
+    chunks=None,
+    save_dtype=None,
+):
+    compression_kwargs = _get_compression_kwargs(compression, compression_level)
+
+    ls = f.create_group(_LIST_GROUP_NAME)
+    ls.attrs["length"] = len(variables)
+    for i, v in enumerate(variables):
+        val = v.numpy()
+        stored_val, stored_dtype = _downcast(val, save_dtype)
+
+        kwargs = {}
+        if val.shape:
+            # NOTE: Scalars cannot be chunked or compressed.
+            kwargs.update(compression_kwargs)
+            kwargs.update(_get_chunks_kwargs(chunks, val.shape))
+
+        ds = ls.create_dataset(
+            str(i), stored_val.shape, dtype=stored_val.dtype, **kwargs
+        )
+        # NOTE: Code modified from a section of tf source code here.
+        if not val.shape:
+            # scalar
+            ds[()] = stored_val
+        else:
+            ds[:] = stored_val
+        name = v.name
+        if name.endswith(":0"):
+            name = name[: -len(":0")]
+        ds.attrs["name"] = name
+        ds.attrs["trainable"] = v.trainable
+        if stored_dtype:
+            ds.attrs["stored_dtype"] = stored_dtype
+            ds.attrs["dtype"] = val.dtype.name
+
+
+def save_variables_to_hdf5(variables, filepath, **kwargs):
+    # The kwargs can be:
+    #   compression: None, "gzip", "lz4" (needs hdf5plugin) or another h5py filter.
+    #   compression_level: Passed to the gzip filter.
+    #   chunks: True to chunk every dataset, or a chunk shape to use for datasets of
+    #       the same rank. Defaults to h5py's guess when compressing.
+    #   save_dtype: None, "float16" or "bfloat16". Floating point variables are
+    #       downcast before saving. They are restored to their original dtype
+    #       when loading.
     with h5py.File(filepath, "w") as f:
-        ls = f.create_group(_LIST_GROUP_NAME)
-        ls.attrs["length"] = len(variables)
-        for i, v in enumerate(variables):
-            val = v.numpy()
-            ds = ls.create_dataset(str(i), val.shape, dtype=val.dtype)
-            # NOTE: Code modified from a section of tf source code here.
-            if not val.shape:
-                # scalar
-                ds[()] = val
+        _write_variables(f, variables, **kwargs)
+
+
+def variables_to_hdf5_image(variables, **kwargs):
+    # See `save_variables_to_hdf5` for the kwargs.
+    return create_hdf5_image(lambda f: _write_variables(f, variables, **kwargs))
+
+
+def _get_save_weights_to_hdf5_group_fn():
+    # Returns None if this version of tf does not have the function where we
+    # expect it.
+    #
+    # NOTE: This is a private part of the tf API, which is what Keras calls
+    # internally when saving weights in the h5 format.
+    try:
+        from tensorflow.python.keras.saving import hdf5_format
+    except ImportError:
+        return None
+    return getattr(hdf5_format, "save_weights_to_hdf5_group", None)
+
+
+def model_weights_to_hdf5_buffer(model):
+    # Returns an io.BytesIO holding the same file as `model.save_weights(filepath)`
+    # with an h5 filepath.
+    save_fn = _get_save_weights_to_hdf5_group_fn()
+    if save_fn:
+        return create_hdf5_buffer(lambda f: save_fn(f, model.layers))
+
+    # Fall back to the public API, which has to go through a file on disk.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = os.path.join(tmp_dir, "model.weights.h5")
+        model.save_weights(filepath)
+        with open(filepath, "rb") as f:
+            # NOTE: A BytesIO shares the bytes it is created with until written to.
+            return io.BytesIO(f.read())
+
+
+###############################################################################
+
+# NOTE: h5py serializes every call into the HDF5 library behind a global lock,
+# so reading datasets through h5py from several threads does not speed anything
+# up. Instead, we use h5py only to find where each dataset's bytes live in the
+# file. We then read (and decompress) them ourselves, which releases the GIL.
+
+
+def _get_contiguous_offset(ds):
+    # Returns the offset within the file of an uncompressed, contiguous dataset.
+    # Returns None if the dataset is not stored like that.
+    if ds.chunks is not None or ds.compression is not None or ds.external:
+        return None
+    elif not ds.shape or ds.dtype.kind not in _RAW_DTYPE_KINDS:
+        return None
+    return ds.id.get_offset()
+
+
+def _get_gzip_chunk_infos(ds):
+    # Returns info on where each chunk of a gzip-compressed dataset lives.
+    # Returns None if the dataset is not stored like that.
+    if ds.chunks is None or ds.compression != "gzip":
+        return None
+    elif ds.shuffle or ds.fletcher32 or ds.scaleoffset is not None:
+        return None
+    elif ds.dtype.kind not in _RAW_DTYPE_KINDS:
+        return None
+    elif not hasattr(ds.id, "get_chunk_info"):
+        # Requires h5py>=3 built against HDF5>=1.10.5.
+        return None
+    return [ds.id.get_chunk_info(i) for i in range(ds.id.get_num_chunks())]
+
+
+def _read_contiguous(fd, offset, shape, dtype):
+    out = np.empty(shape, dtype=dtype)
+    buffer = memoryview(out.reshape(-1).view(np.uint8))
+    position = 0
+    while position < len(buffer):
+        num_read = os.preadv(fd, [buffer[position:]], offset + position)
+        if not num_read:
+            raise IOError("Unexpected end of file when reading hdf5 dataset.")
+        position += num_read
+    return out
+
+
+def _read_gzip_chunks(fd, chunk_infos, chunk_shape, shape, dtype, fillvalue):
+    out = np.full(shape, fillvalue, dtype=dtype)
+    for info in chunk_infos:
+        raw = os.pread(fd, info.size, info.byte_offset)
+        if not info.filter_mask & _FIRST_FILTER_SKIPPED:
+            raw = zlib.decompress(raw)
+        chunk = np.frombuffer(raw, dtype=dtype).reshape(chunk_shape)
+        # Chunks at the edges can extend past the end of the dataset.
+        region = tuple(
+            slice(start, min(start + size, dim))
+            for start, size, dim in zip(info.chunk_offset, chunk_shape, shape)
+        )
+        out[region] = chunk[tuple(slice(0, r.stop - r.start) for r in region)]
+    return out
+
+
+def _read_datasets(filepath, datasets, num_threads=None, lazy=False):
+    # Returns the values of the datasets, which must be open datasets of the
+    # file at `filepath`, as numpy arrays in the same order.
+    #
+    # If `lazy`, we return read-only memory-mapped arrays for contiguous,
+    # uncompressed datasets. Otherwise datasets are read in parallel using up to
+    # `num_threads` threads.
+    values = [None] * len(datasets)
+    tasks = []
+    for i, ds in enumerate(datasets):
+        offset = _get_contiguous_offset(ds)
+        if offset is not None:
+            if lazy:
+                values[i] = np.memmap(
+                    filepath, mode="r", dtype=ds.dtype, shape=ds.shape, offset=offset
+                )
             else:
-                ds[:] = val
-            name = v.name
-            if name.endswith(":0"):
-                name = name[: -len(":0")]
-            ds.attrs["name"] = name
-            ds.attrs["trainable"] = v.trainable
+                read_fn = functools.partial(
+                    _read_contiguous, offset=offset, shape=ds.shape, dtype=ds.dtype
+                )
+                tasks.append((i, read_fn))
+            continue
+
+        chunk_infos = _get_gzip_chunk_infos(ds)
+        if chunk_infos is not None:
+            read_fn = functools.partial(
+                _read_gzip_chunks,
+                chunk_infos=chunk_infos,
+                chunk_shape=ds.chunks,
+                shape=ds.shape,
+                dtype=ds.dtype,
+                fillvalue=ds.fillvalue,
+            )
+            tasks.append((i, read_fn))
+            continue
+
+        # Fall back to reading through h5py.
+        _maybe_register_filter_plugins()
+        values[i] = ds[()]
+
+    if not tasks:
+        return values
+
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        if num_threads and num_threads > 1 and len(tasks) > 1:
+            with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+                results = list(executor.map(lambda t: t[1](fd), tasks))
+        else:
+            results = [read_fn(fd) for _, read_fn in tasks]
+    finally:
+        os.close(fd)
+
+    for (i, _), result in zip(tasks, results):
+        values[i] = result
+    return values
 
 
-def load_variables_from_hdf5(filepath, trainable=None):
+def _get_list_group(f):
+    if _LIST_GROUP_NAME not in f or len(f.keys()) > 1:
+        # TODO: Support other nested structures for both writing and reading.
+        raise ValueError(
+            "Restoring variables from a hdf5 requires the hdf5 only to contain a list."
+        )
+    return f[_LIST_GROUP_NAME]
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_name_index(filepath, mtime_ns, size):
+    # Returns a tuple of (variable name, dataset key) pairs in list order. The
+    # modification time and size are only there to invalidate the cache when the
+    # file changes.
+    del mtime_ns, size
     with h5py.File(filepath, "r") as f:
-        if _LIST_GROUP_NAME not in f or len(f.keys()) > 1:
-            # TODO: Support other nested structures for both writing and reading.
-            raise ValueError(
-                "Restoring variables from a hdf5 requires the hdf5 only to contain a list."
-            )
-        ls = f[_LIST_GROUP_NAME]
+        ls = _get_list_group(f)
+        return tuple(
+            (ls[str(i)].attrs["name"], str(i)) for i in range(ls.attrs["length"])
+        )
+
+
+def get_variable_names_index(filepath):
+    # Returns a dict from variable name to the key of its dataset within the list
+    # group. The index is only built once per file.
+    filepath = os.path.realpath(filepath)
+    stat = os.stat(filepath)
+    index = {}
+    for name, key in _get_name_index(filepath, stat.st_mtime_ns, stat.st_size):
+        if name in index:
+            raise ValueError(f"Found multiple variables named {name} in {filepath}.")
+        index[name] = key
+    return index
+
+
+def _filter_names(all_names, names=None, pattern=None):
+    # Keeps the names that are in `names` or match the regex `pattern`. Keeps
+    # everything if both are None. Order is preserved.
+    if names is None and pattern is None:
+        return list(all_names)
+    names = set(names or ())
+    regex = re.compile(pattern) if pattern is not None else None
+    return [n for n in all_names if n in names or (regex and regex.search(n))]
+
+
+def _get_filtered_datasets(f, filepath, names=None, pattern=None):
+    ls = _get_list_group(f)
+    if names is None and pattern is None:
+        return [ls[str(i)] for i in range(ls.attrs["length"])]
+    index = get_variable_names_index(filepath)
+    return [ls[index[n]] for n in _filter_names(index.keys(), names, pattern)]
+
+
+def load_variable_values_from_hdf5(
+    filepath, num_threads=None, lazy=False, names=None, pattern=None
+):
+    # Returns a list of numpy arrays holding the values of the variables saved
+    # by `save_variables_to_hdf5`. See `_read_datasets` for the kwargs. Only
+    # variables with a name in `names` or matching the regex `pattern` are
+    # loaded if either is provided.
+    #
+    # NOTE: The lazy memory-mapped arrays are only valid while the file exists.
+    with h5py.File(filepath, "r") as f:
+        datasets = _get_filtered_datasets(f, filepath, names=names, pattern=pattern)
+        values = _read_datasets(
+            filepath, datasets, num_threads=num_threads, lazy=lazy
+        )
+        return [_restore_dtype(v, ds.attrs) for v, ds in zip(values, datasets)]
+
+
+def load_variables_from_hdf5(
+    filepath, trainable=None, num_threads=None, names=None, pattern=None
+):
+    with h5py.File(filepath, "r") as f:
+        datasets = _get_filtered_datasets(f, filepath, names=names, pattern=pattern)
+        values = _read_datasets(filepath, datasets, num_threads=num_threads)
 
         variables = []
-        for i in range(ls.attrs["length"]):
-            ds = ls[str(i)]
+        for ds, value in zip(datasets, values):
             tr = trainable
             if trainable is None:
                 tr = ds.attrs["trainable"]
-            var = tf.Variable(ds, name=ds.attrs["name"], trainable=tr)
+            value = _restore_dtype(value, ds.attrs)
+            var = tf.Variable(value, name=ds.attrs["name"], trainable=tr)
             variables.append(var)
         return variables
 
 
+###############################################################################
+
+
 def save_np_dict_to_hdf5(np_dict, filepath):
     with h5py.File(filepath, "w") as f:
         for key, val in np_dict.items():
@@ -61,9 +441,79 @@ def save_np_dict_to_hdf5(np_dict, filepath):
                 ds[:] = val
 
 
-def load_np_dict_from_hdf5(filepath):
+def load_np_dict_from_hdf5(filepath, keys=None, pattern=None):
+    # Only keys in `keys` or matching the regex `pattern` are loaded if either
+    # is provided.
     ret = {}
     with h5py.File(filepath, "r") as f:
-        for key in f.keys():
+        for key in _filter_names(f.keys(), keys, pattern):
             ret[key] = np.array(f[key])
     return ret
+
+
+###############################################################################
+
+
+class LazyHdf5Mapping(collections.abc.Mapping):
+    """Read-only mapping that only reads a dataset when it gets accessed.
+
+    Keeps the file open, so use it as a context manager or call `close`.
+    Values are not cached; every access reads from the file.
+    """
+
+    def __init__(self, filepath, key_to_dataset_path):
+        self._filepath = filepath
+        self._key_to_dataset_path = key_to_dataset_path
+        self._file = h5py.File(filepath, "r")
+
+    def __getitem__(self, key):
+        ds = self.get_dataset(key)
+        (value,) = _read_datasets(self._filepath, [ds])
+        return _restore_dtype(value, ds.attrs)
+
+    def __iter__(self):
+        return iter(self._key_to_dataset_path)
+
+    def __len__(self):
+        return len(self._key_to_dataset_path)
+
+    def get_dataset(self, key):
+        return self._file[self._key_to_dataset_path[key]]
+
+    def read_slice(self, key, slices):
+        # Only reads the selected part of the dataset from the file. For example,
+        # `mapping.read_slice(name, np.s_[:, :10])`.
+        ds = self.get_dataset(key)
+        _maybe_register_filter_plugins()
+        return _restore_dtype(ds[slices], ds.attrs)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def lazy_load_variables_from_hdf5(filepath, names=None, pattern=None):
+    # Returns a LazyHdf5Mapping from variable name to value for a file saved by
+    # `save_variables_to_hdf5`.
+    index = get_variable_names_index(filepath)
+    return LazyHdf5Mapping(
+        filepath,
+        {
+            n: f"{_LIST_GROUP_NAME}/{index[n]}"
+            for n in _filter_names(index.keys(), names, pattern)
+        },
+    )
+
+
+def lazy_load_np_dict_from_hdf5(filepath, keys=None, pattern=None):
+    # Returns a LazyHdf5Mapping for a file saved by `save_np_dict_to_hdf5`.
+    with h5py.File(filepath, "r") as f:
+        all_keys = list(f.keys())
+    return LazyHdf5Mapping(
+        filepath, {k: k for k in _filter_names(all_keys, keys, pattern)}
+    )
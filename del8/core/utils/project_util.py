@@ -1,15 +1,21 @@
 """TODO: Add title."""
 import base64
+import gzip
+import io
+import json
 import os
 import re
 import tarfile
 import tempfile
+import threading
+import uuid as uuidlib
 
 from typing import Sequence
 
 from absl import logging
 
 from del8.core import data_class
+from del8.core.utils import file_util
 
 
 @data_class.data_class()
@@ -39,14 +45,16 @@ def python_project_to_pythonpath_command(project_params):
     return f"export PYTHONPATH=$PYTHONPATH:~/{source_name}"
 
 
-def python_project_to_bash_command(project_params):
+def python_project_to_bash_command(project_params, artifact_store=None):
     # NOTE: This assumes that we have a top-level python project and wish
     # to add it to the path.
     source_dir = project_params.folder_path
     excludes = project_params.get_excludes()
 
     script = [
-        folder_to_bash_command(source_dir, excludes=excludes),
+        folder_to_bash_command(
+            source_dir, excludes=excludes, artifact_store=artifact_store
+        ),
         python_project_to_pythonpath_command(project_params),
     ]
 
@@ -74,14 +82,56 @@ def file_to_bash_command(filepath, dst_directory="./"):
     return "\n".join(script)
 
 
-def folder_to_bash_command(folder, excludes=[], unzip_directory="./"):
+# Base64 encoded tarballs of folders get cached here, keyed by a hash of the
+# folder's manifest. When the folder changes, its tarball gets rebuilt from the
+# cached members of the entries that did not change, so only the changed files
+# are read and compressed again.
+ARCHIVE_CACHE_DIR = "~/.del8_archive_cache"
+
+# In-memory cache from manifest hash to base64 encoded tarball.
+_archive_cache = {}
+_archive_cache_lock = threading.Lock()
+
+
+def _is_excluded(name, excludes):
+    return any(re.match(pattern, name) for pattern in excludes)
+
+
+def _get_folder_manifest(source_dir, excludes):
+    # Returns a list of (name, size, mtime, mode) for everything that would go into
+    # the tarball of the folder, where the names are the ones used in the tarball.
+    # Any change to a file will almost surely change its size or mtime.
+    source_name = os.path.basename(source_dir)
+    manifest = []
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        rel_dirpath = os.path.relpath(dirpath, source_dir)
+        arc_dirpath = os.path.normpath(os.path.join(source_name, rel_dirpath))
+
+        # Prune excluded directories so that we do not walk into them.
+        dirnames[:] = sorted(
+            d
+            for d in dirnames
+            if not _is_excluded(os.path.join(arc_dirpath, d), excludes)
+        )
+        # NOTE: A directory's mtime changes whenever something gets added to or
+        # removed from it, which the entries of its files already capture.
+        manifest.append((arc_dirpath, 0, 0, os.lstat(dirpath).st_mode))
+
+        for filename in sorted(filenames):
+            arcname = os.path.join(arc_dirpath, filename)
+            if _is_excluded(arcname, excludes):
+                continue
+            stat = os.lstat(os.path.join(dirpath, filename))
+            manifest.append((arcname, stat.st_size, stat.st_mtime_ns, stat.st_mode))
+    return manifest
+
+
+def _create_folder_tar_base64(source_dir, excludes):
     def filter_fn(tarinfo):
-        for pattern in excludes:
-            if re.match(pattern, tarinfo.name):
-                return None
+        if _is_excluded(tarinfo.name, excludes):
+            return None
         return tarinfo
 
-    source_dir = os.path.expanduser(folder)
     source_name = os.path.basename(source_dir)
 
     with tempfile.NamedTemporaryFile() as tmp:
@@ -89,18 +139,162 @@ def folder_to_bash_command(folder, excludes=[], unzip_directory="./"):
             tar.add(source_dir, arcname=source_name, filter=filter_fn)
         with open(tmp.name, "rb") as f:
             content = f.read()
-    folder_tar = base64.b64encode(content).decode("utf-8")
+    return base64.b64encode(content).decode("utf-8")
+
+
+def _create_tar_member_gz(source_dir, arcname):
+    # Returns the gzipped tar blocks of a single entry of the folder's tarball.
+    #
+    # NOTE: Concatenated gzip streams decompress to the concatenation of their
+    # contents, and a tarball is just its members' blocks one after another. Thus
+    # we can build the folder's tarball out of separately compressed members.
+    source_name = os.path.basename(source_dir)
+    filepath = os.path.join(source_dir, os.path.relpath(arcname, source_name))
+
+    with tarfile.open(fileobj=io.BytesIO(), mode="w") as tar:
+        tarinfo = tar.gettarinfo(filepath, arcname=arcname)
+
+    data = b""
+    if tarinfo.isreg():
+        with open(filepath, "rb") as f:
+            data = f.read()
+        # The file might have changed since we looked at it.
+        tarinfo.size = len(data)
+    header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape")
+    padding = b"\0" * (-len(data) % tarfile.BLOCKSIZE)
+    return gzip.compress(header + data + padding, mtime=0)
+
+
+def _create_folder_tar_base64_from_members(source_dir, manifest, members_dir):
+    # Like `_create_folder_tar_base64`, but reuses the members cached in
+    # `members_dir` for the entries of the manifest that have not changed. The
+    # members of entries no longer in the manifest get removed.
+    os.makedirs(members_dir, mode=0o700, exist_ok=True)
+
+    chunks = []
+    member_filenames = set()
+    num_created = 0
+    for entry in manifest:
+        member_filename = file_util.hash_bytes(json.dumps(entry).encode("utf-8"))
+        member_filename = f"{member_filename}.gz"
+        member_filenames.add(member_filename)
+
+        member_filepath = os.path.join(members_dir, member_filename)
+        if os.path.exists(member_filepath):
+            with open(member_filepath, "rb") as f:
+                chunks.append(f.read())
+        else:
+            member = _create_tar_member_gz(source_dir, entry[0])
+            _write_private_file(member_filepath, member)
+            chunks.append(member)
+            num_created += 1
+
+    # A tarball ends with two empty blocks.
+    chunks.append(gzip.compress(b"\0" * (2 * tarfile.BLOCKSIZE), mtime=0))
+
+    for filename in os.listdir(members_dir):
+        if filename not in member_filenames:
+            os.remove(os.path.join(members_dir, filename))
+
+    logging.info(
+        f"Rebuilt the tarball of {source_dir} with {num_created} changed entries "
+        f"out of {len(manifest)}."
+    )
+    return base64.b64encode(b"".join(chunks)).decode("utf-8")
+
+
+def _write_private_file(filepath, data):
+    # Atomically writes the bytes to a file that only our user can access.
+    tmp_filepath = f"{filepath}.{uuidlib.uuid4().hex}.tmp"
+    fd = os.open(tmp_filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_filepath, filepath)
+
+
+def get_folder_tar_base64(folder, excludes=(), use_cache=True):
+    source_dir = os.path.expanduser(folder)
+    if not use_cache:
+        return _create_folder_tar_base64(source_dir, excludes)
+
+    manifest = _get_folder_manifest(source_dir, excludes)
+    manifest_hash = file_util.hash_bytes(json.dumps(manifest).encode("utf-8"))
+
+    with _archive_cache_lock:
+        if manifest_hash in _archive_cache:
+            return _archive_cache[manifest_hash]
+
+        # Cache files are named by the folder's path followed by the manifest hash,
+        # so we can remove the stale archives of a folder when it changes. The
+        # folder's members live in a directory named by the folder's path.
+        cache_dir = os.path.expanduser(ARCHIVE_CACHE_DIR)
+        folder_hash = file_util.hash_bytes(source_dir.encode("utf-8"))[:16]
+        cache_filepath = os.path.join(
+            cache_dir, f"{folder_hash}-{manifest_hash}.tar.gz.b64"
+        )
+        members_dir = os.path.join(cache_dir, folder_hash)
+
+        # NOTE: The folders can hold secrets, e.g. the GCP credentials, so only
+        # our user can access the cache. We also tighten the permissions of a
+        # cache directory created before we did this.
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        os.chmod(cache_dir, 0o700)
+
+        if os.path.exists(cache_filepath):
+            with open(cache_filepath, "r") as f:
+                folder_tar = f.read()
+        else:
+            folder_tar = _create_folder_tar_base64_from_members(
+                source_dir, manifest, members_dir
+            )
+
+            for filename in os.listdir(cache_dir):
+                if filename.startswith(f"{folder_hash}-"):
+                    os.remove(os.path.join(cache_dir, filename))
+
+            _write_private_file(cache_filepath, folder_tar.encode("utf-8"))
+
+        _archive_cache[manifest_hash] = folder_tar
+
+    return folder_tar
+
+
+def folder_to_bash_command(
+    folder,
+    excludes=[],
+    unzip_directory="./",
+    use_cache=True,
+    # If provided, the tarball gets uploaded to the store and the script fetches it
+    # from there instead of having it inlined. See `artifact_util`.
+    artifact_store=None,
+):
+    # If `use_cache`, we only tar and compress the files that changed since the
+    # last time. See `get_folder_tar_base64`.
+    folder_tar = get_folder_tar_base64(folder, excludes=excludes, use_cache=use_cache)
 
     logging.info(f"{folder} base64 has been created.")
 
-    script = [
-        f"FOLDER_TAR='{folder_tar}'",
-        "TMP_TAR_FILE=$(mktemp)",
-        "echo $FOLDER_TAR | base64 -d > $TMP_TAR_FILE",
-        f"mkdir -p {unzip_directory}",
-        f"tar -xvzf $TMP_TAR_FILE -C {unzip_directory}",
-        "rm $TMP_TAR_FILE",
-    ]
+    if artifact_store:
+        script = [
+            "TMP_TAR_FILE=$(mktemp)",
+            artifact_store.put_and_fetch_command(
+                base64.b64decode(folder_tar), "$TMP_TAR_FILE", suffix=".tar.gz"
+            ),
+        ]
+    else:
+        script = [
+            f"FOLDER_TAR='{folder_tar}'",
+            "TMP_TAR_FILE=$(mktemp)",
+            "echo $FOLDER_TAR | base64 -d > $TMP_TAR_FILE",
+        ]
+
+    script.extend(
+        [
+            f"mkdir -p {unzip_directory}",
+            f"tar -xvzf $TMP_TAR_FILE -C {unzip_directory}",
+            "rm $TMP_TAR_FILE",
+        ]
+    )
 
     return "\n".join(script)
 
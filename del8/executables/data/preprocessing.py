@@ -1,7 +1,27 @@
 """TODO: Add title."""
+import time
+
+from absl import logging
+
+import tensorflow as tf
+
 from del8.core.di import executable
 
 
+def _maybe_autotune(value):
+    return tf.data.experimental.AUTOTUNE if value is None else value
+
+
+def _with_deterministic(ds, deterministic):
+    # When `deterministic` is False, tf.data is allowed to produce elements out of
+    # order if that lets it keep the pipeline busy. None keeps the default.
+    if deterministic is None:
+        return ds
+    options = tf.data.Options()
+    options.experimental_deterministic = deterministic
+    return ds.with_options(options)
+
+
 @executable.executable()
 def common_prebatch_processer(
     dataset,
@@ -10,19 +30,246 @@ def common_prebatch_processer(
     shuffle=False,
     repeat=False,
     shuffle_buffer_size=1000,
+    # If True, shuffling happens before repeating. This keeps the examples of
+    # different epochs separate.
+    shuffle_before_repeat=False,
+    shuffle_seed=None,
+    # Applied to each example with `num_parallel_calls` before any caching.
+    prebatch_map_fn=None,
+    # Applied with `dataset.interleave` before anything else, e.g. to read from
+    # several files at once.
+    interleave_fn=None,
+    interleave_cycle_length=None,
+    # None means autotune.
+    num_parallel_calls=None,
+    # If provided, the dataset is cached to this file instead of to memory. Only used
+    # if `num_examples` is provided or `cache_all` is True.
+    cache_filename=None,
+    # If True, the dataset is cached even if `num_examples` is not provided.
+    cache_all=False,
+    # None keeps the tf.data default.
+    deterministic=None,
 ):
-    ds = dataset
+    ds = _with_deterministic(dataset, deterministic)
+    if interleave_fn is not None:
+        ds = ds.interleave(
+            interleave_fn,
+            cycle_length=interleave_cycle_length,
+            num_parallel_calls=_maybe_autotune(num_parallel_calls),
+        )
     if dataset_skip is not None:
         ds = ds.skip(dataset_skip)
-    if num_examples is not None and num_examples >= 0:
-        ds = ds.take(num_examples).cache()
+    if prebatch_map_fn is not None:
+        ds = ds.map(
+            prebatch_map_fn, num_parallel_calls=_maybe_autotune(num_parallel_calls)
+        )
+
+    should_take = num_examples is not None and num_examples >= 0
+    if should_take:
+        ds = ds.take(num_examples)
+    if should_take or cache_all:
+        ds = ds.cache(cache_filename) if cache_filename else ds.cache()
+
+    if shuffle and shuffle_before_repeat:
+        ds = ds.shuffle(shuffle_buffer_size, seed=shuffle_seed)
     if repeat:
         ds = ds.repeat()
-    if shuffle:
-        ds = ds.shuffle(shuffle_buffer_size)
+    if shuffle and not shuffle_before_repeat:
+        ds = ds.shuffle(shuffle_buffer_size, seed=shuffle_seed)
+    return ds
+
+
+@executable.executable()
+def batcher(
+    dataset,
+    batch_size,
+    # Gives batches a static batch dimension.
+    drop_remainder=False,
+    # If True, uses `padded_batch` so examples of different lengths can be batched.
+    padded=False,
+    # If True, batches are prefetched with `prefetch_buffer_size`, where None means
+    # autotune.
+    prefetch=False,
+    prefetch_buffer_size=None,
+):
+    if padded:
+        ds = dataset.padded_batch(batch_size, drop_remainder=drop_remainder)
+    else:
+        ds = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    if prefetch:
+        ds = ds.prefetch(_maybe_autotune(prefetch_buffer_size))
     return ds
 
 
+def _default_element_length(*element):
+    # Length of the first dimension of the first tensor in the element.
+    #
+    # NOTE: tf.data unpacks tuple elements into separate arguments.
+    return tf.shape(tf.nest.flatten(element)[0])[0]
+
+
+def _get_element_length_fn(sequence_length_key):
+    # If `sequence_length_key` is provided, we assume that elements are either
+    # dicts of features or (features, label) tuples.
+    if sequence_length_key is None:
+        return _default_element_length
+
+    def element_length_fn(*element):
+        features = element[0]
+        return tf.shape(features[sequence_length_key])[0]
+
+    return element_length_fn
+
+
+def get_length_bucket_boundaries(
+    dataset, element_length_fn, num_buckets, num_histogram_examples=10000
+):
+    # Makes a single pass over (at most `num_histogram_examples` of) the dataset to
+    # get a histogram of the lengths. Returns at most `num_buckets - 1` boundaries,
+    # so `bucket_by_sequence_length` makes at most `num_buckets` buckets.
+    #
+    # The last boundary is always past the longest length so that every example we
+    # have seen fits within a boundary, which padding to the bucket boundary
+    # requires. The bucket past it only gets examples longer than any in the
+    # histogram. The other boundaries are chosen to be quantiles of the histogram
+    # so that each of the remaining `num_buckets - 1` buckets gets about the same
+    # number of examples.
+    if num_buckets < 2:
+        raise ValueError(f"Need at least 2 buckets, got {num_buckets}.")
+    lengths = dataset.take(num_histogram_examples).map(
+        element_length_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE
+    )
+    histogram = {}
+    for length in lengths.as_numpy_iterator():
+        histogram[int(length)] = histogram.get(int(length), 0) + 1
+    if not histogram:
+        # Gives a single bucket that can hold empty sequences when padding to the
+        # bucket boundary.
+        return [1]
+
+    sorted_lengths = sorted(histogram.keys())
+    total = sum(histogram.values())
+    final_boundary = sorted_lengths[-1] + 1
+
+    num_quantiles = num_buckets - 1
+    boundaries = []
+    cumulative = 0
+    next_quantile = 1
+    for length in sorted_lengths:
+        cumulative += histogram[length]
+        while next_quantile < num_quantiles and cumulative >= (
+            next_quantile * total / num_quantiles
+        ):
+            # Boundaries are exclusive upper bounds for a bucket.
+            boundary = length + 1
+            if boundary < final_boundary and (
+                not boundaries or boundary > boundaries[-1]
+            ):
+                boundaries.append(boundary)
+            next_quantile += 1
+
+    return boundaries + [final_boundary]
+
+
 @executable.executable()
-def batcher(dataset, batch_size):
-    return dataset.batch(batch_size)
+def bucketed_batcher(
+    dataset,
+    batch_size,
+    # Key of the feature whose length we bucket on. If None, we use the first
+    # tensor in each element.
+    sequence_length_key=None,
+    # If None, boundaries for `num_buckets` buckets get derived from a pass over
+    # the data. See `get_length_bucket_boundaries`.
+    bucket_boundaries=None,
+    num_buckets=8,
+    num_histogram_examples=10000,
+    # If True, examples get padded to their bucket's boundary rather than to the
+    # longest example in their batch. Gives fewer distinct shapes to trace, but
+    # every length must be less than the last boundary. Derived boundaries always
+    # end past the longest example within the first `num_histogram_examples`.
+    pad_to_bucket_boundary=False,
+    drop_remainder=False,
+    prefetch=False,
+    prefetch_buffer_size=None,
+):
+    # Drop-in replacement for `batcher` that batches together examples of similar
+    # lengths, which cuts down on padding. Bind it to "batcher" to use it.
+    element_length_fn = _get_element_length_fn(sequence_length_key)
+    if bucket_boundaries is None:
+        bucket_boundaries = get_length_bucket_boundaries(
+            dataset,
+            element_length_fn,
+            num_buckets=num_buckets,
+            num_histogram_examples=num_histogram_examples,
+        )
+        logging.info(f"Using sequence length bucket boundaries {bucket_boundaries}.")
+
+    ds = dataset.apply(
+        tf.data.experimental.bucket_by_sequence_length(
+            element_length_fn,
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+            pad_to_bucket_boundary=pad_to_bucket_boundary,
+            drop_remainder=drop_remainder,
+        )
+    )
+    if prefetch:
+        ds = ds.prefetch(_maybe_autotune(prefetch_buffer_size))
+    return ds
+
+
+@executable.executable(
+    default_bindings={
+        "prebatch_processer": common_prebatch_processer,
+        "batcher": batcher,
+    },
+)
+def input_pipeline(dataset, _prebatch_processer, _batcher):
+    # Lets the entire pipeline be swapped out with a single binding.
+    ds = _prebatch_processer(dataset)
+    return _batcher(ds)
+
+
+###############################################################################
+
+
+def _get_batch_size(batch):
+    return int(tf.shape(tf.nest.flatten(batch)[0])[0])
+
+
+def benchmark_dataset(dataset, num_batches=100, num_warmup_batches=10):
+    # Returns the number of examples per second that the dataset produces. The
+    # first `num_warmup_batches` are not timed so that things like filling
+    # shuffle buffers do not count.
+    iterator = iter(dataset)
+    for _ in range(num_warmup_batches):
+        next(iterator, None)
+
+    num_examples = 0
+    start_time = time.time()
+    for _ in range(num_batches):
+        batch = next(iterator, None)
+        if batch is None:
+            break
+        num_examples += _get_batch_size(batch)
+    elapsed_seconds = time.time() - start_time
+
+    return num_examples / elapsed_seconds if elapsed_seconds > 0 else 0.0
+
+
+@executable.executable(
+    default_bindings={
+        "input_pipeline": input_pipeline,
+    },
+)
+def input_pipeline_benchmark(
+    dataset, _input_pipeline, num_batches=100, num_warmup_batches=10
+):
+    # Bind `dataset` to one of the data loaders, e.g. a `gcp_tfds_dataset` for a
+    # GLUE task, to see how fast the input pipeline can feed the model.
+    ds = _input_pipeline(dataset)
+    examples_per_second = benchmark_dataset(
+        ds, num_batches=num_batches, num_warmup_batches=num_warmup_batches
+    )
+    logging.info(f"Input pipeline produced {examples_per_second:.1f} examples/sec.")
+    return examples_per_second
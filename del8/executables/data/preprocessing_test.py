@@ -0,0 +1,75 @@
+"""Tests for the length bucketing in preprocessing."""
+from absl.testing import absltest
+
+import numpy as np
+import tensorflow as tf
+
+from del8.executables.data import preprocessing
+
+
+def _create_dataset(lengths):
+    return tf.data.Dataset.from_generator(
+        lambda: (np.ones([n], dtype=np.int32) for n in lengths),
+        output_signature=tf.TensorSpec([None], tf.int32),
+    )
+
+
+class BucketBoundariesTest(absltest.TestCase):
+    def test_last_boundary_is_past_longest_length(self):
+        lengths = list(range(1, 101))
+        boundaries = preprocessing.get_length_bucket_boundaries(
+            _create_dataset(lengths),
+            preprocessing._default_element_length,
+            num_buckets=4,
+        )
+        self.assertEqual(boundaries, sorted(set(boundaries)))
+        self.assertEqual(boundaries[-1], max(lengths) + 1)
+        # The examples we have seen get spread over the first 3 buckets, and the
+        # 4th only gets longer ones.
+        self.assertEqual(boundaries, [35, 68, 101])
+
+    def test_number_of_buckets_matches_argument(self):
+        lengths = list(range(1, 1001))
+        for num_buckets in [2, 3, 8]:
+            boundaries = preprocessing.get_length_bucket_boundaries(
+                _create_dataset(lengths),
+                preprocessing._default_element_length,
+                num_buckets=num_buckets,
+            )
+            # The `bucket_by_sequence_length` makes one more bucket than there are
+            # boundaries.
+            self.assertLen(boundaries, num_buckets - 1)
+
+    def test_single_length(self):
+        boundaries = preprocessing.get_length_bucket_boundaries(
+            _create_dataset([5] * 20),
+            preprocessing._default_element_length,
+            num_buckets=4,
+        )
+        self.assertEqual(boundaries, [6])
+
+    def test_empty_dataset(self):
+        boundaries = preprocessing.get_length_bucket_boundaries(
+            _create_dataset([]),
+            preprocessing._default_element_length,
+            num_buckets=4,
+        )
+        self.assertEqual(boundaries, [1])
+
+    def test_bucketed_batcher_pads_to_derived_boundaries(self):
+        rng = np.random.RandomState(0)
+        lengths = list(rng.randint(1, 50, size=200)) + [64]
+        ds = preprocessing.bucketed_batcher()(
+            _create_dataset(lengths),
+            batch_size=8,
+            num_buckets=4,
+            pad_to_bucket_boundary=True,
+        )
+        num_examples = 0
+        for batch in ds:
+            num_examples += int(batch.shape[0])
+        self.assertEqual(num_examples, len(lengths))
+
+
+if __name__ == "__main__":
+    absltest.main()
@@ -1,13 +1,21 @@
 """TODO: Add title."""
+import base64
+from concurrent import futures
+import json
 import os
+import re
+import threading
+import uuid as uuidlib
 
 from absl import logging
 
 from google.cloud import storage as gcp_storage
+import google_crc32c
 from google.oauth2 import service_account
 import tensorflow_datasets as tfds
 
 from del8.core.di import executable
+from del8.core.utils import file_util
 from del8.core.utils import gcp_util
 
 
@@ -37,6 +45,88 @@ def private_key_filepath_from_storage(storage):
     return storage.private_key_file
 
 
+# Lives inside of the dataset's local directory. Keeps track of which files we have
+# fully downloaded and verified.
+_DOWNLOAD_MANIFEST_FILENAME = ".del8_download_manifest.json"
+
+# Also lives inside of the dataset's local directory. Held while downloading so that
+# only a single process on the host downloads any given dataset at a time.
+_DOWNLOAD_LOCK_FILENAME = ".del8_download.lock"
+
+# Matches the file names of record shards, e.g. "glue-train.tfrecord-00000-of-00001".
+_SHARD_FILENAME_REGEX = re.compile(
+    r"-(?P<split>[^-.]+)\.(tfrecord|array_record|riegeli)"
+)
+
+# Matches the split names in a split string, e.g. "train[:10%]+validation".
+_SPLIT_NAME_REGEX = re.compile(r"(?:^|\+)\s*(?P<split>[^\[+\s]+)")
+
+
+def _get_split_names(split):
+    # Returns None if we could not figure out the split names, e.g. when the split
+    # is given as a `tfds.core.ReadInstruction`.
+    if not isinstance(split, (list, tuple)):
+        split = [split]
+    if not all(isinstance(s, str) for s in split):
+        return None
+    names = set()
+    for s in split:
+        names.update(m.group("split") for m in _SPLIT_NAME_REGEX.finditer(s))
+    return names
+
+
+def _get_shard_split(blob_name):
+    # Returns None if the blob is not a record shard, i.e. it is metadata.
+    match = _SHARD_FILENAME_REGEX.search(os.path.basename(blob_name))
+    return match.group("split") if match else None
+
+
+def _file_crc32c(filepath, chunk_size=8 * 1024 * 1024):
+    # Returns the crc in the same base64 format that GCS uses.
+    checksum = google_crc32c.Checksum()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+def _is_valid_local_file(filepath, file_info, check_crc=True):
+    if not os.path.isfile(filepath):
+        return False
+    elif os.path.getsize(filepath) != file_info["size"]:
+        return False
+    elif check_crc and file_info["crc32c"]:
+        return _file_crc32c(filepath) == file_info["crc32c"]
+    return True
+
+
+def _read_manifest(manifest_filepath):
+    if not os.path.exists(manifest_filepath):
+        return {"remote": {}, "local": []}
+    with open(manifest_filepath, "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest_filepath, manifest):
+    os.makedirs(os.path.dirname(manifest_filepath), exist_ok=True)
+    tmp_filepath = f"{manifest_filepath}.{uuidlib.uuid4().hex}.tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_filepath, manifest_filepath)
+
+
+def _get_matching_local_files(data_dir, remote_files):
+    # Returns the names of the files in `data_dir` whose sizes match their remote
+    # versions. Does not verify the crcs.
+    return sorted(
+        name
+        for name, file_info in remote_files.items()
+        if _is_valid_local_file(
+            os.path.join(data_dir, name), file_info, check_crc=False
+        )
+    )
+
+
 @executable.executable(
     # TODO: Add all of the cloud dependencies to pip_packages as well.
     pip_packages=["tensorflow-datasets"],
@@ -57,56 +147,230 @@ class gcp_tfds_dataset(object):
     def connect_to_bucket(self, tfds_bucket, private_key_filepath):
         return gcp_util.connect_to_bucket(tfds_bucket, private_key_filepath)
 
-    def call(
+    def _get_needed_files(self, remote_files, split, download_all_records):
+        split_names = _get_split_names(split)
+        if download_all_records or split_names is None:
+            return sorted(remote_files.keys())
+        # Only fetch the record shards of the splits that we are loading. We
+        # always need all of the metadata files.
+        return sorted(
+            name
+            for name in remote_files.keys()
+            if _get_shard_split(name) in split_names.union({None})
+        )
+
+    def _has_local_files(self, tfds_dir, manifest, needed_files):
+        # Cheap check that does not verify the crcs. Files only get added to the
+        # manifest after their crc has been verified.
+        local_files = set(manifest["local"])
+        for name in needed_files:
+            if name not in local_files:
+                return False
+            filepath = os.path.join(tfds_dir, name)
+            if not _is_valid_local_file(
+                filepath, manifest["remote"][name], check_crc=False
+            ):
+                return False
+        return True
+
+    def _download_files(
         self,
-        dataset_name,
-        split,
-        download_all_records=True,
-        tfds_bucket="del8_tfds",
-        # This is where stuff will be copied locally.
-        tfds_dir="~/tensorflow_datasets",
+        names,
+        tfds_bucket,
+        private_key_filepath,
+        tfds_dir,
+        manifest,
+        manifest_filepath,
+        num_download_threads,
+        read_only=False,
     ):
-        # NOTE: That the split argument does not affect what is downloaded from gcp.
-        if not download_all_records:
-            raise NotImplementedError(
-                "TODO: Support downloading tfrecords as needed. Bested suited for large datasets. "
-                "Try to use the regular `tfds_dataset` executable with the `tfds_try_gcs=True` flag."
-            )
+        remote_files = manifest["remote"]
+        thread_local = threading.local()
 
-        name_subpath = self.dataset_name_to_subpath(dataset_name)
-        tfds_dir = os.path.expanduser(tfds_dir)
-        local_records_path = os.path.join(tfds_dir, name_subpath)
+        def download(name):
+            filepath = os.path.join(tfds_dir, name)
+            file_info = remote_files[name]
 
-        # If the directory already exists locally for the dataset, assume that the
-        # data set exists locally and load from it.
-        if os.path.isdir(local_records_path):
-            logging.info(
-                f"Using records found locally at {local_records_path} for tfds data set {dataset_name}."
-            )
-            return tfds.load(dataset_name, split=split, data_dir=tfds_dir)
-        else:
-            logging.info(
-                f"Downloading records from gs://{tfds_bucket} for tfds data set {dataset_name}."
-            )
+            # Resume support: reuse anything already downloaded that passes
+            # verification, e.g. from a run that crashed before updating the
+            # manifest.
+            if _is_valid_local_file(filepath, file_info):
+                return name
+
+            # NOTE: We use a bucket per thread since we do not want to rely on the
+            # client being thread-safe. We also can't use dependency injection
+            # off of the main thread.
+            if not hasattr(thread_local, "bucket"):
+                thread_local.bucket = gcp_util.connect_to_bucket(
+                    tfds_bucket, private_key_filepath
+                )
+
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            # Download to a temporary file and then atomically move it into place
+            # so that an interrupted download never leaves a partial file behind.
+            tmp_filepath = f"{filepath}.{uuidlib.uuid4().hex}.tmp"
+            try:
+                thread_local.bucket.blob(name).download_to_filename(tmp_filepath)
+                if not _is_valid_local_file(tmp_filepath, file_info):
+                    raise ValueError(
+                        f"Downloaded file gs://{tfds_bucket}/{name} did not match "
+                        "its expected size and crc32c."
+                    )
+                if read_only:
+                    os.chmod(tmp_filepath, 0o444)
+                os.replace(tmp_filepath, filepath)
+            finally:
+                if os.path.exists(tmp_filepath):
+                    os.remove(tmp_filepath)
+            return name
+
+        local_files = set(manifest["local"])
+        with futures.ThreadPoolExecutor(max_workers=num_download_threads) as pool:
+            download_futures = [pool.submit(download, name) for name in names]
+            try:
+                for i, future in enumerate(futures.as_completed(download_futures)):
+                    local_files.add(future.result())
+                    manifest["local"] = sorted(local_files)
+                    _write_manifest(manifest_filepath, manifest)
+                    logging.info(f"Downloaded {i + 1}/{len(names)} tfds files.")
+            except BaseException:
+                for future in download_futures:
+                    future.cancel()
+                raise
+
+    def _has_records(self, data_dir, manifest_filepath, split, download_all_records):
+        manifest = _read_manifest(manifest_filepath)
+        if not manifest["remote"]:
+            return False
+        needed_files = self._get_needed_files(
+            manifest["remote"], split, download_all_records
+        )
+        return self._has_local_files(data_dir, manifest, needed_files)
+
+    def _download_records(
+        self,
+        dataset_name,
+        split,
+        private_key_filepath,
+        download_all_records,
+        tfds_bucket,
+        data_dir,
+        manifest_filepath,
+        num_download_threads,
+        read_only,
+    ):
+        logging.info(
+            f"Downloading records from gs://{tfds_bucket} for tfds data set {dataset_name}."
+        )
 
         bucket = self.connect_to_bucket(tfds_bucket)
 
-        prefix = name_subpath
+        prefix = self.dataset_name_to_subpath(dataset_name)
         # NOTE: I think the prefix has to end with a slash.
         if not prefix.endswith("/"):
             prefix = prefix + "/"
 
-        blobs = list(bucket.list_blobs(prefix=prefix))
-        if not blobs:
+        remote_files = {
+            blob.name: {"size": blob.size, "crc32c": blob.crc32c}
+            for blob in bucket.list_blobs(prefix=prefix)
+        }
+        if not remote_files:
             raise ValueError(
                 f"The tfds dataset {dataset_name} had no matching files on gcp bucket {tfds_bucket}."
             )
 
-        # NOTE: For large datasets, this can be done much faster using multithreading. However,
-        # it appears good enough for GLUE datasets, so I'll hold off on that.
-        for blob in blobs:
-            download_filepath = os.path.join(tfds_dir, blob.name)
-            os.makedirs(os.path.dirname(download_filepath), exist_ok=True)
-            blob.download_to_filename(download_filepath)
+        if os.path.exists(manifest_filepath):
+            # Forget about any local files whose remote versions have changed.
+            manifest = _read_manifest(manifest_filepath)
+            local_files = [
+                name
+                for name in manifest["local"]
+                if manifest["remote"].get(name) == remote_files.get(name)
+            ]
+        else:
+            # Datasets downloaded before we kept manifests, e.g. by an older version
+            # of `gcp_tfds_dataset`, might have been interrupted part way through.
+            # We keep the files whose sizes match the remote ones and download the
+            # rest.
+            local_files = _get_matching_local_files(data_dir, remote_files)
+        manifest = {"remote": remote_files, "local": local_files}
+        _write_manifest(manifest_filepath, manifest)
+
+        needed_files = self._get_needed_files(
+            remote_files, split, download_all_records
+        )
+        missing_files = [
+            name
+            for name in needed_files
+            if not self._has_local_files(data_dir, manifest, [name])
+        ]
+        self._download_files(
+            missing_files,
+            tfds_bucket=tfds_bucket,
+            private_key_filepath=private_key_filepath,
+            tfds_dir=data_dir,
+            manifest=manifest,
+            manifest_filepath=manifest_filepath,
+            num_download_threads=num_download_threads,
+            read_only=read_only,
+        )
+
+    def call(
+        self,
+        dataset_name,
+        split,
+        private_key_filepath,
+        # If False, we only fetch the record shards for the splits in `split`. Shards
+        # for other splits get fetched when they are requested.
+        download_all_records=True,
+        tfds_bucket="del8_tfds",
+        # This is where stuff will be copied locally.
+        tfds_dir="~/tensorflow_datasets",
+        num_download_threads=16,
+        # If provided, records are downloaded to and loaded from this directory
+        # instead of tfds_dir. It is meant to be shared by all of the workers on a
+        # host, e.g. set it to the same directory for all of the workers on a
+        # Longleaf node. Only the first worker needing a dataset will download it
+        # while the rest wait for it. The downloaded records are made read-only.
+        shared_tfds_dir=None,
+    ):
+        name_subpath = self.dataset_name_to_subpath(dataset_name)
+        tfds_dir = os.path.expanduser(tfds_dir)
+        if shared_tfds_dir:
+            data_dir = os.path.expanduser(shared_tfds_dir)
+        else:
+            data_dir = tfds_dir
+
+        records_path = os.path.join(data_dir, name_subpath)
+        manifest_filepath = os.path.join(records_path, _DOWNLOAD_MANIFEST_FILENAME)
+        has_records_kwargs = {
+            "data_dir": data_dir,
+            "manifest_filepath": manifest_filepath,
+            "split": split,
+            "download_all_records": download_all_records,
+        }
+
+        if self._has_records(**has_records_kwargs):
+            logging.info(
+                f"Using records found locally at {records_path} for tfds data set {dataset_name}."
+            )
+        else:
+            os.makedirs(records_path, exist_ok=True)
+            lock_filepath = os.path.join(records_path, _DOWNLOAD_LOCK_FILENAME)
+            with file_util.file_lock(lock_filepath):
+                # Another process might have downloaded the records while we were
+                # waiting on the lock.
+                if not self._has_records(**has_records_kwargs):
+                    self._download_records(
+                        dataset_name,
+                        split,
+                        private_key_filepath=private_key_filepath,
+                        download_all_records=download_all_records,
+                        tfds_bucket=tfds_bucket,
+                        data_dir=data_dir,
+                        manifest_filepath=manifest_filepath,
+                        num_download_threads=num_download_threads,
+                        read_only=bool(shared_tfds_dir),
+                    )
 
-        return tfds.load(dataset_name, split=split, data_dir=tfds_dir)
+        return tfds.load(dataset_name, split=split, data_dir=data_dir)
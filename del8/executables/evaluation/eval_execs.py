@@ -1,14 +1,18 @@
 """TODO: Add title."""
+from concurrent import futures
 import datetime
 import time
 
 from absl import logging
 
+import numpy as np
 import tensorflow as tf
 
 from del8.core import data_class
 from del8.core.di import executable
 from del8.core.di import scopes
+from del8.executables.evaluation import streaming_metrics
+from del8.executables.models import checkpoints
 
 
 ###############################################################################
@@ -30,28 +34,113 @@ def evaluate_model(
 ###############################################################################
 
 
-# def _get_task_logits(compute_task_logits, dataset, task, num_classes):
-#     task_logits = tf.TensorArray(
-#         tf.float32,
-#         size=0,
-#         dynamic_size=True,
-#         infer_shape=False,
-#         element_shape=tf.TensorShape([None, num_classes])
-#     )
-#     index = 0
-#     for minibatch, _ in dataset:
-#         logits = compute_task_logits(minibatch, task, training=False)
-#         task_logits = task_logits.write(index, logits)
-#         index += 1
-#     return task_logits.concat()
+def _start_task_inputs(dataset):
+    # Creates an iterator over the dataset and pulls its first element. This starts
+    # up the dataset's input pipeline, including its background prefetching, so that
+    # it can run while we are doing something else.
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    iterator = iter(dataset)
+    first_element = iterator.get_next_as_optional()
+    return iterator, first_element
+
+
+def _get_task_outputs(
+    compute_task_logits,
+    task_inputs,
+    task,
+    num_examples,
+    num_classes,
+    argmax=False,
+    compile_loop=False,
+    labels=None,
+    streaming=None,
+):
+    # Runs the model over the dataset and writes its outputs into a buffer that is
+    # preallocated to hold all `num_examples` outputs. This avoids having both the
+    # per-batch outputs and their concatenation in memory at the same time.
+    #
+    # The `task_inputs` are what `_start_task_inputs` returns for the dataset.
+    #
+    # If `argmax`, we only keep the predicted class for each example instead of its
+    # logits. If `compile_loop`, the entire loop over the dataset is traced into a
+    # single tf.function.
+    #
+    # If `streaming` is provided, it is a StreamingMetrics that gets updated with
+    # each batch of the `labels` and predictions. Requires `argmax`.
+    if streaming and not argmax:
+        raise ValueError("Updating streaming metrics in the loop requires argmax.")
+    if argmax:
+        initial_value = tf.zeros([num_examples], dtype=tf.int32)
+    else:
+        initial_value = tf.zeros([num_examples, num_classes], dtype=tf.float32)
+    buffer = tf.Variable(initial_value, trainable=False)
+    del initial_value
+
+    def update_streaming(batch_labels, outputs):
+        streaming.update(batch_labels, outputs)
+        # NOTE: tf.numpy_function needs us to return something.
+        return np.int32(0)
+
+    def write_outputs(start, minibatch):
+        outputs = compute_task_logits(minibatch, task, training=False)
+        if argmax:
+            outputs = tf.argmax(outputs, axis=-1, output_type=tf.int32)
+        end = start + tf.shape(outputs)[0]
+        buffer[start:end].assign(tf.cast(outputs, buffer.dtype))
+        if streaming:
+            if compile_loop:
+                # The metrics are updated in numpy, so we leave the graph for it.
+                tf.numpy_function(
+                    update_streaming, [labels[start:end], outputs], tf.int32
+                )
+            else:
+                update_streaming(labels[start:end], outputs)
+        return end
+
+    def fill_buffer(start, iterator):
+        for minibatch, _ in iterator:
+            start = write_outputs(start, minibatch)
+        return start
+
+    if compile_loop:
+        write_outputs = tf.function(write_outputs)
+        fill_buffer = tf.function(fill_buffer)
+
+    iterator, first_element = task_inputs
+    num_filled = tf.constant(0)
+    if first_element.has_value():
+        minibatch, _ = first_element.get_value()
+        num_filled = write_outputs(num_filled, minibatch)
+        num_filled = fill_buffer(num_filled, iterator)
+
+    num_filled = int(num_filled)
+    if num_filled != num_examples:
+        raise ValueError(
+            f"Task {task} had {num_filled} evaluation examples but {num_examples} labels."
+        )
+
+    return tf.convert_to_tensor(buffer)
+
+
+def _compute_task_metrics(
+    labels, prediction_outputs, metrics, use_streaming_metrics, streaming=None
+):
+    # Returns the results and how long they took to compute in seconds. The
+    # `streaming` are the StreamingMetrics if they were updated in the loop.
+    start_time = time.time()
+    if use_streaming_metrics:
+        task_results = streaming_metrics.compute_metrics(
+            labels, prediction_outputs, metrics, streaming=streaming
+        )
+    else:
+        task_results = {}
+        for metric in metrics:
+            task_results.update(metric(labels, prediction_outputs, return_dict=True))
+    return task_results, time.time() - start_time
 
 
-def _get_task_logits(compute_task_logits, dataset, task, num_classes):
-    task_logits = []
-    for minibatch, _ in dataset:
-        logits = compute_task_logits(minibatch, task, training=False)
-        task_logits.append(logits)
-    return tf.concat(task_logits, axis=0)
+def _seconds_to_nice(seconds):
+    return str(datetime.timedelta(seconds=seconds))
 
 
 @executable.executable()
@@ -78,42 +167,124 @@ def robust_evaluate_model(
     metrics_for_tasks,
     _process_task_logits,
     _evaluation_results_saver,
+    # If True, the loop over each task's dataset is compiled into a tf.function.
+    compile_evaluation_loop=False,
+    # If True, metrics from `metrics.py` that share sufficient statistics (e.g. a
+    # confusion matrix) are computed together in a single pass.
+    use_streaming_metrics=False,
+    # If True, the next task's input pipeline starts up while the model is running
+    # on the current task, and metrics are computed on a thread pool while the model
+    # moves on to the next task.
+    interleave_tasks=False,
+    # Only used if `interleave_tasks`.
+    num_metric_threads=4,
 ):
-    results = {}
-    items = robust_evaluate_dataset.items()
-    for task, dataset in items:
-        if task.endswith("_labels"):
-            continue
-
-        labels = robust_evaluate_dataset[f"{task}_labels"]
-
-        og_task = task
-        task = _handle_mnli(task)
-
-        start_time = time.time()
-        task_logits = _get_task_logits(
-            compiled_model.compute_task_logits,
-            dataset,
-            task,
-            num_classes=compiled_model.get_num_classes_for_task(task),
-        )
-        elapsed_seconds = time.time() - start_time
-        elapsed_nice = str(datetime.timedelta(seconds=elapsed_seconds))
-        logging.info(f"Evaluation took {elapsed_nice}")
-
-        with scopes.binding_by_name_scope("task", og_task):
-            prediction_outputs = _process_task_logits(task_logits)
-
-        metrics = metrics_for_tasks[og_task]
-        if not isinstance(metrics, (list, tuple)):
-            metrics = [metrics]
-
-        task_results = {}
-        for metric in metrics:
-            task_results.update(metric(labels, prediction_outputs, return_dict=True))
-
-        results[og_task] = task_results
-
+    # NOTE: When using the default `argmax_logits`, we take the argmax inside of the
+    # evaluation loop so that we never have to keep all of the logits around.
+    argmax_in_loop = isinstance(_process_task_logits, argmax_logits)
+
+    tasks = [t for t in robust_evaluate_dataset.keys() if not t.endswith("_labels")]
+
+    # NOTE: Only the dataset prefetching and metric computation happen off of the
+    # main thread. Anything using dependency injection, such as the call to
+    # `_process_task_logits`, must stay on the main thread.
+    if interleave_tasks:
+        prefetch_pool = futures.ThreadPoolExecutor(max_workers=1)
+        metrics_pool = futures.ThreadPoolExecutor(max_workers=num_metric_threads)
+    else:
+        prefetch_pool = None
+        metrics_pool = None
+
+    def start_task_inputs(task):
+        dataset = robust_evaluate_dataset[task]
+        if prefetch_pool:
+            return prefetch_pool.submit(_start_task_inputs, dataset)
+        return _start_task_inputs(dataset)
+
+    task_to_metrics_result = {}
+    task_to_eval_seconds = {}
+    try:
+        next_task_inputs = start_task_inputs(tasks[0]) if tasks else None
+        for i, og_task in enumerate(tasks):
+            task_inputs = next_task_inputs
+            if prefetch_pool:
+                task_inputs = task_inputs.result()
+            if i + 1 < len(tasks):
+                next_task_inputs = start_task_inputs(tasks[i + 1])
+            else:
+                next_task_inputs = None
+
+            labels = robust_evaluate_dataset[f"{og_task}_labels"]
+            task = _handle_mnli(og_task)
+
+            metrics = metrics_for_tasks[og_task]
+            if not isinstance(metrics, (list, tuple)):
+                metrics = [metrics]
+
+            # We can only update the streaming metrics batch by batch if we have
+            # the predictions inside of the loop.
+            streaming = None
+            if use_streaming_metrics and argmax_in_loop:
+                streaming = streaming_metrics.create_streaming_metrics(metrics)
+
+            start_time = time.time()
+            task_outputs = _get_task_outputs(
+                compiled_model.compute_task_logits,
+                task_inputs,
+                task,
+                num_examples=labels.shape[0],
+                num_classes=compiled_model.get_num_classes_for_task(task),
+                argmax=argmax_in_loop,
+                compile_loop=compile_evaluation_loop,
+                labels=tf.convert_to_tensor(labels),
+                streaming=streaming,
+            )
+            del task_inputs
+            task_to_eval_seconds[og_task] = time.time() - start_time
+            logging.info(
+                f"Evaluation of {og_task} took "
+                f"{_seconds_to_nice(task_to_eval_seconds[og_task])}"
+            )
+
+            if argmax_in_loop:
+                prediction_outputs = task_outputs
+            else:
+                with scopes.binding_by_name_scope("task", og_task):
+                    prediction_outputs = _process_task_logits(task_outputs)
+
+            metrics_args = (
+                labels,
+                prediction_outputs,
+                metrics,
+                use_streaming_metrics,
+                streaming,
+            )
+            if metrics_pool:
+                task_to_metrics_result[og_task] = metrics_pool.submit(
+                    _compute_task_metrics, *metrics_args
+                )
+            else:
+                task_to_metrics_result[og_task] = _compute_task_metrics(*metrics_args)
+
+        results = {}
+        timings = {}
+        for og_task in tasks:
+            metrics_result = task_to_metrics_result[og_task]
+            if metrics_pool:
+                metrics_result = metrics_result.result()
+            results[og_task], metrics_seconds = metrics_result
+            timings[og_task] = {
+                "evaluation": _seconds_to_nice(task_to_eval_seconds[og_task]),
+                "metrics": _seconds_to_nice(metrics_seconds),
+            }
+
+    finally:
+        if prefetch_pool:
+            prefetch_pool.shutdown(wait=True)
+        if metrics_pool:
+            metrics_pool.shutdown(wait=True)
+
+    logging.info(f"Per-task evaluation timings: {timings}")
     logging.info(f"Evaluation results: {results}")
 
     return _evaluation_results_saver(results)
@@ -135,23 +306,81 @@ def checkpoint_evaluation_results_saver(results, storage, checkpoint):
     return item_uuid
 
 
+def _prefetch_checkpoint(prefetch_fn, checkpoint_blob_uuid):
+    # Runs in a background thread, so just log failures. The checkpoint will
+    # then get downloaded as usual when it is needed.
+    try:
+        prefetch_fn()
+    except Exception as e:
+        logging.warning(f"Failed to prefetch checkpoint {checkpoint_blob_uuid}.")
+        logging.exception(e)
+
+
 @executable.executable(
     default_bindings={
         "evaluation_results_saver": checkpoint_evaluation_results_saver,
         "evaluate_model": evaluate_model,
+        "checkpoint_loader": checkpoints.checkpoint_loader,
     },
 )
 def evaluate_from_checkpoints_summary(
-    checkpoints_summary, _compiled_model, _evaluate_model, should_clear_session=True
+    checkpoints_summary,
+    _compiled_model,
+    _evaluate_model,
+    _checkpoint_loader,
+    storage=None,
+    should_clear_session=True,
+    # If True, we only build and compile the model once. The weights of each
+    # checkpoint then get loaded into it in place, so any traced tf.functions of
+    # the model get reused across checkpoints.
+    reuse_compiled_model=False,
+    # If True, we download the next checkpoint into the storage's cache in the
+    # background while evaluating the current one. Requires the storage to have
+    # a blob cache to do anything.
+    prefetch_next_checkpoint=False,
 ):
+    checkpoint_uuids = checkpoints_summary.checkpoint_uuids
+
+    prefetch_pool = None
+    if prefetch_next_checkpoint and storage is not None:
+        prefetch_pool = futures.ThreadPoolExecutor(max_workers=1)
+
     retvals = []
-    for i, checkpoint_blob_uuid in enumerate(checkpoints_summary.checkpoint_uuids):
-        bindings = [("checkpoint", checkpoint_blob_uuid), ("checkpoint_index", i)]
-        with scopes.binding_by_name_scopes(bindings):
-            compiled_model = _compiled_model()
-            with scopes.binding_by_name_scope("compiled_model", compiled_model):
-                retval = _evaluate_model(compiled_model)
-                retvals.append(retval)
-            if should_clear_session:
-                tf.keras.backend.clear_session()
+    compiled_model = None
+    try:
+        for i, checkpoint_blob_uuid in enumerate(checkpoint_uuids):
+            prefetch_future = None
+            if prefetch_pool and i + 1 < len(checkpoint_uuids):
+                next_uuid = checkpoint_uuids[i + 1]
+                # NOTE: Must be called on this thread as it might use the storage's
+                # database connection.
+                prefetch_fn = storage.get_blob_prefetch_fn(next_uuid)
+                if prefetch_fn:
+                    prefetch_future = prefetch_pool.submit(
+                        _prefetch_checkpoint, prefetch_fn, next_uuid
+                    )
+
+            bindings = [("checkpoint", checkpoint_blob_uuid), ("checkpoint_index", i)]
+            with scopes.binding_by_name_scopes(bindings):
+                if compiled_model is None or not reuse_compiled_model:
+                    # NOTE: Building the model loads the bound checkpoint.
+                    compiled_model = _compiled_model()
+                else:
+                    _checkpoint_loader(compiled_model)
+
+                with scopes.binding_by_name_scope("compiled_model", compiled_model):
+                    retval = _evaluate_model(compiled_model)
+                    retvals.append(retval)
+                if should_clear_session and not reuse_compiled_model:
+                    tf.keras.backend.clear_session()
+
+            if prefetch_future:
+                # Do not let the prefetches pile up.
+                prefetch_future.result()
+    finally:
+        if prefetch_pool:
+            prefetch_pool.shutdown()
+
+    if should_clear_session and reuse_compiled_model:
+        tf.keras.backend.clear_session()
     return retvals
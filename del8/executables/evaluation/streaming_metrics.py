@@ -0,0 +1,378 @@
+"""Metrics computed from sufficient statistics that are updated batch by batch.
+
+The classification metrics are all derived from a single confusion matrix, so
+asking for several of them only requires a single pass over the predictions.
+The values match those of the corresponding functions in `metrics.py`.
+"""
+import numpy as np
+import scipy.stats
+import tensorflow as tf
+
+from del8.executables.evaluation import metrics as metrics_lib
+
+
+ACCURACY = "accuracy"
+F1 = "f1"
+F1_WITH_INVALID = "f1_with_invalid"
+MICRO_F1 = "micro_f1"
+MACRO_F1 = "macro_f1"
+MACRO_F1_1 = "macro_f1_1"
+MACRO_F1_2 = "macro_f1_2"
+MATTHEWS_CORRCOEF = "matthews_corrcoef"
+PEARSON_CORRCOEF = "pearson_corrcoef"
+SPEARMAN_CORRCOEF = "spearman_corrcoef"
+
+# The key each metric's value has in the results dict. These match the names used
+# by the `return_dict=True` versions of the functions in `metrics.py`.
+_RESULT_NAMES = {
+    ACCURACY: "accuracy",
+    F1: "f1",
+    F1_WITH_INVALID: "f1",
+    MICRO_F1: "f1",
+    MACRO_F1: "f1",
+    MACRO_F1_1: "macro_f1_1",
+    MACRO_F1_2: "macro_f1_2",
+    MATTHEWS_CORRCOEF: "matthews_corrcoef",
+    PEARSON_CORRCOEF: "pearson_corrcoef",
+    SPEARMAN_CORRCOEF: "spearman_corrcoef",
+}
+
+_CONFUSION_METRICS = frozenset(
+    {ACCURACY, F1, MICRO_F1, MACRO_F1, MACRO_F1_1, MACRO_F1_2, MATTHEWS_CORRCOEF}
+)
+
+_METRIC_FN_TO_NAME = {
+    metrics_lib.accuracy: ACCURACY,
+    metrics_lib.f1: F1,
+    metrics_lib.f1_score_with_invalid: F1_WITH_INVALID,
+    metrics_lib.micro_f1: MICRO_F1,
+    metrics_lib.macro_f1: MACRO_F1,
+    metrics_lib.macro_f1_1: MACRO_F1_1,
+    metrics_lib.macro_f1_2: MACRO_F1_2,
+    metrics_lib.matthews_corrcoef: MATTHEWS_CORRCOEF,
+    metrics_lib.pearson_corrcoef: PEARSON_CORRCOEF,
+    metrics_lib.spearman_corrcoef: SPEARMAN_CORRCOEF,
+}
+
+
+def get_streaming_metric_name(metric_fn):
+    # Returns None if the function from `metrics.py` has no streaming version.
+    try:
+        return _METRIC_FN_TO_NAME.get(metric_fn)
+    except TypeError:
+        # Unhashable metric.
+        return None
+
+
+def _to_numpy(x):
+    if isinstance(x, tf.Tensor):
+        x = x.numpy()
+    return np.asarray(x)
+
+
+def _safe_divide(numerator, denominator):
+    # Elementwise division that gives 0 wherever the denominator is 0. This
+    # matches how sklearn handles ill-defined precision and recall.
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    out = np.zeros(np.broadcast(numerator, denominator).shape, dtype=np.float64)
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out
+
+
+def _nan_to_zero(x):
+    return 0.0 if np.isnan(x) else float(x)
+
+
+###############################################################################
+
+
+class ConfusionMatrix(object):
+    # Rows are targets and columns are predictions. Grows as new labels appear.
+    #
+    # Labels can be negative, e.g. -1 used for padding. The first row and column
+    # then correspond to `min_label` rather than 0.
+
+    def __init__(self, num_classes=2):
+        self.matrix = np.zeros([num_classes, num_classes], dtype=np.int64)
+        self.min_label = 0
+
+    @property
+    def num_classes(self):
+        return self.matrix.shape[0]
+
+    @property
+    def max_label(self):
+        return self.min_label + self.num_classes - 1
+
+    def _grow(self, min_label, max_label):
+        min_label = min(min_label, self.min_label)
+        max_label = max(max_label, self.max_label)
+        if min_label == self.min_label and max_label == self.max_label:
+            return
+        num_classes = max_label - min_label + 1
+        matrix = np.zeros([num_classes, num_classes], dtype=np.int64)
+        start = self.min_label - min_label
+        end = start + self.num_classes
+        matrix[start:end, start:end] = self.matrix
+        self.matrix = matrix
+        self.min_label = min_label
+
+    def update(self, targets, predictions):
+        targets = _to_numpy(targets).astype(np.int64).reshape(-1)
+        predictions = _to_numpy(predictions).astype(np.int64).reshape(-1)
+        if targets.shape != predictions.shape:
+            raise ValueError(
+                f"Got {targets.size} targets but {predictions.size} predictions."
+            )
+        if not targets.size:
+            return
+        self._grow(
+            int(min(targets.min(), predictions.min())),
+            int(max(targets.max(), predictions.max())),
+        )
+        k = self.num_classes
+        indices = (targets - self.min_label) * k + (predictions - self.min_label)
+        counts = np.bincount(indices, minlength=k * k)
+        self.matrix += counts.reshape([k, k])
+
+    ############################################
+
+    def _present_labels(self):
+        # Indices of the labels appearing in either the targets or predictions.
+        # This is what sklearn averages over.
+        present = (self.matrix.sum(axis=0) + self.matrix.sum(axis=1)) > 0
+        return np.flatnonzero(present)
+
+    def _per_class_stats(self):
+        labels = self._present_labels()
+        matrix = self.matrix[np.ix_(labels, labels)]
+        tp = np.diag(matrix)
+        precision = _safe_divide(tp, matrix.sum(axis=0))
+        recall = _safe_divide(tp, matrix.sum(axis=1))
+        return labels, tp, precision, recall
+
+    def accuracy(self):
+        return 100 * _safe_divide(np.trace(self.matrix), self.matrix.sum()).item()
+
+    def binary_f1(self, pos_label=1):
+        labels = self._present_labels() + self.min_label
+        if np.any((labels != 0) & (labels != 1)):
+            raise ValueError("Binary f1 requires targets and predictions in {0, 1}.")
+        self._grow(pos_label, pos_label)
+        i = pos_label - self.min_label
+        tp = self.matrix[i, i]
+        fp = self.matrix[:, i].sum() - tp
+        fn = self.matrix[i].sum() - tp
+        return 100 * _safe_divide(2 * tp, 2 * tp + fp + fn).item()
+
+    def micro_f1(self):
+        # For single-label classification, micro-averaged f1 equals accuracy.
+        return self.accuracy()
+
+    def macro_f1(self):
+        # Per-class f1 averaged over classes. Ill-defined f1 counts as 0.
+        _, _, precision, recall = self._per_class_stats()
+        f1 = _safe_divide(2 * precision * recall, precision + recall)
+        return 100 * float(np.mean(f1)) if f1.size else 0.0
+
+    def macro_f1_1(self):
+        # Same as `metrics.macro_f1_1`, where an ill-defined f1 for any class
+        # makes the entire result 0.
+        _, _, precision, recall = self._per_class_stats()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f1 = 2 * (precision * recall) / (precision + recall)
+        return _nan_to_zero(100 * np.mean(f1))
+
+    def macro_f1_2(self):
+        _, _, precision, recall = self._per_class_stats()
+        precision, recall = np.mean(precision), np.mean(recall)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f1 = 2 * (precision * recall) / (precision + recall)
+        return _nan_to_zero(100 * f1)
+
+    def matthews_corrcoef(self):
+        matrix = self.matrix.astype(np.float64)
+        t_sum = matrix.sum(axis=1)
+        p_sum = matrix.sum(axis=0)
+        n_correct = np.trace(matrix)
+        n_samples = matrix.sum()
+        cov_ytyp = n_correct * n_samples - np.dot(t_sum, p_sum)
+        cov_ypyp = n_samples ** 2 - np.dot(p_sum, p_sum)
+        cov_ytyt = n_samples ** 2 - np.dot(t_sum, t_sum)
+        if cov_ypyp * cov_ytyt == 0:
+            return 0.0
+        return _nan_to_zero(100 * cov_ytyp / np.sqrt(cov_ytyt * cov_ypyp))
+
+
+class PearsonAccumulator(object):
+    # Keeps running means and co-moments, which are merged batch by batch. This is
+    # more numerically stable than keeping raw sums of squares.
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.m2_x = 0.0
+        self.m2_y = 0.0
+        self.c_xy = 0.0
+
+    def update(self, targets, predictions):
+        x = _to_numpy(targets).astype(np.float64).reshape(-1)
+        y = _to_numpy(predictions).astype(np.float64).reshape(-1)
+        n_b = x.size
+        if not n_b:
+            return
+        mean_x_b, mean_y_b = x.mean(), y.mean()
+        dx, dy = x - mean_x_b, y - mean_y_b
+
+        n = self.n + n_b
+        delta_x = mean_x_b - self.mean_x
+        delta_y = mean_y_b - self.mean_y
+        weight = self.n * n_b / n
+
+        self.m2_x += np.dot(dx, dx) + delta_x ** 2 * weight
+        self.m2_y += np.dot(dy, dy) + delta_y ** 2 * weight
+        self.c_xy += np.dot(dx, dy) + delta_x * delta_y * weight
+        self.mean_x += delta_x * n_b / n
+        self.mean_y += delta_y * n_b / n
+        self.n = n
+
+    def result(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = self.c_xy / np.sqrt(self.m2_x * self.m2_y)
+        return _nan_to_zero(100 * np.clip(r, -1.0, 1.0))
+
+
+class SpearmanAccumulator(object):
+    # Ranks depend on all of the values, so we have to buffer them.
+
+    def __init__(self):
+        self._targets = []
+        self._predictions = []
+
+    def update(self, targets, predictions):
+        self._targets.append(_to_numpy(targets).astype(np.float64).reshape(-1))
+        self._predictions.append(_to_numpy(predictions).astype(np.float64).reshape(-1))
+
+    def result(self):
+        if not self._targets:
+            return 0.0
+        target_ranks = scipy.stats.rankdata(np.concatenate(self._targets))
+        prediction_ranks = scipy.stats.rankdata(np.concatenate(self._predictions))
+        pearson = PearsonAccumulator()
+        pearson.update(target_ranks, prediction_ranks)
+        return pearson.result()
+
+
+###############################################################################
+
+
+class StreamingMetrics(object):
+    """Computes a set of metrics from batches of targets and predictions.
+
+    Use as:
+        streaming = StreamingMetrics([ACCURACY, F1, MATTHEWS_CORRCOEF])
+        for targets, predictions in ...:
+            streaming.update(targets, predictions)
+        results = streaming.result()
+    """
+
+    def __init__(self, metric_names):
+        for name in metric_names:
+            if name not in _RESULT_NAMES:
+                raise ValueError(f"Unrecognized streaming metric {name}.")
+        self.metric_names = tuple(metric_names)
+
+        self._confusion = None
+        self._confusion_with_invalid = None
+        self._pearson = None
+        self._spearman = None
+
+        if _CONFUSION_METRICS & set(self.metric_names):
+            self._confusion = ConfusionMatrix()
+        if F1_WITH_INVALID in self.metric_names:
+            self._confusion_with_invalid = ConfusionMatrix()
+        if PEARSON_CORRCOEF in self.metric_names:
+            self._pearson = PearsonAccumulator()
+        if SPEARMAN_CORRCOEF in self.metric_names:
+            self._spearman = SpearmanAccumulator()
+
+    def update(self, targets, predictions):
+        targets = _to_numpy(targets)
+        predictions = _to_numpy(predictions)
+        if self._confusion:
+            self._confusion.update(targets, predictions)
+        if self._confusion_with_invalid:
+            # Any prediction != 0 or 1 is counted as wrong.
+            invalid = np.logical_and(predictions != 0, predictions != 1)
+            valid_predictions = np.where(invalid, 1 - targets, predictions)
+            self._confusion_with_invalid.update(targets, valid_predictions)
+        if self._pearson:
+            self._pearson.update(targets, predictions)
+        if self._spearman:
+            self._spearman.update(targets, predictions)
+
+    def compute(self, name):
+        if name == ACCURACY:
+            return self._confusion.accuracy()
+        elif name == F1:
+            return self._confusion.binary_f1()
+        elif name == F1_WITH_INVALID:
+            return self._confusion_with_invalid.binary_f1()
+        elif name == MICRO_F1:
+            return self._confusion.micro_f1()
+        elif name == MACRO_F1:
+            return self._confusion.macro_f1()
+        elif name == MACRO_F1_1:
+            return self._confusion.macro_f1_1()
+        elif name == MACRO_F1_2:
+            return self._confusion.macro_f1_2()
+        elif name == MATTHEWS_CORRCOEF:
+            return self._confusion.matthews_corrcoef()
+        elif name == PEARSON_CORRCOEF:
+            return self._pearson.result()
+        elif name == SPEARMAN_CORRCOEF:
+            return self._spearman.result()
+        raise ValueError(f"Unrecognized streaming metric {name}.")
+
+    def result(self):
+        # NOTE: Like calling the `metrics.py` functions with `return_dict=True` and
+        # merging the dicts, later metrics overwrite earlier ones with the same
+        # result name (e.g. the f1 variants).
+        return {_RESULT_NAMES[name]: self.compute(name) for name in self.metric_names}
+
+
+def create_streaming_metrics(metrics):
+    """Returns StreamingMetrics for the `metrics` that have a streaming version.
+
+    Returns None if none of them do.
+    """
+    metric_names = [get_streaming_metric_name(m) for m in metrics]
+    metric_names = [n for n in metric_names if n is not None]
+    return StreamingMetrics(metric_names) if metric_names else None
+
+
+def compute_metrics(targets, predictions, metrics, streaming=None):
+    """Drop-in replacement for calling each of the `metrics` and merging the results.
+
+    Metrics from `metrics.py` that have a streaming version share a single pass
+    over the data. Any others are called as usual.
+
+    If provided, `streaming` must be what `create_streaming_metrics(metrics)`
+    returned, already updated batch by batch with the targets and predictions.
+    Otherwise we update fresh StreamingMetrics with all of the data at once.
+    """
+    if streaming is None:
+        streaming = create_streaming_metrics(metrics)
+        if streaming:
+            streaming.update(targets, predictions)
+
+    results = {}
+    for metric in metrics:
+        name = get_streaming_metric_name(metric)
+        if name is None:
+            results.update(metric(targets, predictions, return_dict=True))
+        else:
+            results[_RESULT_NAMES[name]] = streaming.compute(name)
+    return results
@@ -0,0 +1,157 @@
+"""Tests that the streaming metrics match sklearn and scipy."""
+from absl.testing import absltest
+
+import numpy as np
+import scipy.stats
+import sklearn.metrics
+
+from del8.executables.evaluation import streaming_metrics as sm
+
+
+def _update_in_batches(streaming, targets, predictions, batch_size):
+    for start in range(0, len(targets), batch_size):
+        end = start + batch_size
+        streaming.update(targets[start:end], predictions[start:end])
+    return streaming
+
+
+class StreamingMetricsTest(absltest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.rng = np.random.RandomState(0)
+
+    def assertMatchesInBatches(self, name, targets, predictions, expected):
+        for batch_size in [1, 7, 64, len(targets)]:
+            streaming = _update_in_batches(
+                sm.StreamingMetrics([name]), targets, predictions, batch_size
+            )
+            self.assertAlmostEqual(streaming.compute(name), expected, places=6)
+
+    def test_accuracy(self):
+        targets = self.rng.randint(0, 5, size=200)
+        predictions = self.rng.randint(0, 5, size=200)
+        expected = 100 * sklearn.metrics.accuracy_score(targets, predictions)
+        self.assertMatchesInBatches(sm.ACCURACY, targets, predictions, expected)
+
+    def test_binary_f1(self):
+        targets = self.rng.randint(0, 2, size=200)
+        predictions = self.rng.randint(0, 2, size=200)
+        expected = 100 * sklearn.metrics.f1_score(targets, predictions)
+        self.assertMatchesInBatches(sm.F1, targets, predictions, expected)
+
+    def test_binary_f1_without_positives(self):
+        targets = np.zeros([50], dtype=np.int64)
+        predictions = np.zeros([50], dtype=np.int64)
+        expected = 100 * sklearn.metrics.f1_score(
+            targets, predictions, zero_division=0
+        )
+        self.assertMatchesInBatches(sm.F1, targets, predictions, expected)
+
+    def test_binary_f1_rejects_multiclass(self):
+        streaming = sm.StreamingMetrics([sm.F1])
+        streaming.update([0, 1, 2], [0, 1, 1])
+        with self.assertRaises(ValueError):
+            streaming.compute(sm.F1)
+
+    def test_macro_f1(self):
+        targets = self.rng.randint(0, 4, size=200)
+        # Class 4 only ever gets predicted.
+        predictions = self.rng.randint(0, 5, size=200)
+        expected = 100 * sklearn.metrics.f1_score(
+            targets, predictions, average="macro", zero_division=0
+        )
+        self.assertMatchesInBatches(sm.MACRO_F1, targets, predictions, expected)
+
+    def test_matthews_corrcoef(self):
+        targets = self.rng.randint(0, 3, size=200)
+        predictions = np.where(
+            self.rng.rand(200) < 0.7, targets, self.rng.randint(0, 3, size=200)
+        )
+        expected = 100 * sklearn.metrics.matthews_corrcoef(targets, predictions)
+        self.assertMatchesInBatches(
+            sm.MATTHEWS_CORRCOEF, targets, predictions, expected
+        )
+
+    def test_matthews_corrcoef_constant_predictions(self):
+        targets = self.rng.randint(0, 2, size=50)
+        predictions = np.ones([50], dtype=np.int64)
+        self.assertMatchesInBatches(sm.MATTHEWS_CORRCOEF, targets, predictions, 0.0)
+
+    def test_pearson_corrcoef(self):
+        targets = self.rng.rand(300) * 5
+        predictions = targets + self.rng.randn(300)
+        expected = 100 * scipy.stats.pearsonr(targets, predictions)[0]
+        self.assertMatchesInBatches(
+            sm.PEARSON_CORRCOEF, targets, predictions, expected
+        )
+
+    def test_spearman_corrcoef(self):
+        # Rounding gives us plenty of ties.
+        targets = np.round(self.rng.rand(300) * 5)
+        predictions = np.round(targets + self.rng.randn(300))
+        expected = 100 * scipy.stats.spearmanr(targets, predictions)[0]
+        self.assertMatchesInBatches(
+            sm.SPEARMAN_CORRCOEF, targets, predictions, expected
+        )
+
+    def test_negative_labels(self):
+        # Labels like -1 used for padding count as a class of their own, like
+        # they do in sklearn.
+        targets = self.rng.randint(-1, 3, size=200)
+        predictions = self.rng.randint(-2, 3, size=200)
+        self.assertMatchesInBatches(
+            sm.ACCURACY,
+            targets,
+            predictions,
+            100 * sklearn.metrics.accuracy_score(targets, predictions),
+        )
+        self.assertMatchesInBatches(
+            sm.MACRO_F1,
+            targets,
+            predictions,
+            100
+            * sklearn.metrics.f1_score(
+                targets, predictions, average="macro", zero_division=0
+            ),
+        )
+        self.assertMatchesInBatches(
+            sm.MATTHEWS_CORRCOEF,
+            targets,
+            predictions,
+            100 * sklearn.metrics.matthews_corrcoef(targets, predictions),
+        )
+
+    def test_labels_appearing_in_later_batches(self):
+        confusion = sm.ConfusionMatrix()
+        confusion.update([0, 1], [1, 1])
+        confusion.update([3, -1], [3, 0])
+        self.assertEqual(confusion.min_label, -1)
+        self.assertEqual(confusion.max_label, 3)
+        self.assertEqual(confusion.matrix.sum(), 4)
+        self.assertAlmostEqual(confusion.accuracy(), 50.0)
+
+    def test_several_metrics_share_updates(self):
+        targets = self.rng.randint(0, 2, size=100)
+        predictions = self.rng.randint(0, 2, size=100)
+        streaming = _update_in_batches(
+            sm.StreamingMetrics([sm.ACCURACY, sm.F1, sm.MATTHEWS_CORRCOEF]),
+            targets,
+            predictions,
+            batch_size=16,
+        )
+        results = streaming.result()
+        self.assertAlmostEqual(
+            results["accuracy"],
+            100 * sklearn.metrics.accuracy_score(targets, predictions),
+        )
+        self.assertAlmostEqual(
+            results["f1"], 100 * sklearn.metrics.f1_score(targets, predictions)
+        )
+        self.assertAlmostEqual(
+            results["matthews_corrcoef"],
+            100 * sklearn.metrics.matthews_corrcoef(targets, predictions),
+        )
+
+
+if __name__ == "__main__":
+    absltest.main()
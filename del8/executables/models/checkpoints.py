@@ -92,6 +92,7 @@ def checkpoint_loader(
     # TODO: Add some kwargs for the load_weights (by_name=False, skip_mismatch=False, options=None)
     # once I support "protected" bindings.
     logging.info(f"Loading checkpoint {checkpoint}")
-    with storage.retrieve_blob_as_tempfile(checkpoint) as f:
-        model.load_weights(f.name, by_name=load_checkpoint_weights_by_name)
+    # NOTE: This avoids copying the checkpoint if the storage has it cached locally.
+    with storage.retrieve_blob_as_readonly_path(checkpoint) as filepath:
+        model.load_weights(filepath, by_name=load_checkpoint_weights_by_name)
     return model
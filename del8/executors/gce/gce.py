@@ -62,6 +62,10 @@ class GceParams(object):
         supervisor_main=DEFAULT_SUPERVISOR_MAIN,
         supervisor_logs_dir="~/del8_supervisor_logs",
         logs_bucket="del8_logs",
+        # If provided, the del8 tarball and the serialized execution items get
+        # uploaded here and the startup script fetches them instead of having them
+        # inlined. Should be the params of an artifact store from `artifact_util`.
+        artifact_store_params=None,
     ):
         self.private_ssh_key_path = os.path.expanduser(self.private_ssh_key_path)
         self.public_ssh_key_path = os.path.expanduser(self.public_ssh_key_path)
@@ -104,12 +108,32 @@ def _create_base_exit_logger_params(gce_params):
     )
 
 
+def _file_content_to_bash_command(content_b64, dst, artifact_store=None):
+    if artifact_store:
+        return artifact_store.put_and_fetch_command(
+            content_b64.encode("utf-8"), dst, suffix=".b64"
+        )
+    script = [
+        f"CONTENT_B64='{content_b64}'",
+        f"echo $CONTENT_B64 > {dst}",
+    ]
+    return "\n".join(script)
+
+
 def _add_start_supervisor_script(
-    execution_items, executor_params, launch_params, instance_name
+    execution_items, executor_params, launch_params, instance_name, artifact_store=None
 ):
     on_start_cmd = executor_params.create_onstart_cmd()
     executor_params = executor_params.copy(entire_on_start_cmd=on_start_cmd)
 
+    # The supervisor only gets serialized items, so any scheduling policy has to
+    # order them here. The supervisor then just runs them in order.
+    if getattr(executor_params, "scheduling_policy", None):
+        scheduling_policy = executor_params.scheduling_policy
+        execution_items = scheduling_policy.order_items(execution_items)
+        scheduling_policy.log_schedule(execution_items, executor_params.num_workers)
+        executor_params = executor_params.copy(scheduling_policy=None)
+
     # We serialize each execution item so that we can pass the string to the
     # worker on the supervisor. Thus we do not need to download experiment's
     # dependencies on the supervisor.
@@ -136,11 +160,12 @@ def _add_start_supervisor_script(
     ]
     cmd = " ".join(cmd)
     script = [
-        f"EXE_ITEMS_B64='{execution_items}'",
-        "echo $EXE_ITEMS_B64 > ~/.execution_items",
-        #
-        f"EXE_PARAMS_B64='{executor_params}'",
-        "echo $EXE_PARAMS_B64 > ~/.execution_params",
+        _file_content_to_bash_command(
+            execution_items, "$HOME/.execution_items", artifact_store=artifact_store
+        ),
+        # NOTE: The executor params are always inlined. Their on-start command holds
+        # the GCP credentials, which must not be uploaded behind a signed URL.
+        _file_content_to_bash_command(executor_params, "$HOME/.execution_params"),
         #
         f"mkdir -p {logs_dir}",
         cmd,
@@ -157,6 +182,10 @@ def launch(execution_items, executor_params, launch_params):
             base_exit_logger_params=_create_base_exit_logger_params(launch_params)
         )
 
+    artifact_store = None
+    if launch_params.artifact_store_params:
+        artifact_store = launch_params.artifact_store_params.instantiate_store()
+
     script = [
         "#!/bin/bash",
         # I think we need the sudo apt-get update twice for whatever reason.
@@ -182,10 +211,16 @@ def launch(execution_items, executor_params, launch_params):
         f"ssh-add ~/.ssh/{os.path.basename(launch_params.private_ssh_key_path)}",
         project_util.file_to_bash_command(launch_params.vast_api_key_file),
         #
-        project_util.python_project_to_bash_command(project_util.DEL8_PROJECT),
+        project_util.python_project_to_bash_command(
+            project_util.DEL8_PROJECT, artifact_store=artifact_store
+        ),
         #
         _add_start_supervisor_script(
-            execution_items, executor_params, launch_params, instance_name=instance_name
+            execution_items,
+            executor_params,
+            launch_params,
+            instance_name=instance_name,
+            artifact_store=artifact_store,
         ),
     ]
     deploy = MultiStepDeployment(
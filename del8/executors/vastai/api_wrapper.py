@@ -1,6 +1,8 @@
 """Wrapper around the Vast API for better use within the executor code."""
+from concurrent import futures
 import functools
 import random
+import threading
 import time
 import uuid as uuidlib
 
@@ -19,12 +21,18 @@ _http_500_backoff = functools.partial(
     backoffs.linear_to_exp_backoff,
     exceptions_to_catch=(requests.exceptions.HTTPError,),
     should_retry_on_exception_fn=lambda e: 500 <= e.response.status_code < 600,
+    # Lots of threads hit the API at once, so keep them from retrying in lockstep.
+    jitter=backoffs.Jitter.DECORRELATED,
 )
 
 
 ##############################################################################
 
 
+class InstanceNotFoundError(Exception):
+    pass
+
+
 def _new_uuid():
     return uuidlib.uuid4().hex
 
@@ -53,6 +61,17 @@ class VastOffer(object):
     def get_instance_id(self):
         return self["id"]
 
+    def get_dollars_per_hour(self):
+        return self._json.get("dph_total")
+
+    def get_score(self):
+        # Higher is better. Deep learning performance per dollar per hour.
+        if self._json.get("dlperf_per_dphtotal") is not None:
+            return self["dlperf_per_dphtotal"]
+        dlperf = self._json.get("dlperf") or 0.0
+        dph_total = self._json.get("dph_total")
+        return dlperf / dph_total if dph_total else 0.0
+
 
 @_json_wrapper
 class VastInstance(object):
@@ -97,17 +116,28 @@ def query_offers(vast_params):
     return [VastOffer(r) for r in results]
 
 
+def rank_offers(offers, score_fn=None):
+    # Returns the offers sorted from best to worst.
+    if score_fn is None:
+        score_fn = VastOffer.get_score
+    return sorted(offers, key=score_fn, reverse=True)
+
+
 @_http_500_backoff()
 def create_instance(
     instance_id,
     vast_params,
+    # If None, we create it from the vast_params. Creating it can be slow, so pass
+    # it in when creating many instances.
+    onstart_cmd=None,
 ) -> str:
     """Returns the uuid of the instance. Note this is different than the instance id."""
     # It looks like the instance id changes from the offer to the instance,
     # so we use the label for tracking.
     uuid = _new_uuid()
 
-    onstart_cmd = vast_params.create_onstart_cmd()
+    if onstart_cmd is None:
+        onstart_cmd = vast_params.create_onstart_cmd()
 
     response = vast_api.create_instance(
         instance_id,
@@ -141,7 +171,107 @@ def get_instance_by_uuid(instance_uuid):
     for instance in get_all_instances(no_backoff=True):
         if instance.get_uuid() == instance_uuid:
             return instance
-    raise Exception(f"Instance with uuid {instance_uuid} not found.")
+    raise InstanceNotFoundError(f"Instance with uuid {instance_uuid} not found.")
+
+
+class InstanceSnapshots(object):
+    """Serves instance statuses from a periodically refreshed listing of all instances.
+
+    Looking up an instance through `get_instance_by_uuid` lists all of our instances,
+    so polling the statuses of many workers that way quickly gets us rate limited.
+    Here we list the instances at most once per `refresh_interval_secs`, no matter
+    how many threads are asking. Threads that ask while a refresh is in progress
+    wait on it instead of starting their own.
+
+    Thread-safe.
+    """
+
+    def __init__(self, refresh_interval_secs=10, min_refresh_interval_secs=2):
+        self.refresh_interval_secs = refresh_interval_secs
+        # A lookup of an uuid not in the snapshot can force an early refresh, e.g.
+        # for a newly created instance. We never refresh more often than this, though.
+        self.min_refresh_interval_secs = min_refresh_interval_secs
+
+        self._lock = threading.Lock()
+        self._instances_by_uuid = {}
+        # This is the time when the refresh started, so it is conservative.
+        self._snapshot_time = None
+        self._etag = None
+        self._last_modified = None
+        self._refresh_future = None
+
+    def _snapshot_age(self):
+        if self._snapshot_time is None:
+            return float("inf")
+        return time.time() - self._snapshot_time
+
+    @_http_500_backoff()
+    def _fetch_instances(self):
+        rows, etag, last_modified = vast_api.get_instances_if_modified(
+            etag=self._etag, last_modified=self._last_modified
+        )
+        if rows is None:
+            return None, etag, last_modified
+        instances = [VastInstance(row) for row in rows]
+        return {inst.get_uuid(): inst for inst in instances}, etag, last_modified
+
+    def _refresh(self):
+        # Returns the uuid to instance dict after the refresh.
+        with self._lock:
+            if self._refresh_future is None:
+                future = futures.Future()
+                self._refresh_future = future
+                is_owner = True
+            else:
+                future = self._refresh_future
+                is_owner = False
+
+        if not is_owner:
+            return future.result()
+
+        start_time = time.time()
+        try:
+            instances_by_uuid, etag, last_modified = self._fetch_instances()
+        except BaseException as e:
+            with self._lock:
+                self._refresh_future = None
+            future.set_exception(e)
+            raise e
+
+        with self._lock:
+            if instances_by_uuid is not None:
+                self._instances_by_uuid = instances_by_uuid
+            self._etag = etag
+            self._last_modified = last_modified
+            self._snapshot_time = start_time
+            self._refresh_future = None
+            instances_by_uuid = self._instances_by_uuid
+        future.set_result(instances_by_uuid)
+        return instances_by_uuid
+
+    def get_instance_by_uuid(self, instance_uuid):
+        with self._lock:
+            age = self._snapshot_age()
+            instances_by_uuid = self._instances_by_uuid
+
+        if age >= self.refresh_interval_secs:
+            instances_by_uuid = self._refresh()
+        elif (
+            instance_uuid not in instances_by_uuid
+            and age >= self.min_refresh_interval_secs
+        ):
+            instances_by_uuid = self._refresh()
+
+        if instance_uuid not in instances_by_uuid:
+            raise InstanceNotFoundError(
+                f"Instance with uuid {instance_uuid} not found."
+            )
+        return instances_by_uuid[instance_uuid]
+
+    def invalidate(self):
+        # Forces the next lookup to refresh the snapshot.
+        with self._lock:
+            self._snapshot_time = None
 
 
 @_http_500_backoff()
@@ -0,0 +1,152 @@
+"""Elastic scaling of the number of Vast workers based on the queue depth."""
+import collections
+import json
+import math
+import threading
+import time
+
+from absl import logging
+
+from del8.core import data_class
+
+
+@data_class.data_class()
+class AutoscalerParams(object):
+    def __init__(
+        self,
+        max_workers: int,
+        min_workers: int = 1,
+        # How often the autoscaler makes a scaling decision.
+        interval_secs=60,
+        # We want enough workers to finish the remaining items within about this
+        # long. Smaller values trade money for time.
+        target_drain_secs=60 * 60,
+        # Caps the total $/hr of our workers if provided.
+        max_dollars_per_hour=None,
+        # Limits how many workers get launched in a single decision.
+        max_launches_per_interval=4,
+        # Completions within this window are used to measure the throughput.
+        throughput_window_secs=30 * 60,
+    ):
+        pass
+
+    def instantiate_autoscaler(self, initial_num_workers):
+        return Autoscaler(self, initial_num_workers)
+
+
+class Autoscaler(object):
+    """Decides how many workers we should have.
+
+    Until some items complete, we do not know how long items take. We then just
+    try to keep the initial number of workers, which replaces workers that die.
+    Afterwards, we want enough workers to get through the remaining items in
+    about `target_drain_secs`. As the remaining work shrinks, this number goes
+    down and we scale down early rather than waiting for the queue to empty.
+
+    Each decision gets logged as a single line of JSON prefixed by
+    "Autoscaler decision: ".
+    """
+
+    def __init__(self, params, initial_num_workers):
+        self._params = params
+        self._initial_num_workers = initial_num_workers
+
+        self._lock = threading.Lock()
+        self._completion_times = collections.deque()
+        self._last_decision_time = None
+
+        self.target_num_workers = initial_num_workers
+
+    def record_completion(self):
+        # Can be called from any thread.
+        with self._lock:
+            self._completion_times.append(time.time())
+
+    def _get_throughput_per_hour(self):
+        # Completed items per hour over the recent window.
+        window_secs = self._params.throughput_window_secs
+        now = time.time()
+        with self._lock:
+            while self._completion_times and (
+                now - self._completion_times[0] > window_secs
+            ):
+                self._completion_times.popleft()
+            num_completed = len(self._completion_times)
+        return 3600.0 * num_completed / window_secs
+
+    def is_decision_due(self):
+        if self._last_decision_time is None:
+            return True
+        return time.time() - self._last_decision_time >= self._params.interval_secs
+
+    def _get_unclipped_target(self, num_remaining, expected_item_secs):
+        if expected_item_secs is None:
+            return self._initial_num_workers
+        remaining_work_secs = num_remaining * expected_item_secs
+        return math.ceil(remaining_work_secs / self._params.target_drain_secs)
+
+    def decide(
+        self,
+        *,
+        num_pending,
+        num_running,
+        num_workers,
+        expected_item_secs,
+        dollars_per_hour_per_worker,
+    ):
+        """Returns the number of workers to launch.
+
+        Scaling down is done lazily. Idle workers should be killed while there
+        are more than `target_num_workers` of them.
+        """
+        self._last_decision_time = time.time()
+        params = self._params
+
+        num_remaining = num_pending + num_running
+        target = self._get_unclipped_target(num_remaining, expected_item_secs)
+        target = min(max(target, params.min_workers), params.max_workers)
+
+        max_workers_for_cost = None
+        if params.max_dollars_per_hour is not None and dollars_per_hour_per_worker:
+            max_workers_for_cost = math.floor(
+                params.max_dollars_per_hour / dollars_per_hour_per_worker
+            )
+            target = min(target, max_workers_for_cost)
+
+        # Workers without an item to run are a waste. We still keep one around
+        # while there is something left to run.
+        target = min(target, num_remaining)
+        if num_remaining:
+            target = max(target, 1)
+        self.target_num_workers = target
+
+        num_to_launch = min(
+            max(target - num_workers, 0), params.max_launches_per_interval
+        )
+
+        self._log_decision(
+            num_pending=num_pending,
+            num_running=num_running,
+            num_workers=num_workers,
+            target_num_workers=target,
+            num_to_launch=num_to_launch,
+            num_to_kill=max(num_workers - target, 0),
+            expected_item_secs=expected_item_secs,
+            per_worker_items_per_hour=(
+                3600.0 / expected_item_secs if expected_item_secs else None
+            ),
+            observed_items_per_hour=self._get_throughput_per_hour(),
+            dollars_per_hour_per_worker=dollars_per_hour_per_worker,
+            dollars_per_hour=(
+                num_workers * dollars_per_hour_per_worker
+                if dollars_per_hour_per_worker
+                else None
+            ),
+            max_workers_for_cost=max_workers_for_cost,
+        )
+
+        return num_to_launch
+
+    def _log_decision(self, **record):
+        record["time"] = self._last_decision_time
+        logging.info(f"Autoscaler decision: {json.dumps(record, sort_keys=True)}")
@@ -64,8 +64,15 @@ def create_onstart_cmd(vast_params):
         script.append(_add_storage_startup(storage_params))
 
     # project stuff
+    artifact_store = None
+    if vast_params.artifact_store_params:
+        artifact_store = vast_params.artifact_store_params.instantiate_store()
     for project in instance_params.project_params:
-        script.append(project_util.python_project_to_bash_command(project))
+        script.append(
+            project_util.python_project_to_bash_command(
+                project, artifact_store=artifact_store
+            )
+        )
 
     if instance_params.extra_onstart_cmd:
         script.append(instance_params.extra_onstart_cmd)
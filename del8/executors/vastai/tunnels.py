@@ -0,0 +1,124 @@
+"""Persistent SSH tunnels to Vast AI workers."""
+from multiprocessing import connection
+import threading
+
+from absl import logging
+import sshtunnel
+
+
+class TunnelFailedException(Exception):
+    pass
+
+
+class WorkerTunnel(object):
+    """SSH tunnel to a single worker that outlives connections through it.
+
+    The paramiko transport is kept alive with keepalives and only gets rebuilt
+    if it dies. Thus a broken connection to the worker can be re-established
+    without going through the SSH handshake again.
+    """
+
+    def __init__(
+        self, ssh_address, remote_port, compression=False, keepalive_secs=15.0
+    ):
+        self._ssh_address = ssh_address
+        self._remote_port = remote_port
+        self._compression = compression
+        self._keepalive_secs = keepalive_secs
+
+        self._lock = threading.Lock()
+        self._forwarder = None
+
+    def _is_up(self):
+        if not self._forwarder:
+            return False
+        self._forwarder.check_tunnels()
+        if not self._forwarder.is_active or not self._forwarder.is_alive:
+            return False
+        if not self._forwarder.tunnel_is_up[
+            (self._forwarder.local_bind_host, self._forwarder.local_bind_port)
+        ]:
+            logging.debug("Tunnel is active and alive but does not appear to be up.")
+            return False
+        return True
+
+    def _stop_forwarder(self):
+        if self._forwarder:
+            self._forwarder.stop()
+            self._forwarder = None
+
+    def _start_forwarder(self):
+        # Make sure that we do not leak the threads of a dead forwarder.
+        self._stop_forwarder()
+        self._forwarder = sshtunnel.SSHTunnelForwarder(
+            self._ssh_address,
+            remote_bind_address=("127.0.0.1", self._remote_port),
+            ssh_username="root",
+            compression=self._compression,
+            #
+            # mute_exceptions=False,
+            mute_exceptions=True,
+            #
+            # This is in seconds.
+            set_keepalive=self._keepalive_secs,
+        )
+        self._forwarder.start()
+
+    def ensure_up(self):
+        with self._lock:
+            if self._is_up():
+                return
+            self._start_forwarder()
+            if not self._is_up():
+                raise TunnelFailedException(
+                    "Failed to create SSH tunnel to VastAI worker."
+                )
+
+    def connect(self):
+        """Returns a new connection to the worker, rebuilding the tunnel if needed."""
+        self.ensure_up()
+        return connection.Client(("127.0.0.1", self._forwarder.local_bind_port))
+
+    def close(self):
+        with self._lock:
+            self._stop_forwarder()
+
+
+class TunnelManager(object):
+    """Owns the tunnels to all of the workers of a supervisor.
+
+    Thread-safe.
+    """
+
+    def __init__(self, compression=False, keepalive_secs=15.0):
+        self._compression = compression
+        self._keepalive_secs = keepalive_secs
+
+        self._lock = threading.Lock()
+        self._tunnels = {}
+
+    def get_tunnel(self, ssh_address, remote_port):
+        key = (tuple(ssh_address), remote_port)
+        with self._lock:
+            if key not in self._tunnels:
+                self._tunnels[key] = WorkerTunnel(
+                    ssh_address,
+                    remote_port,
+                    compression=self._compression,
+                    keepalive_secs=self._keepalive_secs,
+                )
+            return self._tunnels[key]
+
+    def close_tunnel(self, ssh_address, remote_port):
+        key = (tuple(ssh_address), remote_port)
+        with self._lock:
+            tunnel = self._tunnels.pop(key, None)
+        if tunnel:
+            tunnel.close()
+
+    def close(self):
+        with self._lock:
+            tunnels = list(self._tunnels.values())
+            self._tunnels.clear()
+        for tunnel in tunnels:
+            tunnel.close()
@@ -1,10 +1,8 @@
 """My modified version of the vast.py file for better access from within python."""
-import json
 import re
-import requests
 import os
-from urllib.parse import quote_plus
 
+from . import client as client_lib
 from . import constants as C
 
 
@@ -124,24 +122,6 @@ def _get_api_key():
         return reader.read().strip()
 
 
-def _apiurl(subpath, query_args=None):
-    if query_args is None:
-        query_args = {}
-    if "api_key" not in query_args:
-        query_args["api_key"] = _get_api_key()
-    return (
-        C.SERVER_URL_DEFAULT
-        + subpath
-        + "?"
-        + "&".join(
-            "{x}={y}".format(
-                x=x, y=quote_plus(y if isinstance(y, str) else json.dumps(y))
-            )
-            for x, y in query_args.items()
-        )
-    )
-
-
 def search_offers(
     query_str,
     order_str,
@@ -149,6 +129,7 @@ def search_offers(
     use_defaults=True,
     offer_type="on-demand",
     disable_bundling=True,
+    client=None,
 ):
     if use_defaults:
         query = {
@@ -165,8 +146,8 @@ def search_offers(
     if disable_bundling:
         query["disable_bundling"] = True
 
-    url = _apiurl("/bundles", {"q": query})
-    r = requests.get(url)
+    client = client or client_lib.get_default_client()
+    r = client.get("/bundles", {"q": query})
     r.raise_for_status()
     rows = r.json()["offers"]
     return rows
@@ -176,11 +157,17 @@ def search_offers(
 
 
 def create_instance(
-    instance_id, *, disk_gb: int, image: str, onstart_cmd: str = None, label: str = None
+    instance_id,
+    *,
+    disk_gb: int,
+    image: str,
+    onstart_cmd: str = None,
+    label: str = None,
+    client=None,
 ):
-    url = _apiurl(f"/asks/{instance_id}/")
-    r = requests.put(
-        url,
+    client = client or client_lib.get_default_client()
+    r = client.put(
+        f"/asks/{instance_id}/",
         json={
             "client_id": "me",
             "image": image,
@@ -197,19 +184,44 @@ def create_instance(
 ###############################################################################
 
 
-def get_instances(owner: str = "me"):
-    req_url = _apiurl("/instances", {"owner": owner})
-    r = requests.get(req_url)
+def get_instances(owner: str = "me", *, client=None):
+    client = client or client_lib.get_default_client()
+    r = client.get("/instances", {"owner": owner})
     r.raise_for_status()
     rows = r.json()["instances"]
     return rows
 
 
+def get_instances_if_modified(
+    owner: str = "me", *, etag: str = None, last_modified: str = None, client=None
+):
+    """Conditional version of `get_instances`.
+
+    Returns a tuple `(rows, etag, last_modified)`. The rows are None if the server
+    says that nothing changed since the response with the given etag or
+    last_modified. Servers that do not support conditional requests will just
+    always send the rows.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    client = client or client_lib.get_default_client()
+    r = client.get("/instances", {"owner": owner}, headers=headers)
+    if r.status_code == 304:
+        return None, etag, last_modified
+    r.raise_for_status()
+    rows = r.json()["instances"]
+    return rows, r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+
 ###############################################################################
 
 
-def destroy_instance(instance_id):
-    url = _apiurl(f"/instances/{instance_id}/")
-    r = requests.delete(url, json={})
+def destroy_instance(instance_id, *, client=None):
+    client = client or client_lib.get_default_client()
+    r = client.delete(f"/instances/{instance_id}/", json={})
     r.raise_for_status()
     return r.json()
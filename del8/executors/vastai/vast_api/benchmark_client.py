@@ -0,0 +1,69 @@
+"""Benchmarks the shared vast API client against a local fake server.
+
+Run as `python -m del8.executors.vastai.vast_api.benchmark_client`.
+"""
+from concurrent import futures
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from del8.executors.vastai.vast_api import api
+from del8.executors.vastai.vast_api import fake_server as fake_server_lib
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer("num_threads", 64, "")
+flags.DEFINE_integer("num_calls_per_thread", 20, "")
+flags.DEFINE_float("latency_secs", 0.05, "")
+
+
+def benchmark_get_instances(
+    fake_server, client, num_threads=64, num_calls_per_thread=20
+):
+    """Returns the number of requests that reached the server and the calls/sec."""
+    path = ("GET", "/instances")
+    start_count = fake_server.request_counts[path]
+
+    def call():
+        for _ in range(num_calls_per_thread):
+            api.get_instances(client=client)
+
+    start_time = time.time()
+    with futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for future in [pool.submit(call) for _ in range(num_threads)]:
+            future.result()
+    elapsed_secs = time.time() - start_time
+
+    num_calls = num_threads * num_calls_per_thread
+    num_requests = fake_server.request_counts[path] - start_count
+    return num_requests, num_calls / elapsed_secs
+
+
+def main(_):
+    instances = [
+        {"id": i, "label": f"label{i}", "actual_status": "running"} for i in range(100)
+    ]
+    with fake_server_lib.FakeVastServer(
+        instances=instances, latency_secs=FLAGS.latency_secs
+    ) as fs:
+        for coalesce_gets in [False, True]:
+            client = fs.create_client(
+                max_requests_per_sec=None, coalesce_gets=coalesce_gets
+            )
+            num_requests, calls_per_sec = benchmark_get_instances(
+                fs,
+                client,
+                num_threads=FLAGS.num_threads,
+                num_calls_per_thread=FLAGS.num_calls_per_thread,
+            )
+            logging.info(
+                f"coalesce_gets={coalesce_gets}: {num_requests} requests reached the "
+                f"server, {calls_per_sec:.1f} calls/sec."
+            )
+            client.close()
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,144 @@
+"""Shared HTTP client for the vast API.
+
+Many threads call the API at once. Routing them through a single client lets
+us keep connections alive, stay under a request rate instead of relying on
+backing off after 429s, and make a single request for identical GETs that are
+in flight at the same time.
+"""
+from concurrent import futures
+import json
+import threading
+from urllib.parse import quote_plus
+
+import requests
+from requests import adapters
+
+from del8.core.utils import backoffs
+
+from . import constants as C
+
+
+class VastClient(object):
+    """Thread-safe client for the vast API."""
+
+    def __init__(
+        self,
+        server_url=C.SERVER_URL_DEFAULT,
+        api_key=None,
+        # The rate limit is client-side and shared by all threads using the client.
+        # None means no limit.
+        max_requests_per_sec=C.DEFAULT_MAX_REQUESTS_PER_SEC,
+        max_burst_requests=C.DEFAULT_MAX_BURST_REQUESTS,
+        # Max number of connections to keep alive.
+        pool_maxsize=32,
+        # If True, identical GET requests made while one is in flight wait for
+        # it and share its response.
+        coalesce_gets=True,
+    ):
+        self.server_url = server_url
+        self._api_key = api_key
+        self._coalesce_gets = coalesce_gets
+
+        self._rate_limiter = None
+        if max_requests_per_sec is not None:
+            self._rate_limiter = backoffs.TokenBucket(
+                max_requests_per_sec, capacity=max_burst_requests
+            )
+
+        self._session = requests.Session()
+        adapter = adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        # Key of an in-flight GET to the future of its response.
+        self._in_flight_gets = {}
+
+    def _get_api_key(self):
+        if self._api_key is None:
+            # NOTE: Imported here to avoid a circular import.
+            from . import api
+
+            self._api_key = api._get_api_key()
+        return self._api_key
+
+    def url(self, subpath, query_args=None):
+        if query_args is None:
+            query_args = {}
+        if "api_key" not in query_args:
+            query_args["api_key"] = self._get_api_key()
+        return (
+            self.server_url
+            + subpath
+            + "?"
+            + "&".join(
+                "{x}={y}".format(
+                    x=x, y=quote_plus(y if isinstance(y, str) else json.dumps(y))
+                )
+                for x, y in query_args.items()
+            )
+        )
+
+    def _request(self, method, url, **kwargs):
+        if self._rate_limiter:
+            self._rate_limiter.acquire()
+        return self._session.request(method, url, **kwargs)
+
+    def get(self, subpath, query_args=None, headers=None):
+        url = self.url(subpath, query_args)
+        if not self._coalesce_gets:
+            return self._request("GET", url, headers=headers)
+
+        key = (url, tuple(sorted((headers or {}).items())))
+        with self._lock:
+            future = self._in_flight_gets.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = futures.Future()
+                self._in_flight_gets[key] = future
+
+        if not is_leader:
+            # NOTE: The response object is shared, so callers must not consume it
+            # as a stream.
+            return future.result()
+
+        try:
+            response = self._request("GET", url, headers=headers)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise e
+        finally:
+            with self._lock:
+                del self._in_flight_gets[key]
+
+    def put(self, subpath, query_args=None, **kwargs):
+        return self._request("PUT", self.url(subpath, query_args), **kwargs)
+
+    def delete(self, subpath, query_args=None, **kwargs):
+        return self._request("DELETE", self.url(subpath, query_args), **kwargs)
+
+    def close(self):
+        self._session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = VastClient()
+        return _default_client
+
+
+def set_default_client(client):
+    """Makes the functions in `api` use the client, e.g. one for a fake server."""
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
@@ -0,0 +1,130 @@
+"""Tests for the shared vast API client against the fake server."""
+from concurrent import futures
+import threading
+import time
+
+from absl.testing import absltest
+import requests
+
+from del8.executors.vastai.vast_api import api
+from del8.executors.vastai.vast_api import fake_server as fake_server_lib
+
+_INSTANCES = [
+    {"id": i, "label": f"label{i}", "actual_status": "running"} for i in range(5)
+]
+
+
+def _call_concurrently(fn, num_threads):
+    # Starts all of the calls at about the same time. Returns their results.
+    barrier = threading.Barrier(num_threads)
+
+    def call():
+        barrier.wait()
+        return fn()
+
+    with futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+        return [f.result() for f in [pool.submit(call) for _ in range(num_threads)]]
+
+
+class VastClientTest(absltest.TestCase):
+    def create_server(self, **kwargs):
+        kwargs.setdefault("instances", _INSTANCES)
+        fake_server = fake_server_lib.FakeVastServer(**kwargs)
+        fake_server.start()
+        self.addCleanup(fake_server.stop)
+        return fake_server
+
+    def create_client(self, fake_server, **kwargs):
+        client = fake_server.create_client(**kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_get_instances(self):
+        fake_server = self.create_server()
+        client = self.create_client(fake_server)
+        self.assertEqual(api.get_instances(client=client), _INSTANCES)
+
+    def test_create_and_destroy_instance(self):
+        fake_server = self.create_server(
+            offers=[{"id": 100, "dph_total": 0.5}], instances=()
+        )
+        client = self.create_client(fake_server)
+
+        response = api.create_instance(
+            100, disk_gb=10, image="image", label="my-label", client=client
+        )
+        (instance,) = api.get_instances(client=client)
+        self.assertEqual(instance["id"], response["new_contract"])
+        self.assertEqual(instance["label"], "my-label")
+
+        api.destroy_instance(instance["id"], client=client)
+        self.assertEqual(api.get_instances(client=client), [])
+
+    def test_rate_limit_spaces_out_requests(self):
+        fake_server = self.create_server()
+        client = self.create_client(
+            fake_server,
+            max_requests_per_sec=20,
+            max_burst_requests=1,
+            coalesce_gets=False,
+        )
+        start_time = time.time()
+        for _ in range(11):
+            api.get_instances(client=client)
+        # The first request uses the burst, and the next 10 are spaced 50ms apart.
+        self.assertGreaterEqual(time.time() - start_time, 0.45)
+
+    def test_rate_limit_keeps_server_from_rejecting_requests(self):
+        fake_server = self.create_server(max_requests_per_sec=10)
+        client = self.create_client(
+            fake_server,
+            max_requests_per_sec=8,
+            max_burst_requests=1,
+            coalesce_gets=False,
+        )
+        _call_concurrently(lambda: api.get_instances(client=client), num_threads=12)
+        self.assertEqual(fake_server.num_rate_limited, 0)
+        self.assertEqual(fake_server.request_counts[("GET", "/instances")], 12)
+
+    def test_server_rejects_requests_without_rate_limit(self):
+        fake_server = self.create_server(max_requests_per_sec=5)
+        client = self.create_client(
+            fake_server, max_requests_per_sec=None, coalesce_gets=False
+        )
+        with self.assertRaises(requests.exceptions.HTTPError):
+            for _ in range(10):
+                api.get_instances(client=client)
+        self.assertGreater(fake_server.num_rate_limited, 0)
+
+    def test_coalesces_concurrent_gets(self):
+        fake_server = self.create_server(latency_secs=0.5)
+        client = self.create_client(
+            fake_server, max_requests_per_sec=None, coalesce_gets=True
+        )
+        results = _call_concurrently(
+            lambda: api.get_instances(client=client), num_threads=16
+        )
+        self.assertTrue(all(r == _INSTANCES for r in results))
+        # The calls all start well within the latency of a single request.
+        self.assertLess(fake_server.request_counts[("GET", "/instances")], 16)
+
+    def test_does_not_coalesce_when_disabled(self):
+        fake_server = self.create_server(latency_secs=0.1)
+        client = self.create_client(
+            fake_server, max_requests_per_sec=None, coalesce_gets=False
+        )
+        _call_concurrently(lambda: api.get_instances(client=client), num_threads=8)
+        self.assertEqual(fake_server.request_counts[("GET", "/instances")], 8)
+
+    def test_does_not_coalesce_sequential_gets(self):
+        fake_server = self.create_server()
+        client = self.create_client(
+            fake_server, max_requests_per_sec=None, coalesce_gets=True
+        )
+        for _ in range(3):
+            api.get_instances(client=client)
+        self.assertEqual(fake_server.request_counts[("GET", "/instances")], 3)
+
+
+if __name__ == "__main__":
+    absltest.main()
@@ -7,6 +7,10 @@ SERVER_URL_DEFAULT = "https://vast.ai/api/v0"
 
 API_KEY_FILE_BASE = "~/.vast_api_key"
 
+# Client-side limit on the rate of requests to the API.
+DEFAULT_MAX_REQUESTS_PER_SEC = 10
+DEFAULT_MAX_BURST_REQUESTS = 20
+
 FIELD_ALIASES = {
     "cuda_vers": "cuda_max_good",
     "reliability": "reliability2",
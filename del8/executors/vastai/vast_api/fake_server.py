@@ -0,0 +1,177 @@
+"""Local HTTP server that replays vast API responses.
+
+Used to test and benchmark code calling the API without renting anything. See
+`benchmark_client.py` for benchmarking the shared client against the server.
+"""
+import collections
+from http import server
+import json
+import re
+import threading
+import time
+
+from . import client as client_lib
+
+
+class FakeVastServer(object):
+    """Serves recorded responses for the endpoints that we use.
+
+    The `offers` and `instances` are lists of JSON rows like the ones that the
+    real API returns, e.g. recorded from `api.search_offers` and
+    `api.get_instances`. Creating an instance from an offer adds a running
+    instance with the requested label, and destroying an instance removes it.
+
+    Thread-safe.
+    """
+
+    def __init__(
+        self,
+        offers=(),
+        instances=(),
+        # Each request takes at least this long to respond to.
+        latency_secs=0.0,
+        # If provided, requests past this rate get a 429 response.
+        max_requests_per_sec=None,
+        port=0,
+    ):
+        self._offers = [dict(o) for o in offers]
+        self._instances = [dict(i) for i in instances]
+        self._latency_secs = latency_secs
+        self._max_requests_per_sec = max_requests_per_sec
+
+        self._lock = threading.Lock()
+        self._request_times = collections.deque()
+        # Method and path to the number of requests made.
+        self.request_counts = collections.Counter()
+        self.num_rate_limited = 0
+
+        self._httpd = server.ThreadingHTTPServer(
+            ("127.0.0.1", port), self._create_handler_cls()
+        )
+        self._thread = None
+
+    @classmethod
+    def from_recording_file(cls, filepath, **kwargs):
+        # The file should be a JSON object with "offers" and "instances" lists.
+        with open(filepath, "r") as f:
+            recording = json.load(f)
+        return cls(
+            offers=recording.get("offers", ()),
+            instances=recording.get("instances", ()),
+            **kwargs,
+        )
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}"
+
+    def create_client(self, **kwargs):
+        return client_lib.VastClient(server_url=self.url, api_key="fake", **kwargs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    ###########################################################################
+
+    def _is_rate_limited(self):
+        if self._max_requests_per_sec is None:
+            return False
+        now = time.time()
+        with self._lock:
+            while self._request_times and now - self._request_times[0] > 1.0:
+                self._request_times.popleft()
+            if len(self._request_times) >= self._max_requests_per_sec:
+                self.num_rate_limited += 1
+                return True
+            self._request_times.append(now)
+            return False
+
+    def _respond(self, method, path, body):
+        # Returns a tuple of the status code and JSON response.
+        with self._lock:
+            self.request_counts[(method, path)] += 1
+
+        if self._latency_secs:
+            time.sleep(self._latency_secs)
+        if self._is_rate_limited():
+            return 429, {"error": "Too many requests."}
+
+        with self._lock:
+            if method == "GET" and path == "/bundles":
+                return 200, {"offers": list(self._offers)}
+
+            elif method == "GET" and path == "/instances":
+                return 200, {"instances": list(self._instances)}
+
+            match = re.fullmatch(r"/asks/(\d+)/", path)
+            if method == "PUT" and match:
+                return self._create_instance(int(match.group(1)), body)
+
+            match = re.fullmatch(r"/instances/(\d+)/", path)
+            if method == "DELETE" and match:
+                instance_id = int(match.group(1))
+                self._instances = [i for i in self._instances if i["id"] != instance_id]
+                return 200, {"success": True}
+
+        return 404, {"error": f"Unknown endpoint {method} {path}."}
+
+    def _create_instance(self, offer_id, body):
+        # NOTE: Must be called while holding the lock.
+        offers = [o for o in self._offers if o["id"] == offer_id]
+        if not offers:
+            return 404, {"error": f"Offer {offer_id} not found."}
+        self._offers.remove(offers[0])
+
+        instance_id = max([i["id"] for i in self._instances] + [offer_id]) + 1
+        self._instances.append(
+            {
+                "id": instance_id,
+                "label": body.get("label"),
+                "actual_status": "running",
+                "ssh_host": "127.0.0.1",
+                "ssh_port": 22,
+                "dph_total": offers[0].get("dph_total"),
+            }
+        )
+        return 200, {"success": True, "new_contract": instance_id}
+
+    def _create_handler_cls(self):
+        fake_server = self
+
+        class Handler(server.BaseHTTPRequestHandler):
+            def _handle(self):
+                path = self.path.split("?", 1)[0]
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+
+                status, response = fake_server._respond(self.command, path, body)
+
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_PUT = _handle
+            do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,19 +1,20 @@
 """TODO: Add title."""
 from concurrent import futures
+import collections
 import datetime
-import functools
+import heapq
+import itertools
 import logging as pylogging
 from multiprocessing import connection
 import os
-import queue
 import subprocess
+import threading
 import time
 
 from typing import Sequence
 
 from absl import logging
 import requests
-import sshtunnel
 
 from del8.core import data_class
 from del8.core import serialization
@@ -21,8 +22,10 @@ from del8.core.execution import executor
 from del8.core.utils import backoffs
 
 from . import api_wrapper
+from . import autoscaling
 from . import onstart_util
 from . import messages
+from . import tunnels
 
 
 # Do this to suppress messages that spam the logs when trying
@@ -34,6 +37,13 @@ pylogging.getLogger("sshtunnel.SSHTunnelForwarder").addFilter(lambda *x, **y: Fa
 pylogging.getLogger("paramiko.transport").addFilter(lambda *x, **y: False)
 
 
+###############################################################################
+
+
+class NoOffersAvailable(Exception):
+    pass
+
+
 ###############################################################################
 
 # NOTE: I'm not sure how this will work if we use this as a pip package. In the
@@ -54,12 +64,58 @@ class VastExecutorParams(object):
         # on start command.
         entire_on_start_cmd=None,
         base_exit_logger_params=None,
+        # Instance statuses are polled from a listing of all of our instances that
+        # is refreshed at most this often.
+        instance_status_refresh_secs=10,
+        # Limits how many instances we try to create at the same time.
+        max_concurrent_instance_creations=8,
+        # We query for fresh offers once fewer than this many are left.
+        offer_requery_threshold=4,
+        # Number of offers we try before giving up on launching a worker.
+        max_offer_attempts_per_launch=5,
+        # If provided, project tarballs get uploaded here and the onstart command
+        # fetches them instead of having them inlined. Should be the params of an
+        # artifact store from `artifact_util`.
+        artifact_store_params=None,
+        # If provided, items running for longer than this multiple of the median
+        # duration of completed items get re-dispatched to idle workers. The first
+        # copy to finish wins. Idle workers are kept around while this could happen.
+        straggler_multiple=None,
+        # How long idle workers wait between checks for stragglers.
+        idle_worker_poll_secs=30,
+        # Decides the order items run in and how many idle workers to keep. Should
+        # be a policy from `executor`. Runs items in order if None.
+        scheduling_policy=None,
+        # If provided, workers get launched and killed as the queue drains. The
+        # `num_workers` will then only be the initial number of workers. Should
+        # be an `autoscaling.AutoscalerParams`.
+        autoscaler_params=None,
+        # Max number of threads used for blocking calls such as creating
+        # instances and opening SSH tunnels. Calls past this get queued.
+        max_blocking_threads=32,
+        # Our messages are small JSON, so compression just costs CPU.
+        ssh_compression=False,
+        ssh_keepalive_secs=15.0,
+        # We retry setting up the SSH tunnel to a new worker this many times with
+        # this interval. Workers usually take a while before accepting SSH
+        # connections, so short intervals get us the first item sooner.
+        ssh_connect_retries=60,
+        ssh_connect_retry_secs=5,
+        # Number of times we try to re-establish a lost connection to a worker
+        # through its existing tunnel before killing it. The item it was running
+        # still counts as failed.
+        max_reconnect_attempts=0,
     ):
         pass
 
     def get_queries_str(self):
         return self.offer_query.get_queries_str(self.instance_params)
 
+    def get_scheduling_policy(self):
+        if not self.scheduling_policy:
+            return executor.FifoSchedulingPolicy()
+        return self.scheduling_policy
+
     def create_onstart_cmd(self):
         if self.entire_on_start_cmd:
             return self.entire_on_start_cmd
@@ -174,97 +230,388 @@ def launch_experiment(
 ###############################################################################
 
 
-def _list_to_queue(lst):
-    q = queue.Queue()
-    for item in lst:
-        q.put_nowait(item)
-    return q
-
-
-###############################################################################
-
-
 class _WorkerStates(object):
     UNSTARTED = "UNSTARTED"
     INITIALIZING = "INITIALIZING"
     ACCEPTING = "ACCEPTING"
     PROCESSING = "PROCESSING"
+    # We lost the connection to the worker. We either reconnect or kill it.
+    BROKEN = "BROKEN"
     SHUTTING_DOWN = "SHUTTING_DOWN"
     KILLED = "KILLED"
 
 
+def _identity(x):
+    return x
+
+
+def _copy_future_result(src, dst):
+    def callback(src):
+        exception = src.exception()
+        if exception is not None:
+            dst.set_exception(exception)
+        else:
+            dst.set_result(src.result())
+
+    src.add_done_callback(callback)
+
+
+class _Waiter(object):
+    """Single thread that waits on worker connections and timers.
+
+    This lets us avoid tying up a thread per worker while it processes an item or
+    while we wait to poll it again.
+    """
+
+    def __init__(self, pool, poll_secs=1.0):
+        self._pool = pool
+        self._poll_secs = poll_secs
+
+        self._lock = threading.Lock()
+        # Connection to (future, fn).
+        self._readable = {}
+        # Heap of (time, count, future, fn, args). The count breaks ties.
+        self._timers = []
+        self._counter = itertools.count()
+
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def when_readable(self, conn, fn):
+        """Calls `fn` on the waiter thread once `conn` is readable.
+
+        The `fn` should not block as it holds up everything else. Returns a
+        future with its result.
+        """
+        future = futures.Future()
+        with self._lock:
+            self._readable[conn] = (future, fn)
+        return future
+
+    def cancel(self, conn):
+        """Stops waiting on `conn` without calling its `fn`.
+
+        Returns the future that `when_readable` returned, which is left for the
+        caller to resolve. Returns None if we were not waiting on `conn`.
+        """
+        with self._lock:
+            entry = self._readable.pop(conn, None)
+        return entry[0] if entry else None
+
+    def after(self, delay_secs, fn, *args):
+        """Calls `fn` in the pool after a delay and returns a future with its result."""
+        future = futures.Future()
+        with self._lock:
+            heapq.heappush(
+                self._timers,
+                (time.time() + delay_secs, next(self._counter), future, fn, args),
+            )
+        return future
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+
+    def _pop_due_timers(self):
+        # NOTE: Must be called while holding the lock.
+        now = time.time()
+        due = []
+        while self._timers and self._timers[0][0] <= now:
+            due.append(heapq.heappop(self._timers))
+        timeout = self._poll_secs
+        if self._timers:
+            timeout = min(timeout, max(self._timers[0][0] - now, 0.0))
+        return due, timeout
+
+    def _loop(self):
+        while not self._closed:
+            with self._lock:
+                conns = list(self._readable.keys())
+                due, timeout = self._pop_due_timers()
+
+            for _, _, future, fn, args in due:
+                _copy_future_result(self._pool.submit(fn, *args), future)
+
+            if not conns:
+                time.sleep(timeout)
+                continue
+
+            for conn in connection.wait(conns, timeout=timeout):
+                with self._lock:
+                    entry = self._readable.pop(conn, None)
+                if entry is None:
+                    # Cancelled while we were waiting.
+                    continue
+                future, fn = entry
+                try:
+                    future.set_result(fn())
+                except Exception as e:
+                    future.set_exception(e)
+
+
 class VastSupervisor(executor.Supervisor):
+    """Runs execution items on Vast AI workers.
+
+    Each worker handle is a state machine whose transitions are futures. Only
+    blocking calls, e.g. creating instances, opening SSH tunnels, and killing
+    workers, run in a pool of at most `max_blocking_threads` threads. Waiting
+    on processing workers and between polls of a worker happens on a single
+    waiter thread.
+
+    Threads used with the default `max_blocking_threads=32`, besides the main
+    and waiter threads:
+        - Up to 32 pool threads. They mostly exist while workers are starting.
+        - About 2 per connected worker: one for the `sshtunnel` forwarding server
+          and one for its paramiko transport.
+    So roughly 50 threads for 10 workers, 230 for 100 workers, and 1030 for
+    500 workers. The old pool alone had 8 threads per worker. The thread stacks
+    are mostly untouched, so the memory cost is mostly the SSH buffers. That is
+    on the order of a few hundred KB per connected worker, so a few hundred MB
+    for 500 workers.
+    """
+
     def __init__(self, vast_params):
         self._vast_params = vast_params
         self._worker_launcher = VastWorkerLauncher(vast_params, self)
         self._execution_items = None
+        # Shared by all of the worker handles.
+        self.instance_snapshots = api_wrapper.InstanceSnapshots(
+            refresh_interval_secs=vast_params.instance_status_refresh_secs
+        )
+        self.tunnel_manager = tunnels.TunnelManager(
+            compression=vast_params.ssh_compression,
+            keepalive_secs=vast_params.ssh_keepalive_secs,
+        )
 
     @classmethod
     def from_params(cls, executor_params):
         return cls(executor_params)
 
     def initialize(self):
-        # NOTE: I chose the 8 pretty arbitarily here.
-        max_pool_workers = round(8 * self._vast_params.num_workers)
-        self._pool = futures.ThreadPoolExecutor(max_workers=max_pool_workers)
+        self._pool = futures.ThreadPoolExecutor(
+            max_workers=self._vast_params.max_blocking_threads
+        )
+        self._waiter = _Waiter(self._pool)
         self._worker_handles = set()
-        self._failed_items = set()
+        self._idle_worker_handles = set()
+        # Keys of the items that have failed once.
+        self._failed_item_keys = set()
+        self._launch_futures = set()
+        self._worker_handles_lock = threading.Lock()
+        # Handles that we have decided to kill but that might not have started
+        # shutting down yet. Guarded by the worker handles lock.
+        self._handles_being_killed = set()
+        # Guards the tracking of which workers run copies of which items.
+        self._copies_lock = threading.Lock()
+        # Item key to the handles running a copy of it.
+        self._item_key_to_handles = collections.defaultdict(set)
+        # Handles whose item another worker completed before we started waiting
+        # on them. They get killed once we would start waiting.
+        self._superseded_handles = set()
+        self._autoscaler = None
+        autoscaler_params = self._vast_params.autoscaler_params
+        if autoscaler_params:
+            self._autoscaler = autoscaler_params.instantiate_autoscaler(
+                self._vast_params.num_workers
+            )
         self._worker_launcher.prepare_for_launches()
 
     def close(self):
+        self._waiter.close()
         self._pool.shutdown()
         for handle in self._worker_handles:
             handle.close()
+        self.tunnel_manager.close()
 
     def _launch_worker(self):
-        handle = self._worker_launcher.launch()
-        self._worker_handles.add(handle)
+        # Returns None if there were no offers to launch the worker from.
+        try:
+            handle = self._worker_launcher.launch()
+        except NoOffersAvailable as e:
+            # Our existing workers are fine. With autoscaling, we try again with
+            # freshly queried offers at a later scale up.
+            logging.warning(f"Skipping a worker launch. {e}")
+            return None
+        with self._worker_handles_lock:
+            self._worker_handles.add(handle)
         return handle
 
+    def _get_live_worker_handles(self):
+        dead_states = [_WorkerStates.SHUTTING_DOWN, _WorkerStates.KILLED]
+        with self._worker_handles_lock:
+            return [
+                h
+                for h in self._worker_handles
+                if h.state not in dead_states and h not in self._handles_being_killed
+            ]
+
+    def _kill_worker(self, handle, submit=None):
+        # Returns the future of the kill. The worker stops counting as live right
+        # away, so later scaling decisions do not kill another worker in its place.
+        with self._worker_handles_lock:
+            self._handles_being_killed.add(handle)
+        return (submit or self._pool.submit)(handle.kill)
+
+    def _get_num_live_workers(self):
+        # Workers that are still launching count as live.
+        return len(self._get_live_worker_handles()) + len(self._launch_futures)
+
+    def _get_dollars_per_hour_per_worker(self):
+        dphs = [h.get_dollars_per_hour() for h in self._get_live_worker_handles()]
+        dphs = [d for d in dphs if d is not None]
+        return sum(dphs) / len(dphs) if dphs else None
+
+    def _autoscale(self, submit_to_pool):
+        execution_items = self._execution_items
+        num_to_launch = self._autoscaler.decide(
+            num_pending=execution_items.qsize(),
+            num_running=execution_items.num_in_flight(),
+            num_workers=self._get_num_live_workers(),
+            expected_item_secs=execution_items.get_expected_duration(),
+            dollars_per_hour_per_worker=self._get_dollars_per_hour_per_worker(),
+        )
+        for _ in range(num_to_launch):
+            self._launch_futures.add(submit_to_pool(self._launch_worker))
+
+    def _should_scale_down(self):
+        if not self._autoscaler:
+            return False
+        # Idle workers kept around for re-dispatching stragglers are not part of
+        # the target, so they do not count here.
+        num_workers = self._get_num_live_workers() - len(self._idle_worker_handles)
+        return num_workers > self._autoscaler.target_num_workers
+
+    def _has_remaining_items(self):
+        execution_items = self._execution_items
+        return execution_items.qsize() > 0 or execution_items.num_in_flight() > 0
+
     def _run(self, execution_items):
         not_done = set()
 
+        def track(future):
+            not_done.add(future)
+            return future
+
         def submit_to_pool(fn, *args, **kwargs):
-            not_done.add(self._pool.submit(fn, *args, **kwargs))
+            return track(self._pool.submit(fn, *args, **kwargs))
 
         total_exe_items = len(execution_items)
 
-        execution_items = _list_to_queue(execution_items)
+        scheduling_policy = self._vast_params.get_scheduling_policy()
+        execution_items = scheduling_policy.order_items(execution_items)
+        scheduling_policy.log_schedule(execution_items, self._vast_params.num_workers)
+
+        straggler_multiple = self._vast_params.straggler_multiple
+        if straggler_multiple is not None:
+            execution_items = executor.add_dedup_keys(execution_items)
+        execution_items = executor.SpeculativeItemQueue(
+            execution_items, straggler_multiple=straggler_multiple
+        )
         self._execution_items = execution_items
 
         for _ in range(self._vast_params.num_workers):
-            submit_to_pool(self._launch_worker)
+            self._launch_futures.add(submit_to_pool(self._launch_worker))
+
+        # With autoscaling, we launch new workers if all of ours die.
+        while not_done or (self._autoscaler and self._has_remaining_items()):
+            if self._autoscaler and self._autoscaler.is_decision_due():
+                self._autoscale(submit_to_pool)
+            if not not_done:
+                # All of our workers died. Wait until we can launch more.
+                time.sleep(self._vast_params.autoscaler_params.interval_secs)
+                continue
 
-        while not_done:
             logging.info("Waiting for a future to complete.")
             dones, not_done = futures.wait(
-                not_done, return_when=futures.FIRST_COMPLETED
+                not_done,
+                timeout=(
+                    self._vast_params.autoscaler_params.interval_secs
+                    if self._autoscaler
+                    else None
+                ),
+                return_when=futures.FIRST_COMPLETED,
             )
             for done in dones:
+                self._launch_futures.discard(done)
                 try:
                     handle = done.result(1)
                 except futures.TimeoutError as e:
                     logging.exception(e)
                     raise e
+                if handle is None:
+                    # A launch that had no offers to use.
+                    continue
                 state = handle.state
 
                 logging.info(f"Worker state: {state}")
 
                 if state == _WorkerStates.INITIALIZING:
-                    submit_to_pool(handle.wait_for_connection)
+                    # NOTE: We retry on a timer instead of sleeping in the pool so
+                    # that waiting workers do not hold up the other blocking calls.
+                    track(
+                        self._waiter.after(
+                            handle.retry_delay_secs, handle.wait_for_connection
+                        )
+                    )
 
                 elif state == _WorkerStates.ACCEPTING:
-                    try:
-                        item = execution_items.get_nowait()
+                    was_idle = handle in self._idle_worker_handles
+                    self._idle_worker_handles.discard(handle)
+                    with self._copies_lock:
+                        self._superseded_handles.discard(handle)
+                    # Idle workers are only killed once the scheduling policy no
+                    # longer wants them, which gets checked below.
+                    if not was_idle and self._should_scale_down():
+                        logging.info("Killing worker to scale down.")
+                        self._kill_worker(handle, submit_to_pool)
+                        continue
+
+                    item = execution_items.get()
+                    if item is not None:
                         remaining = execution_items.qsize()
-                        submit_to_pool(handle.accept_item, item)
+                        with self._copies_lock:
+                            key = executor.get_item_key(item)
+                            self._item_key_to_handles[key].add(handle)
+                        submit_to_pool(handle.send_item, item)
                         logging.info(
                             f"Approximately {remaining} out of {total_exe_items} execution items remaining."
                         )
-                    except queue.Empty:
-                        submit_to_pool(handle.kill)
+                    elif len(
+                        self._idle_worker_handles
+                    ) < scheduling_policy.num_idle_workers_to_keep(execution_items):
+                        # Idle workers are kept around in case an item needs to
+                        # be speculatively re-executed.
+                        self._idle_worker_handles.add(handle)
+                        track(
+                            self._waiter.after(
+                                self._vast_params.idle_worker_poll_secs,
+                                _identity,
+                                handle,
+                            )
+                        )
+                    else:
+                        self._kill_worker(handle, submit_to_pool)
+
+                elif state == _WorkerStates.PROCESSING:
+                    with self._copies_lock:
+                        if handle in self._superseded_handles:
+                            self._superseded_handles.discard(handle)
+                            logging.info("Killing worker running a completed item.")
+                            self._kill_worker(handle, submit_to_pool)
+                            continue
+                        track(
+                            self._waiter.when_readable(
+                                handle.connection, handle.finish_item
+                            )
+                        )
+
+                elif state == _WorkerStates.BROKEN:
+                    submit_to_pool(handle.reconnect)
 
                 elif state == _WorkerStates.KILLED:
+                    with self._worker_handles_lock:
+                        self._handles_being_killed.discard(handle)
                     continue
 
                 else:
@@ -272,18 +619,66 @@ class VastSupervisor(executor.Supervisor):
                         f"State {state} not recognized in the supervisor for VastWorkerHandle."
                     )
 
-    def handle_failed_item(self, item):
+        if self._has_remaining_items():
+            logging.error("All of the workers died with execution items remaining.")
+
+    def _remove_copy(self, item, handle):
+        # NOTE: Must be called while holding the copies lock.
+        key = executor.get_item_key(item)
+        handles = self._item_key_to_handles.get(key, set())
+        handles.discard(handle)
+        if not handles:
+            self._item_key_to_handles.pop(key, None)
+
+    def _stop_copy(self, handle):
+        # Kills a worker running a copy of an item that another worker completed.
+        #
+        # NOTE: Must be called while holding the copies lock.
+        future = self._waiter.cancel(handle.connection)
+        if future is None:
+            # The supervisor has not started waiting on the worker yet. It will
+            # kill the worker instead once it gets there.
+            self._superseded_handles.add(handle)
+            return
+        logging.info("Killing worker running a completed item.")
+        # The supervisor is already waiting on this future, so it now finds out
+        # that the worker got killed.
+        _copy_future_result(self._kill_worker(handle), future)
+
+    def handle_completed_item(self, item, duration_secs, handle=None):
+        with self._copies_lock:
+            self._remove_copy(item, handle)
+            if not self._execution_items.complete(item, duration_secs=duration_secs):
+                logging.info("Another worker already completed this item.")
+                return
+            other_handles = self._item_key_to_handles.pop(
+                executor.get_item_key(item), set()
+            )
+            for other_handle in other_handles:
+                self._stop_copy(other_handle)
+        if self._autoscaler:
+            self._autoscaler.record_completion()
+
+    def handle_failed_item(self, item, handle=None):
+        with self._copies_lock:
+            self._remove_copy(item, handle)
+        if not self._execution_items.fail(item):
+            logging.info("Processing item failed, but another copy of it is running.")
+            return
         # Assume if an item fails twice, then the item is bad. Won't always be
         # true but an OK heuristic.
-        if item not in self._failed_items:
-            self._failed_items.add(item)
-            self._execution_items.put_nowait(item)
+        key = executor.get_item_key(item)
+        if key not in self._failed_item_keys:
+            self._failed_item_keys.add(key)
+            self._execution_items.put(item)
             logging.info("Processing item failed. Adding back to queue.")
         else:
             logging.info("Processing item failed twice. Not retrying.")
 
 
 class VastWorkerLauncher(executor.WorkerLauncher):
+    # NOTE: The supervisor calls `launch` from many threads at once.
+
     def __init__(
         self,
         vast_params,
@@ -293,46 +688,115 @@ class VastWorkerLauncher(executor.WorkerLauncher):
         self._offers = None
         self._supervisor = supervisor
 
+        self._onstart_cmd = None
+        # Ids of the offers we have tried to create instances from. We don't want
+        # to try them again after we re-query the offers.
+        self._used_offer_ids = set()
+        self._offers_lock = threading.Lock()
+        self._creation_semaphore = threading.BoundedSemaphore(
+            vast_params.max_concurrent_instance_creations
+        )
+
     def prepare_for_launches(self):
+        # Creating the onstart command can be slow, so only do it once.
+        self._onstart_cmd = self._vast_params.create_onstart_cmd()
+        with self._offers_lock:
+            self._query_offers()
+
+    def _query_offers(self):
+        # NOTE: Must be called while holding the offers lock.
         offers = api_wrapper.query_offers(self._vast_params)
-        self._offers = _list_to_queue(offers)
+        offers = [o for o in offers if o.get_instance_id() not in self._used_offer_ids]
+        self._offers = api_wrapper.rank_offers(offers)
+        logging.info(f"Found {len(self._offers)} unused Vast AI offers.")
+
+    def _get_next_offer(self):
+        with self._offers_lock:
+            # Offers go stale quickly, so get fresh ones when we start running low.
+            if len(self._offers) < self._vast_params.offer_requery_threshold:
+                try:
+                    self._query_offers()
+                except Exception as e:
+                    logging.exception(e)
+
+            if not self._offers:
+                raise NoOffersAvailable(
+                    "Ran out of Vast AI offers when trying to create workers."
+                )
+
+            offer = self._offers.pop(0)
+            self._used_offer_ids.add(offer.get_instance_id())
+            return offer
 
     def launch(self):
-        # Note that this is safe as we do not add any offers to the queue after
-        # we havve created it. Otherwise, probably use something like a blocking get.
-        if self._offers.empty():
-            # TODO: Add some configuration on what to do in this case.
-            raise Exception("Ran out of Vast AI offers when trying to create workers.")
-        offer = self._offers.get_nowait()
-        handle = VastWorkerHandle(
-            vast_params=self._vast_params, offer=offer, supervisor=self._supervisor
-        )
-        return handle.start()
+        max_attempts = self._vast_params.max_offer_attempts_per_launch
+        for attempt in range(max_attempts):
+            offer = self._get_next_offer()
+            handle = VastWorkerHandle(
+                vast_params=self._vast_params,
+                offer=offer,
+                supervisor=self._supervisor,
+                onstart_cmd=self._onstart_cmd,
+            )
+            try:
+                with self._creation_semaphore:
+                    return handle.start()
+            except requests.exceptions.HTTPError as e:
+                # Trying another offer won't help if we are being rate limited.
+                if _is_rate_limited(e) or attempt + 1 == max_attempts:
+                    raise e
+                # Most likely someone else took the offer since we queried it.
+                logging.warning(
+                    f"Failed to create an instance from offer {offer.get_instance_id()}. "
+                    "Trying the next best offer."
+                )
 
 
-# 429 Too Many Requests
-_http_429_backoff = functools.partial(
-    backoffs.linear_to_exp_backoff,
-    exceptions_to_catch=(requests.exceptions.HTTPError,),
-    should_retry_on_exception_fn=lambda e: e.response.status_code == 429,
-)
+def _is_rate_limited(e):
+    # 429 Too Many Requests
+    return e.response is not None and e.response.status_code == 429
 
 
-class _ConnectFailedException(Exception):
-    pass
+# How long the supervisor waits between checks of whether a new worker's
+# instance is running.
+_INSTANCE_POLL_SECS = 5
+
+
+# How long we wait for a new connection to a worker to get closed before
+# assuming that the worker is alive.
+_RECONNECT_CHECK_SECS = 5
 
 
 class VastWorkerHandle(executor.WorkerHandle):
-    def __init__(self, vast_params, offer, supervisor):
+    def __init__(self, vast_params, offer, supervisor, onstart_cmd=None):
         self._vast_params = vast_params
         self._offer = offer
         self._supervisor = supervisor
+        self._onstart_cmd = onstart_cmd
 
         self._uuid = None
         self._instance = None
         self._tunnel = None
         self._listener = None
         self._conn = None
+        self._item = None
+        self._item_start_time = None
+        self._num_reconnect_attempts = 0
+
+        self._connect_schedule = backoffs.create_retry_schedule(
+            linear_backoff_steps=vast_params.ssh_connect_retries,
+            linear_interval_secs=vast_params.ssh_connect_retry_secs,
+            exp_backoff_steps=0,
+        )
+        self._rate_limit_schedule = backoffs.create_retry_schedule(
+            linear_backoff_steps=0,
+            exp_start_interval_secs=30,
+            # Lots of workers hit the API at once, so keep them from retrying in
+            # lockstep.
+            jitter=backoffs.Jitter.DECORRELATED,
+        )
+        # How long the supervisor should wait before calling `wait_for_connection`.
+        self.retry_delay_secs = _INSTANCE_POLL_SECS
 
         self.state = _WorkerStates.UNSTARTED
 
@@ -343,13 +807,18 @@ class VastWorkerHandle(executor.WorkerHandle):
 
         instance_id = self._offer.get_instance_id()
         self._uuid = api_wrapper.create_instance(
-            instance_id, vast_params=self._vast_params
+            instance_id, vast_params=self._vast_params, onstart_cmd=self._onstart_cmd
         )
 
         return self
 
+    def get_dollars_per_hour(self):
+        return self._offer.get_dollars_per_hour()
+
     def kill(self):
         self.state = _WorkerStates.SHUTTING_DOWN
+        # Otherwise the tunnel's forwarder keeps running for the rest of the run.
+        self._close_tunnel()
         try:
             self._perform_worker_exit_logging()
         except Exception as e:
@@ -407,85 +876,94 @@ class VastWorkerHandle(executor.WorkerHandle):
         exit_logger.log_from_base64(logger_params, logs_tar_base64)
 
     def wait_for_connection(self):
-        try:
-            return self._wait_for_connection()
-        except _ConnectFailedException as e:
-            logging.error(
-                f"Worker {self._uuid} failed to connect. Instance {self._instance._json}."
-            )
-            logging.exception(e)
-            return self.kill()
-
-    @_http_429_backoff(
-        linear_backoff_steps=0,
-        exp_start_interval_secs=30,
-    )
-    def _wait_for_connection(self):
+        # Makes a single attempt to connect to the worker without blocking for
+        # long. If the worker is not ready yet, it stays INITIALIZING and the
+        # supervisor calls this again after `retry_delay_secs`.
         assert self.state == _WorkerStates.INITIALIZING
-        # NOTE: Not sure if this sleep is necessary.
-        time.sleep(5)
-        if self._can_connect():
-            self._connect()
-            self.state = _WorkerStates.ACCEPTING
+        try:
+            if self._can_connect():
+                self._connect()
+                self.state = _WorkerStates.ACCEPTING
+            else:
+                self.retry_delay_secs = _INSTANCE_POLL_SECS
+        except api_wrapper.InstanceNotFoundError:
+            # Freshly created instances take a bit to show up in the listing.
+            self.retry_delay_secs = _INSTANCE_POLL_SECS
+        except requests.exceptions.HTTPError as e:
+            if not _is_rate_limited(e):
+                raise e
+            self.retry_delay_secs = self._rate_limit_schedule.next_wait_secs()
+            if self.retry_delay_secs is None:
+                raise e
+        except tunnels.TunnelFailedException as e:
+            self.retry_delay_secs = self._connect_schedule.next_wait_secs()
+            if self.retry_delay_secs is None:
+                logging.error(
+                    f"Worker {self._uuid} failed to connect. "
+                    f"Instance {self._instance._json}."
+                )
+                logging.exception(e)
+                return self.kill()
         return self
 
     def _can_connect(self):
         assert self.state == _WorkerStates.INITIALIZING
-        self._instance = api_wrapper.get_instance_by_uuid(self._uuid)
+        self._instance = self._supervisor.instance_snapshots.get_instance_by_uuid(
+            self._uuid
+        )
         return self._instance.is_running() and self._instance.get_ssh_address()
 
-    def _is_tunnel_good_to_go(self):
-        if not self._tunnel:
-            return False
-        self._tunnel.check_tunnels()
-        if not self._tunnel.is_active or not self._tunnel.is_alive:
-            return False
-        if not self._tunnel.tunnel_is_up[
-            (self._tunnel.local_bind_host, self._tunnel.local_bind_port)
-        ]:
-            logging.debug("Tunnel is active and alive but does not appear to be up.")
-            return False
-        return True
-
-    @backoffs.linear_to_exp_backoff(
-        exceptions_to_catch=(_ConnectFailedException,),
-        should_retry_on_exception_fn=lambda e: isinstance(e, _ConnectFailedException),
-        linear_backoff_steps=20,
-        linear_interval_secs=15,
-    )
     def _connect(self):
         assert self.state == _WorkerStates.INITIALIZING
 
-        ssh_address = self._instance.get_ssh_address()
-        remote_port = self._vast_params.instance_params.remote_port
-
-        self._tunnel = sshtunnel.SSHTunnelForwarder(
-            ssh_address,
-            remote_bind_address=("127.0.0.1", remote_port),
-            ssh_username="root",
-            compression=True,
-            #
-            # mute_exceptions=False,
-            mute_exceptions=True,
-            #
-            # This is in seconds.
-            set_keepalive=15.0,
+        self._tunnel = self._supervisor.tunnel_manager.get_tunnel(
+            self._instance.get_ssh_address(),
+            self._vast_params.instance_params.remote_port,
         )
+        self._conn = self._tunnel.connect()
+
+    def reconnect(self):
+        # Tries to get a new connection to the worker through its existing
+        # tunnel after we lost the old one. Kills the worker if we can't.
+        assert self.state == _WorkerStates.BROKEN
+        while self._num_reconnect_attempts < self._vast_params.max_reconnect_attempts:
+            self._num_reconnect_attempts += 1
+            logging.info(f"Trying to reconnect to worker {self._uuid}.")
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+            try:
+                self._conn = self._tunnel.connect()
+            except (tunnels.TunnelFailedException, OSError) as e:
+                logging.exception(e)
+                continue
+            # The worker never sends anything unprompted, so anything to read
+            # here is the connection getting closed.
+            if self._conn.poll(_RECONNECT_CHECK_SECS):
+                logging.warning(f"Worker {self._uuid} closed the new connection.")
+                continue
+            logging.info(f"Reconnected to worker {self._uuid}.")
+            self.state = _WorkerStates.ACCEPTING
+            return self
+        return self.kill()
 
-        self._tunnel.start()
-
-        if not self._is_tunnel_good_to_go():
-            raise _ConnectFailedException(
-                "Failed to create SSH tunnel to VastAI worker."
-            )
-
-        self._conn = connection.Client(("127.0.0.1", self._tunnel.local_bind_port))
+    @property
+    def connection(self):
+        return self._conn
 
     def accept_item(self, item):
+        self.send_item(item)
+        self.finish_item()
+        if self.state == _WorkerStates.BROKEN:
+            return self.kill()
+        return self
+
+    def send_item(self, item):
         assert self.state == _WorkerStates.ACCEPTING
         assert item is not None
 
         self.state = _WorkerStates.PROCESSING
+        self._item = item
 
         msg = messages.Message(
             type=messages.MessageType.PROCESS_ITEM,
@@ -494,45 +972,85 @@ class VastWorkerHandle(executor.WorkerHandle):
 
         ser_msg = serialization.serialize(msg)
         logging.info(f"Sending execution item to worker {self._uuid}.")
-        start_time = time.time()
-        self._conn.send(ser_msg)
+        self._item_start_time = time.time()
+        try:
+            self._conn.send(ser_msg)
+        except OSError as e:
+            self._handle_lost_connection(e)
+
+        return self
+
+    def _handle_lost_connection(self, e):
+        logging.error(
+            f"Lost connection to worker {self._uuid}. Instance {self._instance._json}."
+        )
+        logging.exception(e)
+        self.state = _WorkerStates.BROKEN
+        self._supervisor.handle_failed_item(self._item, handle=self)
+        self._item = None
+
+    def finish_item(self):
+        # Receives the response for the item we sent. Blocks until the worker
+        # responds, so the supervisor only calls it once the connection is
+        # readable.
+        assert self.state == _WorkerStates.PROCESSING
+        item = self._item
 
         try:
             response = self._conn.recv()
-        except EOFError as e:
-            logging.error(
-                f"Worker {self._uuid} received EOFError. Instance {self._instance._json}."
-            )
-            logging.exception(e)
-            self._supervisor.handle_failed_item(item)
-            return self.kill()
+        except (EOFError, OSError) as e:
+            self._handle_lost_connection(e)
+            return self
 
-        elapsed_seconds = time.time() - start_time
+        elapsed_seconds = time.time() - self._item_start_time
         elapsed_nice = str(datetime.timedelta(seconds=elapsed_seconds))
 
         logging.info(f"Received response from worker {self._uuid}.")
         # Elapsed will be formated as "hh:mm:ss.fractions".
         logging.info(f"The worker processed the item in {elapsed_nice}.")
-        response = serialization.deserialize(response)
+        # NOTE: This runs on the supervisor's waiter thread, so we must not let
+        # exceptions escape.
+        try:
+            response = serialization.deserialize(response)
+        except ValueError as e:
+            # We can't trust anything else the worker sends us.
+            logging.exception(e)
+            self.state = _WorkerStates.BROKEN
+            self._supervisor.handle_failed_item(item, handle=self)
+            self._item = None
+            return self
 
         if response.content.status != messages.ResponseStatus.SUCCESS:
-            # TODO: Handle failures.
-            raise ValueError(
-                f"Unsuccessful item processing with status {response.status}."
+            # The item failed, but the worker itself is fine.
+            logging.error(
+                "Unsuccessful item processing with status "
+                f"{response.content.status}."
             )
+            self._supervisor.handle_failed_item(item, handle=self)
+            self.state = _WorkerStates.ACCEPTING
+            self._item = None
+            return self
 
         logging.info("Successfully processed an item.")
+        self._supervisor.handle_completed_item(item, elapsed_seconds, handle=self)
 
         self.state = _WorkerStates.ACCEPTING
+        self._item = None
 
         return self
 
-    def close(self):
+    def _close_tunnel(self):
         if self._conn:
             self._conn.close()
             self._conn = None
         if self._tunnel:
-            self._tunnel.stop()
+            self._supervisor.tunnel_manager.close_tunnel(
+                self._instance.get_ssh_address(),
+                self._vast_params.instance_params.remote_port,
+            )
             self._tunnel = None
+
+    def close(self):
+        self._close_tunnel()
         if self.state not in [_WorkerStates.SHUTTING_DOWN, _WorkerStates.KILLED]:
             self.kill()
@@ -0,0 +1,317 @@
+"""Persistent, size-bounded blob cache that can be shared across processes.
+
+The cache lives in a single directory on the host. An SQLite database holds
+the index of cached blobs along with their sizes and access statistics. All
+modifications of the index happen while holding an exclusive file lock, so
+several worker processes on the same host can safely share one cache.
+
+Readers pin the blobs that they are using. Eviction skips pinned blobs, so a
+file never disappears while somebody is reading it. Pins record the pid of
+their process, and pins of dead processes get cleaned up during eviction.
+"""
+import contextlib
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+import uuid as uuidlib
+
+from absl import logging
+
+from del8.core import data_class
+from del8.core.utils import file_util
+
+
+_INDEX_FILENAME = "index.sqlite"
+_INDEX_LOCK_FILENAME = "index.lock"
+_BLOBS_DIRNAME = "blobs"
+_KEY_LOCKS_DIRNAME = "locks"
+
+_ENTRIES_TABLE = "Entries"
+_PINS_TABLE = "Pins"
+
+
+@data_class.data_class()
+class BlobCacheParams(object):
+    LRU = "LRU"
+    LFU = "LFU"
+
+    def __init__(
+        self,
+        cache_dir="~/.del8_blob_cache",
+        # 50 GB
+        max_bytes=50 * 1024 ** 3,
+        eviction_policy=LRU,
+    ):
+        pass
+
+    def get_cache_dir(self):
+        return os.path.expanduser(self.cache_dir)
+
+    def instantiate_cache(self):
+        return BlobCache(params=self)
+
+
+class BlobCache(object):
+    def __init__(self, params):
+        self._params = params
+
+    @property
+    def cache_dir(self):
+        return self._params.get_cache_dir()
+
+    @property
+    def max_bytes(self):
+        return self._params.max_bytes
+
+    @property
+    def eviction_policy(self):
+        return self._params.eviction_policy
+
+    @property
+    def _index_filepath(self):
+        return os.path.join(self.cache_dir, _INDEX_FILENAME)
+
+    @property
+    def _index_lock_filepath(self):
+        return os.path.join(self.cache_dir, _INDEX_LOCK_FILENAME)
+
+    @property
+    def _blobs_dir(self):
+        return os.path.join(self.cache_dir, _BLOBS_DIRNAME)
+
+    @property
+    def _key_locks_dir(self):
+        return os.path.join(self.cache_dir, _KEY_LOCKS_DIRNAME)
+
+    ############################################
+
+    def initialize(self):
+        os.makedirs(self._blobs_dir, exist_ok=True)
+        os.makedirs(self._key_locks_dir, exist_ok=True)
+        with self._index() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {_ENTRIES_TABLE} ("
+                "key TEXT NOT NULL PRIMARY KEY, "
+                "size INTEGER NOT NULL, "
+                "last_access REAL NOT NULL, "
+                "hits INTEGER NOT NULL)"
+            )
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {_PINS_TABLE} ("
+                "pin_id TEXT NOT NULL PRIMARY KEY, "
+                "key TEXT NOT NULL, "
+                "pid INTEGER NOT NULL)"
+            )
+
+    def close(self):
+        pass
+
+    @contextlib.contextmanager
+    def _index(self):
+        # To be used as `with self._index() as conn: ...`
+        #
+        # The connection commits when the context exits without an exception.
+        with file_util.file_lock(self._index_lock_filepath):
+            conn = sqlite3.connect(self._index_filepath, timeout=60)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                conn.close()
+
+    def _key_to_filepath(self, key):
+        return os.path.join(self._blobs_dir, key)
+
+    def _key_to_lock_filepath(self, key):
+        # Keys might contain slashes, so hash them to get a flat file name.
+        key_hash = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self._key_locks_dir, f"{key_hash}.lock")
+
+    ############################################
+
+    def _get_filepath(self, key, pin=False):
+        # Returns a tuple of the filepath and the pin id. The filepath is None if
+        # the key is not in the cache. Counts as an access. If `pin` is True, the
+        # entry gets pinned in the same transaction as the lookup so that it
+        # cannot be evicted in between.
+        with self._index() as conn:
+            row = conn.execute(
+                f"SELECT size FROM {_ENTRIES_TABLE} WHERE key=?", (key,)
+            ).fetchone()
+            if not row:
+                return None, None
+
+            filepath = self._key_to_filepath(key)
+            if not os.path.exists(filepath):
+                # Somebody removed the file out from under us.
+                conn.execute(f"DELETE FROM {_ENTRIES_TABLE} WHERE key=?", (key,))
+                return None, None
+
+            conn.execute(
+                f"UPDATE {_ENTRIES_TABLE} SET last_access=?, hits=hits+1 WHERE key=?",
+                (time.time(), key),
+            )
+            pin_id = self._pin(conn, key) if pin else None
+            return filepath, pin_id
+
+    def get_filepath(self, key):
+        # Returns None if the key is not in the cache. Counts as an access.
+        #
+        # NOTE: The file is not pinned, so it can be evicted at any time. Use
+        # `pinned` to read it.
+        filepath, _ = self._get_filepath(key)
+        return filepath
+
+    def _fetch(self, key, download_fn, pin):
+        # Returns a tuple of the filepath and the pin id.
+        filepath, pin_id = self._get_filepath(key, pin=pin)
+        if filepath:
+            return filepath, pin_id
+
+        with file_util.file_lock(self._key_to_lock_filepath(key)):
+            # Someone else might have downloaded it while we were waiting.
+            filepath, pin_id = self._get_filepath(key, pin=pin)
+            if filepath:
+                return filepath, pin_id
+
+            filepath = self._key_to_filepath(key)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+            # Download to a temporary file and then atomically move it into place so
+            # that nobody can see a partially written blob.
+            tmp_filepath = f"{filepath}.{uuidlib.uuid4().hex}.tmp"
+            try:
+                download_fn(tmp_filepath)
+                # We hand out paths to the cached files directly, so make them
+                # read-only to catch anyone accidentally writing to them.
+                os.chmod(tmp_filepath, 0o444)
+                os.replace(tmp_filepath, filepath)
+            finally:
+                if os.path.exists(tmp_filepath):
+                    os.remove(tmp_filepath)
+
+            pin_id = self._add_entry(key, os.path.getsize(filepath), pin=pin)
+
+        return filepath, pin_id
+
+    def fetch(self, key, download_fn):
+        """Makes sure that the blob is cached and returns its filepath.
+
+        On a cache miss, `download_fn(filepath)` is called to write the blob
+        to the given filepath. Only one process will download any given key
+        at a time; the others wait and then reuse the result.
+
+        The blob is not pinned, so this is meant for warming the cache. Use
+        `pinned` to read the blob.
+        """
+        filepath, _ = self._fetch(key, download_fn, pin=False)
+        return filepath
+
+    @contextlib.contextmanager
+    def pinned(self, key, download_fn):
+        """Like `fetch`, but the blob cannot be evicted within the context.
+
+        To be used as `with cache.pinned(key, download_fn) as filepath: ...`
+        """
+        filepath, pin_id = self._fetch(key, download_fn, pin=True)
+        try:
+            yield filepath
+        finally:
+            self.unpin(pin_id)
+
+    def put_file(self, key, src_filepath):
+        return self.fetch(key, lambda dst: shutil.copyfile(src_filepath, dst))
+
+    ############################################
+
+    def pin(self, key):
+        """Returns a pin id, or None if the key is not in the cache.
+
+        The blob will not be evicted until `unpin` gets called with the pin id
+        or our process dies.
+        """
+        _, pin_id = self._get_filepath(key, pin=True)
+        return pin_id
+
+    def unpin(self, pin_id):
+        with self._index() as conn:
+            conn.execute(f"DELETE FROM {_PINS_TABLE} WHERE pin_id=?", (pin_id,))
+
+    def _pin(self, conn, key):
+        # NOTE: Must be called while holding the index lock.
+        pin_id = uuidlib.uuid4().hex
+        conn.execute(
+            f"INSERT INTO {_PINS_TABLE} VALUES (?, ?, ?)", (pin_id, key, os.getpid())
+        )
+        return pin_id
+
+    def _get_pinned_keys(self, conn):
+        # NOTE: Must be called while holding the index lock.
+        pinned_keys = set()
+        rows = conn.execute(f"SELECT pin_id, key, pid FROM {_PINS_TABLE}").fetchall()
+        for pin_id, key, pid in rows:
+            if _is_process_alive(pid):
+                pinned_keys.add(key)
+            else:
+                conn.execute(f"DELETE FROM {_PINS_TABLE} WHERE pin_id=?", (pin_id,))
+        return pinned_keys
+
+    ############################################
+
+    def _add_entry(self, key, size, pin=False):
+        # Returns the pin id if `pin` is True.
+        with self._index() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {_ENTRIES_TABLE} VALUES (?, ?, ?, 1)",
+                (key, size, time.time()),
+            )
+            pin_id = self._pin(conn, key) if pin else None
+            self._evict(conn, keep_key=key)
+            return pin_id
+
+    def _eviction_order(self):
+        if self.eviction_policy == BlobCacheParams.LRU:
+            return "last_access ASC"
+        elif self.eviction_policy == BlobCacheParams.LFU:
+            return "hits ASC, last_access ASC"
+        else:
+            raise ValueError(f"Unrecognized eviction policy: {self.eviction_policy}.")
+
+    def _evict(self, conn, keep_key=None):
+        # NOTE: Must be called while holding the index lock.
+        (total_bytes,) = conn.execute(
+            f"SELECT COALESCE(SUM(size), 0) FROM {_ENTRIES_TABLE}"
+        ).fetchone()
+        if total_bytes <= self.max_bytes:
+            return
+
+        pinned_keys = self._get_pinned_keys(conn)
+        rows = conn.execute(
+            f"SELECT key, size FROM {_ENTRIES_TABLE} ORDER BY {self._eviction_order()}"
+        ).fetchall()
+        for key, size in rows:
+            if total_bytes <= self.max_bytes:
+                break
+            elif key == keep_key or key in pinned_keys:
+                continue
+
+            try:
+                os.remove(self._key_to_filepath(key))
+            except FileNotFoundError:
+                pass
+            conn.execute(f"DELETE FROM {_ENTRIES_TABLE} WHERE key=?", (key,))
+            total_bytes -= size
+            logging.info(f"Evicted {key} ({size} bytes) from the blob cache.")
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to someone else.
+        return True
+    return True
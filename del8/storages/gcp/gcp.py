@@ -1,5 +1,6 @@
 """TODO: Add title."""
 import contextlib
+import io
 import json
 import os
 import shutil
@@ -30,11 +31,15 @@ SerializationType = serialization.SerializationType
 
 
 RUN_STATES_TABLE = "RunStates"
+RUN_DEDUP_KEYS_TABLE = "RunDedupKeys"
 ITEMS_TABLE = "Items"
 BLOBS_TABLE = "Blobs"
 
 
 # Should only be set to true for debugging.
+#
+# NOTE: Set `blob_cache_params` on the GcpStorageParams to get a persistent,
+# size-bounded cache instead.
 PERSISTENT_CACHE = False
 
 
@@ -56,6 +61,25 @@ class GcpStorageParams(storage.StorageParams):
         # Stuff for caching.
         blob_read_cache_dir="~/.del8_gcp_storage_blob_read_cache",
         preloading_params=None,
+        # If provided, retrieved blobs are kept in a persistent, size-bounded
+        # cache shared by all processes on the host. Should be a
+        # `blob_cache.BlobCacheParams`.
+        blob_cache_params=None,
+        # Stuff for content-addressed blobs. If True, blobs are named after
+        # the hash of their contents and only uploaded if no blob with the
+        # same hash exists. This requires the `content_hash` column of the
+        # Blobs table, see schema.sql.
+        content_addressed_blobs=False,
+        content_hash_algorithm="blake2b",
+        # Stuff for uploading. If `stream_model_weights` is True, model weights
+        # are serialized in memory and uploaded via a resumable upload session
+        # instead of going through a temporary file on local disk. HDF5 needs
+        # random access while writing, so this holds the whole file in memory:
+        # peak memory is about the size of the weights plus one upload chunk. The
+        # chunk size must be a multiple of 256 KB.
+        stream_model_weights=False,
+        # 32 MB
+        upload_chunk_size=32 * 1024 * 1024,
     ):
         pass
 
@@ -125,6 +149,7 @@ class GcpStorage(storage.Storage):
         self._bucket = None
 
         self._preloader = None
+        self._blob_cache = None
 
         # Using an int instead of a bool to enable an idempotent context manager.
         self._use_blob_read_cache_depth = 0
@@ -256,6 +281,9 @@ class GcpStorage(storage.Storage):
             self._conn = self._initialize_cloud_sql()
         if not self._bucket:
             self._bucket = self._initialize_cloud_storage()
+        if not self._blob_cache and self._gcp_params.blob_cache_params:
+            self._blob_cache = self._gcp_params.blob_cache_params.instantiate_cache()
+            self._blob_cache.initialize()
         if not self._preloader and self.can_preload_blobs():
             self._preloader = self._gcp_params.preloading_params.instantiate_preloader(
                 self
@@ -270,9 +298,12 @@ class GcpStorage(storage.Storage):
                 self._conn.close()
             if self._preloader:
                 self._preloader.close()
+            if self._blob_cache:
+                self._blob_cache.close()
             self._conn = None
             self._bucket = None
             self._preloader = None
+            self._blob_cache = None
 
     #################
 
@@ -296,6 +327,11 @@ class GcpStorage(storage.Storage):
     def preload_blobs(self, blob_uuids):
         self._preloader.preload_blobs(blob_uuids)
 
+    @property
+    def blob_cache(self):
+        # Will be None if we are not using a persistent blob cache.
+        return self._blob_cache
+
     #################
 
     def store_item(self, item):
@@ -335,8 +371,36 @@ class GcpStorage(storage.Storage):
 
     #################
 
-    def set_run_state(self, run_state):
+    def set_run_state(self, run_state, dedup_key=None):
         with self._cursor() as c:
+            if run_state == storage.RunState.FINISHED and dedup_key is not None:
+                # The first run to claim the key wins. Since this is in the same
+                # transaction as setting the state, runs finishing at the same
+                # time can't both get marked as FINISHED.
+                #
+                # Databases created before dedup keys existed lack the table.
+                c.execute(
+                    f"CREATE TABLE IF NOT EXISTS {RUN_DEDUP_KEYS_TABLE} ("
+                    "dedup_key varchar(128) NOT NULL PRIMARY KEY, "
+                    "run_uuid char(32) NOT NULL)"
+                )
+                c.execute(
+                    f"INSERT INTO {RUN_DEDUP_KEYS_TABLE} VALUES (%s, %s) "
+                    "ON CONFLICT (dedup_key) DO NOTHING",
+                    (dedup_key, self.run_uuid),
+                )
+                c.execute(
+                    f"SELECT run_uuid FROM {RUN_DEDUP_KEYS_TABLE} WHERE dedup_key=%s",
+                    (dedup_key,),
+                )
+                (winning_run_uuid,) = c.fetchone()
+                if winning_run_uuid != self.run_uuid:
+                    logging.info(
+                        f"Run {winning_run_uuid} already finished the same execution "
+                        "item. Marking this run as a duplicate."
+                    )
+                    run_state = storage.RunState.DUPLICATE
+
             c.execute(
                 f"INSERT INTO {RUN_STATES_TABLE} VALUES (%s, %s, %s, %s) "
                 "ON CONFLICT (run_uuid) DO UPDATE SET state = EXCLUDED.state",
@@ -600,11 +664,131 @@ class GcpStorage(storage.Storage):
     def _upload_file(self, blob, filename):
         blob.upload_from_filename(filename, timeout=TIMEOUT)
 
+    @backoffs.linear_to_exp_backoff(
+        exceptions_to_catch=[
+            requests.exceptions.ReadTimeout,
+            # NOTE: We might have to do something more if we get a ConnectionError.
+            requests.exceptions.ConnectionError,
+            ConnectionResetError,
+        ]
+    )
+    def _upload_stream(self, blob, stream):
+        # Setting the chunk size makes the client use a resumable upload session
+        # that reads and sends the stream one chunk at a time.
+        blob.chunk_size = self._gcp_params.upload_chunk_size
+        # We seek back to the start on each attempt so that retries send
+        # everything.
+        size = stream.seek(0, io.SEEK_END)
+        stream.seek(0)
+        blob.upload_from_file(stream, size=size, timeout=TIMEOUT)
+
+    def _insert_blob_row(self, blob_uuid, gcp_storage_object_name, content_hash=None):
+        columns = [
+            "uuid",
+            "group_uuid",
+            "exp_uuid",
+            "run_uuid",
+            "gcp_storage_object_name",
+        ]
+        values = [
+            blob_uuid,
+            self.group_uuid,
+            self.experiment_uuid,
+            self.run_uuid,
+            gcp_storage_object_name,
+        ]
+        # NOTE: We only mention the content_hash column when we have one so that
+        # databases created before that column existed keep working.
+        if content_hash is not None:
+            columns.append("content_hash")
+            values.append(content_hash)
+
+        columns = ", ".join(columns)
+        placeholders = ", ".join(["%s"] * len(values))
+        with self._cursor() as c:
+            c.execute(
+                f"INSERT INTO {BLOBS_TABLE} ({columns}) VALUES ({placeholders})",
+                tuple(values),
+            )
+
+    def _retrieve_blob_name_by_content_hash(self, content_hash):
+        with self._cursor() as c:
+            c.execute(
+                f"SELECT gcp_storage_object_name FROM {BLOBS_TABLE} "
+                "WHERE content_hash=%s LIMIT 1",
+                (content_hash,),
+            )
+            row = c.fetchone()
+        return row[0] if row else None
+
+    def _store_blob(self, ext, upload_fn, content_hash_fn):
+        # NOTE: ext should start with a dot if it is non-empty.
+        #
+        # The `upload_fn` takes a gcp storage blob and uploads our data to it. The
+        # `content_hash_fn` returns the hash of our data and is only called when
+        # using content-addressed blobs.
+        blob_uuid = self.new_uuid()
+
+        if not self._gcp_params.content_addressed_blobs:
+            gcp_storage_object_name = f"{blob_uuid}{ext}"
+            upload_fn(self._bucket.blob(gcp_storage_object_name))
+            self._insert_blob_row(blob_uuid, gcp_storage_object_name)
+            return blob_uuid
+
+        content_hash = content_hash_fn()
+        gcp_storage_object_name = self._retrieve_blob_name_by_content_hash(content_hash)
+
+        if gcp_storage_object_name:
+            logging.info(
+                f"Blob contents already stored at {gcp_storage_object_name}. Skipping upload."
+            )
+        else:
+            # NOTE: If two processes store the same contents at the same time,
+            # they will both upload to the same object name. Since the contents
+            # are identical, this is harmless.
+            gcp_storage_object_name = f"{content_hash}{ext}"
+            upload_fn(self._bucket.blob(gcp_storage_object_name))
+
+        self._insert_blob_row(
+            blob_uuid, gcp_storage_object_name, content_hash=content_hash
+        )
+        # TODO: Maybe delete the GCP storage object if inserting into the
+        # database fails. Then probably re-raise the exception.
+        return blob_uuid
+
+    def _store_blob_from_local_file(self, filepath, ext):
+        algorithm = self._gcp_params.content_hash_algorithm
+        return self._store_blob(
+            ext,
+            upload_fn=lambda blob: self._upload_file(blob, filepath),
+            content_hash_fn=lambda: file_util.hash_file(filepath, algorithm=algorithm),
+        )
+
+    def _store_blob_from_stream(self, stream, ext):
+        # The `stream` must be seekable.
+        algorithm = self._gcp_params.content_hash_algorithm
+
+        def content_hash_fn():
+            stream.seek(0)
+            return file_util.hash_stream(stream, algorithm=algorithm)
+
+        return self._store_blob(
+            ext,
+            upload_fn=lambda blob: self._upload_stream(blob, stream),
+            content_hash_fn=content_hash_fn,
+        )
+
     def store_model_weights(self, model):
         """Returns UUID."""
-        blob_uuid = self.new_uuid()
         extension = "h5"
-        gcp_storage_object_name = f"{blob_uuid}.{extension}"
+
+        if self._gcp_params.stream_model_weights:
+            # NOTE: Imported here so that we do not need tensorflow on machines that
+            # only use the storage for reading and writing items.
+            from del8.core.utils import hdf5_util
+
+            with hdf5_util.model_weights_to_hdf5_buffer(model) as buf:
+                return self._store_blob_from_stream(buf, f".{extension}")
 
         # NOTE: We write to a temporary local file and then upload to
         # Cloud Storage. It might also be possible to directly save to
@@ -612,48 +796,14 @@ class GcpStorage(storage.Storage):
         # each of the methods.
         with tempfile.NamedTemporaryFile(suffix=f".{extension}") as f:
             model.save_weights(f.name)
-            blob = self._bucket.blob(gcp_storage_object_name)
-            self._upload_file(blob, f.name)
-
-        with self._cursor() as c:
-            c.execute(
-                f"INSERT INTO {BLOBS_TABLE} VALUES (%s, %s, %s, %s, %s)",
-                (
-                    blob_uuid,
-                    self.group_uuid,
-                    self.experiment_uuid,
-                    self.run_uuid,
-                    gcp_storage_object_name,
-                ),
-            )
-        # TODO: Maybe delete the GCP storage object if inserting into the
-        # database fails. Then probably re-raise the exception.
-        return blob_uuid
+            # With content-addressed blobs, the file gets hashed by streaming it
+            # in chunks before the upload.
+            return self._store_blob_from_local_file(f.name, f".{extension}")
 
     def store_blob_from_file(self, filepath):
         # NOTE: ext will start with a dot if it is non-empty.
         ext = file_util.get_file_suffix(filepath)
-        blob_uuid = self.new_uuid()
-        gcp_storage_object_name = f"{blob_uuid}{ext}"
-
-        blob = self._bucket.blob(gcp_storage_object_name)
-        blob.upload_from_filename(filepath, timeout=TIMEOUT)
-
-        with self._cursor() as c:
-            c.execute(
-                f"INSERT INTO {BLOBS_TABLE} VALUES (%s, %s, %s, %s, %s)",
-                (
-                    blob_uuid,
-                    self.group_uuid,
-                    self.experiment_uuid,
-                    self.run_uuid,
-                    gcp_storage_object_name,
-                ),
-            )
-
-        # TODO: Maybe delete the GCP storage object if inserting into the
-        # database fails. Then probably re-raise the exception.
-        return blob_uuid
+        return self._store_blob_from_local_file(filepath, ext)
 
     def _should_cache_blobs(self):
         return bool(PERSISTENT_CACHE or self._use_blob_read_cache_depth)
@@ -661,55 +811,143 @@ class GcpStorage(storage.Storage):
     def _is_blob_preloaded(self, blob_uuid):
         return bool(self._preloader and self._preloader.has_blob(blob_uuid))
 
-    def retrieve_blob_as_file(self, blob_uuid, dst_dir):
-        if self._should_cache_blobs() and blob_uuid in self._blob_uuid_to_name:
-            object_name = self._blob_uuid_to_name[blob_uuid]
-
-            cached_path = os.path.join(self.blob_read_cache_dir, object_name)
+    def _download_blob(self, object_name, filepath, bucket=None):
+        if bucket is None:
+            bucket = self._bucket
+        blob = bucket.blob(object_name)
+        blob.download_to_filename(filepath, timeout=TIMEOUT)
 
-            filename = os.path.basename(object_name)
-            filepath = os.path.join(dst_dir, filename)
+    def _get_blob_cache_key(self, blob_uuid):
+        if blob_uuid not in self._blob_uuid_to_name:
+            self._blob_uuid_to_name[blob_uuid] = self.retrieve_blob_name(blob_uuid)
+        return self._blob_uuid_to_name[blob_uuid]
 
-            if cached_path != filepath:
-                shutil.copyfile(cached_path, filepath)
+    @contextlib.contextmanager
+    def _local_blob_filepath(self, blob_uuid):
+        # To be used as `with self._local_blob_filepath(blob_uuid) as path: ...`
+        #
+        # Yields the path of a local copy of the blob in one of our caches,
+        # downloading it into a cache if we are using one. Yields None if there
+        # is no local copy and nowhere to put one. The blob is pinned in the blob
+        # cache within the context, so it will not be evicted while we use it.
+        #
+        # NOTE: The file belongs to the cache and must NOT be modified.
+        if self._blob_cache:
+            object_name = self._get_blob_cache_key(blob_uuid)
+            with self._blob_cache.pinned(
+                object_name, lambda path: self._download_blob(object_name, path)
+            ) as filepath:
+                yield filepath
+        else:
+            yield self._get_local_blob_filepath(blob_uuid)
 
-            return filepath
+    def _get_local_blob_filepath(self, blob_uuid):
+        # Like `_local_blob_filepath` for when we are not using the blob cache.
+        if self._should_cache_blobs() and blob_uuid in self._blob_uuid_to_name:
+            object_name = self._blob_uuid_to_name[blob_uuid]
+            return os.path.join(self.blob_read_cache_dir, object_name)
 
         elif self._is_blob_preloaded(blob_uuid):
-            preloaded_path = self._preloader.get_blob_filepath(blob_uuid)
-
-            filename = os.path.basename(preloaded_path)
-            filepath = os.path.join(dst_dir, filename)
+            return self._preloader.get_blob_filepath(blob_uuid)
 
-            if preloaded_path != filepath:
-                shutil.copyfile(preloaded_path, filepath)
-
-            return filepath
+        elif self._should_cache_blobs():
+            object_name = self.retrieve_blob_name(blob_uuid)
+            cached_path = self._download_to_read_cache(object_name)
+            self._blob_uuid_to_name[blob_uuid] = object_name
+            return cached_path
+
+        return None
+
+    def _download_to_read_cache(self, object_name, bucket=None):
+        # Returns the path of the blob in the read cache.
+        cached_path = os.path.join(self.blob_read_cache_dir, object_name)
+        # NOTE: With content-addressed blobs, several blob uuids can share the
+        # same object name. Thus the blob might be in the cache even though we
+        # have never retrieved this specific uuid.
+        if not os.path.exists(cached_path):
+            # Download to a temporary file and then move it into place so that
+            # nobody sees a partially downloaded blob in the cache.
+            tmp_path = f"{cached_path}.{self.new_uuid()}.tmp"
+            try:
+                self._download_blob(object_name, tmp_path, bucket=bucket)
+                os.replace(tmp_path, cached_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return cached_path
+
+    def retrieve_blob_as_file(self, blob_uuid, dst_dir, read_only=False):
+        # If `read_only` is True, the returned file might be a hardlink to a file
+        # in one of our caches. It thus must not be modified.
+        with self._local_blob_filepath(blob_uuid) as local_path:
+            if local_path:
+                filename = os.path.basename(local_path)
+                filepath = os.path.join(dst_dir, filename)
+
+                # NOTE: A hardlink keeps the file alive even if it later gets
+                # evicted from the cache.
+                if local_path != filepath:
+                    file_util.link_or_copy(
+                        local_path, filepath, allow_hardlink=read_only
+                    )
+
+                return filepath
 
         object_name = self.retrieve_blob_name(blob_uuid)
 
-        if PERSISTENT_CACHE:
-            cached_path = os.path.join(self.blob_read_cache_dir, object_name)
-            if os.path.exists(cached_path):
-                self._blob_uuid_to_name[blob_uuid] = object_name
-                return self.retrieve_blob_as_file(blob_uuid, dst_dir)
-
         filename = os.path.basename(object_name)
         filepath = os.path.join(dst_dir, filename)
 
-        blob = self._bucket.blob(object_name)
-        blob.download_to_filename(filepath, timeout=TIMEOUT)
-
-        if self._should_cache_blobs():
-            self._blob_uuid_to_name[blob_uuid] = object_name
-            cached_path = os.path.join(self.blob_read_cache_dir, object_name)
-            if filepath != cached_path:
-                shutil.copyfile(filepath, cached_path)
+        self._download_blob(object_name, filepath)
 
         return filepath
 
+    def get_blob_prefetch_fn(self, blob_uuid):
+        # Resolves the blob's object name here, as our database connection must
+        # only be used by the thread that owns the storage. The returned function
+        # only downloads the blob into one of our caches. It uses a separate
+        # bucket client so it can run in a background thread.
+        if not self._blob_cache and not self._should_cache_blobs():
+            return None
+        elif not self._blob_cache and self._is_blob_preloaded(blob_uuid):
+            return None
+
+        object_name = self._blob_uuid_to_name.get(blob_uuid)
+        if object_name is None:
+            object_name = self.retrieve_blob_name(blob_uuid)
+
+        def prefetch():
+            bucket = self.get_bucket_from_new_client()
+            if self._blob_cache:
+                self._blob_cache.fetch(
+                    object_name,
+                    lambda path: self._download_blob(object_name, path, bucket=bucket),
+                )
+            else:
+                self._download_to_read_cache(object_name, bucket=bucket)
+
+        return prefetch
+
+    @contextlib.contextmanager
+    def retrieve_blob_as_readonly_path(self, blob_uuid):
+        # Hands out the path in our cache directly if we have the blob locally. It
+        # stays pinned in the blob cache until the context exits.
+        with self._local_blob_filepath(blob_uuid) as local_path:
+            if local_path:
+                yield local_path
+                return
+        with super().retrieve_blob_as_readonly_path(blob_uuid) as filepath:
+            yield filepath
+
     @contextlib.contextmanager
     def retrieve_blob_as_tempfile(self, blob_uuid, flags="r"):
+        if not any(c in flags for c in "wax+"):
+            # We won't be modifying the file, so avoid making a copy.
+            with self.retrieve_blob_as_readonly_path(blob_uuid) as filepath:
+                with open(filepath, flags) as file:
+                    yield file
+            return
+
         use_cache = bool(self._use_blob_read_cache_depth)
 
         if use_cache:
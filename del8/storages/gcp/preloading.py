@@ -68,9 +68,18 @@ class GcpPreloader(object):
     def _bucket(self):
         return self._storage._bucket
 
+    @property
+    def _blob_cache(self):
+        # NOTE: When the storage has a persistent blob cache, we preload directly
+        # into it. The cache then takes care of eviction, so we ignore the
+        # clear_style and do not persist our own uuid to name mapping.
+        return self._storage.blob_cache
+
     ############################################
 
     def initialize(self):
+        if self._blob_cache:
+            return
         if not os.path.isdir(self.preload_dir):
             os.mkdir(self.preload_dir)
         if os.path.exists(self.blob_uuid_to_name_filename):
@@ -81,7 +90,8 @@ class GcpPreloader(object):
         # Make sure that they are unique.
         blob_uuids = set(blob_uuids)
 
-        if self.clear_style == GcpPreloadingParams.DELETE_UNUSED:
+        should_remove_unused = self.clear_style == GcpPreloadingParams.DELETE_UNUSED
+        if not self._blob_cache and should_remove_unused:
             removed_uuids = self._remove_difference_from_cache(blob_uuids)
             logging.info(f"Remove {len(removed_uuids)} unused blobs from cache.")
 
@@ -101,7 +111,9 @@ class GcpPreloader(object):
         logging.info(f"Downloaded {len(blob_uuids_to_load)} blobs in {elapsed_nice}")
 
     def close(self):
-        if self.clear_style == GcpPreloadingParams.DELETE_ALL:
+        if self._blob_cache:
+            self._blob_uuid_to_filename = {}
+        elif self.clear_style == GcpPreloadingParams.DELETE_ALL:
             self._blob_uuid_to_filename = {}
             shutil.rmtree(self.preload_dir)
             logging.info("Cleared preloading cache.")
@@ -129,6 +141,14 @@ class GcpPreloader(object):
     )
     def _preload_blob(self, item):
         blob_uuid, blob_name = item
+
+        if self._blob_cache:
+            self._blob_uuid_to_filename[blob_uuid] = self._blob_cache.fetch(
+                blob_name,
+                lambda path: self._download_blob(blob_uuid, blob_name, path),
+            )
+            return
+
         filepath = os.path.join(self.preload_dir, blob_name)
 
         if os.path.exists(filepath):
@@ -136,6 +156,10 @@ class GcpPreloader(object):
             logging.info(f"Using blob {blob_uuid} cached at {filepath}")
             return
 
+        self._download_blob(blob_uuid, blob_name, filepath)
+        self._blob_uuid_to_filename[blob_uuid] = filepath
+
+    def _download_blob(self, blob_uuid, blob_name, filepath):
         start_time = time.time()
 
         logging.info(f"Starting download of {blob_uuid}")
@@ -147,13 +171,20 @@ class GcpPreloader(object):
         elapsed_nice = str(datetime.timedelta(seconds=elapsed_seconds))
         logging.info(f"Downloaded blob {blob_uuid} in {elapsed_nice}")
 
-        self._blob_uuid_to_filename[blob_uuid] = filepath
-
     def _remove_difference_from_cache(self, blob_uuids):
         difference = set(self._blob_uuid_to_filename.keys()) - set(blob_uuids)
+        # NOTE: With content-addressed blobs, multiple blob uuids can share the
+        # same file. Make sure not to delete files still used by a kept blob.
+        kept_filepaths = {
+            self.get_blob_filepath(uuid)
+            for uuid in self._blob_uuid_to_filename.keys()
+            if uuid not in difference
+        }
         for uuid in difference:
             filepath = self.get_blob_filepath(uuid)
             del self._blob_uuid_to_filename[uuid]
+            if filepath in kept_filepaths:
+                continue
             try:
                 os.remove(filepath)
             except FileNotFoundError:
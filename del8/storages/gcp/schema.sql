@@ -25,6 +25,15 @@ CREATE TABLE RunStates (
     state      integer NOT NULL
 );
 
+-- Used to make sure that only one run per execution item gets marked as finished
+-- when items are speculatively executed on several workers. Only used when
+-- speculative execution is enabled, and created on first use for existing
+-- databases.
+CREATE TABLE RunDedupKeys (
+    dedup_key varchar(128) NOT NULL PRIMARY KEY,
+    run_uuid  char(32) NOT NULL
+);
+
 
 CREATE TABLE Items (
     -- Recall that the `uuid` column represents the uuid of
@@ -54,8 +63,18 @@ CREATE TABLE Blobs (
 
     -- We can limit this to 1024 as cloud storage object names
     -- are limited to 1024 bytes.
-    gcp_storage_object_name varchar(1024)
+    gcp_storage_object_name varchar(1024),
+
+    -- Hex digest of the blob's contents. Only filled in when using
+    -- content-addressed blobs, in which case several rows can share the
+    -- same gcp_storage_object_name. For existing databases, run:
+    --
+    --     ALTER TABLE Blobs ADD COLUMN content_hash varchar(128);
+    --     CREATE INDEX blobs_content_hash_idx ON Blobs (content_hash);
+    content_hash            varchar(128)
 );
 
+CREATE INDEX blobs_content_hash_idx ON Blobs (content_hash);
+
 -- -- TODO: Figure out how to do what I'm trying to do in the next line.
 -- GRANT CONNECT, SELECT, INSERT, UPDATE, DELETE ON DATABASE del8 TO del8;